@@ -0,0 +1,138 @@
+import time
+import heapq
+import threading
+from itertools import izip
+from datetime import datetime
+
+class ArchiveScheduler(object):
+
+    """
+    Incremental replacement for AptFeed.archive: instead of rechecking every active listing
+    on every run, each tick checks a fixed budget of the listings most likely to have been
+    removed since they were last checked.
+
+    priority of a listing = P(removed | age) * seconds since its last check
+
+    P(removed | age) is learned from the outcome of every check, per AGE_BUCKET of listing
+    age (Laplace smoothed), so old listings that tend to disappear get rechecked sooner than
+    fresh ones. The time of each listing's last check is stored in its last_checked column.
+
+    When the AptFeed tracks changes, the listings found live are rechecked against their
+    stored content hash and their changes recorded (see AptFeed.recheck, record_changes).
+
+    """
+
+    AGE_BUCKET = 24*60*60
+    REFRESH_T = 60*60
+
+    def __init__(self, feed, budget=200, tick_t=60):
+        self.feed = feed
+        self.pgSQL = feed.pgSQL
+        self.budget = budget
+        self.tick_t = tick_t
+
+        self.listings = {}      # listing_number: [url, created, last_checked] (epoch seconds)
+        self.hashes = {}        # listing_number: stored content hash, if changes are tracked
+        self.checked = {}       # age bucket: number of checks
+        self.removed = {}       # age bucket: number of checks that found the listing removed
+        self.refreshed = None
+        self.stopped = threading.Event()
+
+    def run(self):
+        """
+            ticks every tick_t seconds until stop() is called
+        """
+        while not self.stopped.is_set():
+            t_start = time.time()
+            self.tick()
+            elapsed = time.time() - t_start
+            if elapsed < self.tick_t:
+                self.stopped.wait(self.tick_t - elapsed)
+
+    def stop(self):
+        self.stopped.set()
+
+    def refresh(self):
+        """
+            reloads the active listings (picking up newly inserted ones) from get_active_listings
+        """
+        if len(self.pgSQL.identify_missing(['last_checked'])) > 0:
+            self.pgSQL.add_columns({'last_checked':datetime})
+        columns = ['listing_number', 'url', 'created', 'scrape_time', 'last_checked']
+        columns = [c for c in columns if len(self.pgSQL.identify_missing([c])) == 0] + self.feed.hash_fields()
+        now = time.time()
+        listings = {}
+        hashes = {}
+        for db_row in self.pgSQL.get_active_listings(columns):
+            row = dict(izip(columns, db_row))
+            created = self.epoch(row.get('created') or row.get('scrape_time')) or now
+            last_checked = self.epoch(row.get('last_checked')) or created
+            listings[row['listing_number']] = [row['url'], created, last_checked]
+            if row.get(self.feed.CONTENT_KEY) != None:
+                hashes[row['listing_number']] = row[self.feed.CONTENT_KEY]
+        self.listings = listings
+        self.hashes = hashes
+        self.refreshed = now
+
+    def tick(self):
+        """
+            checks the `budget` highest priority listings, archives the removed ones and records
+            the check time (and changes) of the rest
+
+            Returns the listing_numbers that were archived
+        """
+        if self.refreshed == None or time.time() - self.refreshed > self.REFRESH_T:
+            self.refresh()
+        now = time.time()
+        batch = self.select(now)
+        listings = [ (self.listings[n][0], self.hashes.get(n)) for n in batch ]
+
+        removed = []
+        alive = []
+        changes = []
+        for listing_number, (is_removed, content_hash, metrics) in izip(batch, self.feed.listing_checks(listings)):
+            if is_removed == None:
+                # undecided (eg: network error), try again once the others have had their turn
+                self.listings[listing_number][2] = now
+                continue
+            self.observe(now - self.listings[listing_number][1], is_removed)
+            if is_removed:
+                removed.append(listing_number)
+                print 'archived url={0}'.format(self.listings.pop(listing_number)[0])
+                self.hashes.pop(listing_number, None)
+            else:
+                alive.append(listing_number)
+                self.listings[listing_number][2] = now
+                if metrics != None:
+                    changes.append((listing_number, content_hash, metrics))
+                    self.hashes[listing_number] = content_hash
+        self.feed.archive_listings(removed)
+        self.pgSQL.mark_checked(alive)
+        self.feed.record_changes(changes)
+        return removed
+
+    def select(self, now):
+        """
+            listing_numbers of the `budget` listings with the highest priority at time now
+        """
+        priority = lambda n: self.priority(self.listings[n], now)
+        return heapq.nlargest(self.budget, self.listings, key=priority)
+
+    def priority(self, listing, now):
+        (url, created, last_checked) = listing
+        return self.removal_probability(now - created) * (now - last_checked)
+
+    def removal_probability(self, age):
+        bucket = int(age // self.AGE_BUCKET)
+        return (self.removed.get(bucket, 0) + 1.0) / (self.checked.get(bucket, 0) + 2.0)
+
+    def observe(self, age, is_removed):
+        bucket = int(age // self.AGE_BUCKET)
+        self.checked[bucket] = self.checked.get(bucket, 0) + 1
+        if is_removed:
+            self.removed[bucket] = self.removed.get(bucket, 0) + 1
+
+    def epoch(self, dt):
+        # timestamps are stored as naive local times (datetime.now())
+        if dt == None: return None
+        return time.mktime(dt.timetuple())
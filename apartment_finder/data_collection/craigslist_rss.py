@@ -1,23 +1,57 @@
 import re
 import os
+import math
 import time
 import string 
 import random
 import inspect
+import hashlib
 import urllib2
-import urlparse
-import feedparser
+import psycopg2
+import traceback
+import threading
+import multiprocessing
 import dateutil.parser
 from datetime import datetime
-from bs4 import BeautifulSoup
-
-from ..utilities.general_utils import mkdir_p, ProxyHandler
-from ..utilities.pgSQL_handler import pgSQL
+from itertools import izip
+from bs4 import BeautifulSoup, SoupStrainer
+from multiprocessing.pool import ThreadPool
+
+from ..utilities.general_utils import ProxyHandler
+from ..utilities.pgSQL_handler import pgSQL, as_timestamp
+from ..utilities.seen_cache import SeenCache
+from ..utilities.html_store import HtmlStore, read_page
+from ..utilities.spatial_index import SpatialIndex
+from ..utilities.instrumentation import REGISTRY
+from ..utilities.spool import Spool, SpoolDrainer
+from .pipeline import Pipeline
+from .image_downloader import ImageDownloader
+from .feed_watermarks import FeedWatermarks
+
+NON_DIGITS = re.compile('[^0-9]')
+NON_FLOAT = re.compile(r'[^\d.]')
 
 def metric(f):
     f.is_metric = True
     return f
 
+def parses(*selectors):
+    """
+        declares the elements a method reads from the soup as (tag name, {attribute: value})
+        pairs, so pages can be parsed keeping only those elements (see AptFeed.build_strainer)
+    """
+    def declare(f):
+        f.selectors = selectors
+        return f
+    return declare
+
+def selector_matches(wanted, attrs):
+    for (k, v) in wanted.items():
+        value = attrs.get(k)
+        if value == None or (value != v and v not in value.split()):
+            return False
+    return True
+
 class AptFeed(object):
 
     """
@@ -28,10 +62,44 @@ class AptFeed(object):
         These accept a BeautifulSoup (html) object and return a dictionary whose keys map to 
         the postgresql database fields, and values are that listing's coresponding values
 
+        @parses declares which elements a metric reads. When every metric declares them, pages
+        are parsed into a tree holding only those elements (in the single pass of the parser),
+        which is much cheaper than building the whole document
+
         This convention allows new metrics to be added to the AptFeed class without any 
         additional overhead. All metrics can be automatically called, and new db fields
         can be automatically added.
 
+    parse_processes:
+        When set, process_items and archive run as a staged Pipeline: pages are fetched by
+        fetch_concurrency() threads and parsed by a pool of parse_processes worker processes,
+        with at most pipeline_depth pages in between. Otherwise pages are parsed in the
+        fetch threads, which share one core
+
+    download_images:
+        new listings' images are saved under base_dir by an ImageDownloader running
+        image_workers threads in the background (see save_images)
+
+    index_geo:
+        keeps a SpatialIndex of the active listings, updated as listings are inserted and
+        archived, for comparables() lookups
+
+    valuation_path:
+        new listings are scored with a RentModel (saved at valuation_path) before they are
+        inserted, storing expected_rent and deal_score, and then folded into the model. Every
+        REVALUE_T the model is refitted and every active listing rescored in a background
+        thread with a connection of its own (see valuation.revalue)
+
+    watermarks_path:
+        feeds are requested conditionally (ETag / Last-Modified) and only their items newer
+        than the per-feed watermarks are processed (see FeedWatermarks), which are saved to
+        watermarks_path
+
+    detect_reposts:
+        new listings whose text_body nearly matches an indexed listing (see NearDuplicates)
+        get that listing's url in their REPOST_KEY column. The index is snapshotted to
+        reposts_path, or warmed from the active listings on startup
+
     """
 
 
@@ -42,70 +110,535 @@ class AptFeed(object):
 
     primary_key_methods = {} 
 
-    DELTA_T = 5*60
+    FEED_KEY = 'rss_link'     # db field holding the RSS item link a listing was scraped from
+    IMAGES_KEY = 'image_urls' # extract() entry listing a page's images, never stored in the db
+    REPOST_KEY = 'repost_of'  # db field holding the url of the listing a repost duplicates
 
-    def __init__(self, rss_url, base_dir, proxy_path='', db_name=None, db_user=None, default_table='apartment_listings', soup_parser='lxml'):
+    DELTA_T = 5*60
+    REVALUE_T = 24*60*60
+
+    ARCHIVE_BATCH = 500
+    REMOVED_STATUS = (404, 410)
+    REMOVED_NOTICE = re.compile(r'This posting has (been deleted|been flagged for removal|expired)')
+    POSTING_DATE = re.compile(r'<time[^>]+class="[^"]*timeago[^"]*"[^>]+datetime=')
+
+    REPLAY_EXCLUDED = ['archived', 'scrape_time']    # fields replay() must not overwrite
+    CONTENT_KEY = 'content_hash'
+    CHANGE_EXCLUDED = REPLAY_EXCLUDED + [CONTENT_KEY]   # fields whose changes record_changes() ignores
+
+    def __init__(self, rss_url, base_dir, proxy_path='', db_name=None, db_user=None, default_table='apartment_listings', soup_parser='lxml', max_per_proxy=4,
+                 seen_cache_path=None, seen_cache_size=100000, fast_extract=True, html_store_path=None,
+                 parse_processes=None, pipeline_depth=64, download_images=False, image_workers=8,
+                 index_geo=False, valuation_path=None, detect_reposts=False, reposts_path=None,
+                 watermarks_path=None, partitioned=False, spool_path=None, track_changes=False,
+                 pg_pool=None, proxy_handler=None, warm_seen=True):
         self.rss_url = rss_url
         self.soup_parser = soup_parser
         self.img_base = os.path.expanduser(base_dir)
-
-        if proxy_path != '':
-            self.proxy_handler = ProxyHandler(os.path.expanduser(proxy_path))
+        self.max_per_proxy = max_per_proxy
+        self.fetch_pool = None
+        self.parse_pool = None
+        self.parse_processes = parse_processes
+        self.pipeline_depth = pipeline_depth
+        self.html_store = HtmlStore(html_store_path) if html_store_path != None else None
+        # archive() and ArchiveScheduler also record the edits of live listings (see recheck)
+        self.track_changes = track_changes
+
+        # without a proxy list, pages are fetched directly (still over pooled keep-alive connections).
+        # Feeds running in one process can share a proxy_handler, and a psycopg2 pg_pool
+        self.proxy_handler = proxy_handler or ProxyHandler(os.path.expanduser(proxy_path), max_per_proxy=max_per_proxy)
+        self.pg_pool = pg_pool
+        self.db_args = None
         if db_name != None and db_user != None:
-            self.pgSQL = pgSQL(db_name, db_user, default_table=default_table)
-        methods = inspect.getmembers(self, predicate=inspect.ismethod)
-        self.metric_methods = [method for (name, method) in methods if 'is_metric' in dir(method)]
+            self.db_args = (db_name, db_user, default_table, partitioned)
+            self.pgSQL = self.connect()
+        self.metric_methods = [getattr(self, name) for name in self.metric_names()]
         self.primary_key_methods = {'url':self.get_url, 'title':self.get_title}
+        self.strainer = self.build_strainer(self.metric_methods + [self.image_urls]) if fast_extract else None
+        self.removal_strainer = self.build_strainer([self.get_post_date])
+
+        if seen_cache_path != None:
+            seen_cache_path = os.path.expanduser(seen_cache_path)
+        self.seen = SeenCache(seen_cache_size, seen_cache_path)
+        self.watermarks = FeedWatermarks(os.path.expanduser(watermarks_path) if watermarks_path != None else None)
+        self.images = None
+        if download_images:
+            self.images = ImageDownloader(self.proxy_handler, self.img_base, image_workers)
+            self.images.resume()
+        self.spatial_index = None
+        if index_geo:
+            self.spatial_index = SpatialIndex.from_db(self.pgSQL) if self.pgSQL != None else SpatialIndex()
+        self.valuation = None
+        self.valuation_path = os.path.expanduser(valuation_path) if valuation_path != None else None
+        self.revalued = None
+        if self.valuation_path != None:
+            # numpy based modules (and feedparser, see read_feed) are only imported when used,
+            # so archive and replay processes start quickly
+            from ..utilities.valuation import RentModel
+            self.valuation = RentModel.load(self.valuation_path) if os.path.exists(self.valuation_path) else RentModel()
+            self.revalued = os.path.getmtime(self.valuation_path) if os.path.exists(self.valuation_path) else 0
+        # with a spool, new listings are appended to a local log and stored by a background
+        # drainer (on a connection of its own), and failed dedupe lookups count as misses (see
+        # lookup), so an unavailable database doesn't stop scraping or lose listings
+        self.spool = None
+        self.drainer = None
+        self.drain_pgSQL = None
+        if spool_path != None:
+            self.spool = Spool(os.path.expanduser(spool_path))
+            self.drainer = SpoolDrainer(self.spool, self.store_spooled)
+        self.reposts = None
+        if detect_reposts:
+            from ..utilities.near_duplicates import NearDuplicates
+            self.reposts = NearDuplicates(snapshot_path=os.path.expanduser(reposts_path) if reposts_path != None else None)
+            if len(self.reposts) == 0 and self.pgSQL != None:
+                self.warm_reposts()
+        # only feeds that ingest need the seen cache (the daemon's archiver doesn't)
+        if warm_seen and len(self.seen) == 0 and self.pgSQL != None:
+            self.warm_seen()
 
     def process_feed(self):
         while True:
-            self.update_feed()
             t_start = time.time()
-            for item in self.feed['items']:
-                soup = self.soup(item['link'])
-                db_identifier = self.primary_key(soup)
-                if not self.pgSQL.apt_exists(db_identifier):
-                    metrics = self.coalesce_metrics(soup)
-                    self.pgSQL.insert(metrics)
-                    listing_id = str(self.pgSQL.get_uid(db_identifier))
-                    print 'inserted url={0}'.format(metrics['url'])
-                    #self.save_images(soup, listing_id)
-                else:
-                    print 'url={0} ALREADY EXISTS '.format(db_identifier['url'])
+            if self.update_feed() != 304:
+                self.process_items(self.watermarks.new_items(self.rss_url, self.feed))
+                self.watermarks.advance(self.rss_url, self.feed)
+            self.end_cycle()
             elapsed = time.time() - t_start;
             if elapsed < self.DELTA_T:
                 time.sleep(self.DELTA_T - elapsed)
 
-    def update_feed(self):
-        self.feed = feedparser.parse(self.rss_url, modified=(self.feed.modified if self.feed != None else None))
-        return self.feed.status
+    @classmethod
+    def metric_names(cls):
+        """
+            names of the @metric methods, looked up once per class (every parse worker and
+            every feed of a process builds its metric_methods from them)
+        """
+        if '_metric_names' not in cls.__dict__:
+            methods = inspect.getmembers(cls, predicate=inspect.ismethod)
+            cls._metric_names = [name for (name, method) in methods if 'is_metric' in dir(method)]
+        return cls._metric_names
 
-    def soup(self, url):
+    def connect(self):
+        """
+            a pgSQL of its own (eg: for a background thread), on a connection from self.pg_pool
+            if there is one. Hand it back with disconnect
+        """
+        pg_conn = self.pg_pool.getconn() if self.pg_pool != None else None
+        return pgSQL(*self.db_args, pg_conn=pg_conn)
+
+    def disconnect(self, db):
+        if self.pg_pool != None:
+            db.release(self.pg_pool)
+        elif db.pg_conn != None:
+            db.pg_conn.close()
+
+    def end_cycle(self):
+        """
+            snapshots the in-memory state after a polling cycle (see process_feed, FeedScheduler)
+        """
+        self.seen.save()
+        if self.reposts != None:
+            self.reposts.save()
+        if self.valuation != None:
+            self.valuation.save(self.valuation_path)
+            if self.db_args != None and time.time() - self.revalued > self.REVALUE_T:
+                self.start_revalue()
+
+    def start_revalue(self):
+        """
+            refits the rent model and rescores the active listings in a background thread.
+            The new model is saved by the next end_cycle, the only place it is saved from
+        """
+        from ..utilities.valuation import revalue
+        def run():
+            db = self.connect()
+            try:
+                self.valuation = revalue(db)
+            finally:
+                self.disconnect(db)
+        self.revalued = time.time()
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def process_items(self, items):
+        """
+            fetch and extract every unseen item's listing page concurrently (see extract_items)
+            and handle the results in feed order: dedupe against the database and collect the
+            metrics. New listings are inserted together with pgSQL.insert_many, so each cycle
+            commits once (or appended to self.spool, if there is one)
+
+            Returns the items that were not already stored
+
+        """
+        items = self.unseen_items(items)
+        new_listings = []
+        images = []
+        pending = set()
+        for item, metrics in self.extract_items(items):
+            if metrics == None:
+                print 'url={0} COULD NOT BE FETCHED '.format(item['link'])
+                REGISTRY.inc('pages_unavailable_total')
+                continue
+            db_identifier = { k:metrics[k] for k in self.primary_key_methods if k in metrics }
+            key = self.seen_key(db_identifier)
+            if key not in pending and key not in self.seen and not self.lookup('apt_exists', False, db_identifier):
+                pending.add(key)
+                metrics[self.FEED_KEY] = item['link']
+                images.append(metrics.pop(self.IMAGES_KEY, []))
+                new_listings.append(metrics)
+            else:
+                self.seen.add(key)
+                print 'url={0} ALREADY EXISTS '.format(db_identifier['url'])
+
+        if self.reposts != None:
+            self.link_reposts(new_listings)
+        if self.valuation != None:
+            self.valuation.score_metrics(new_listings)
+        if self.spool != None:
+            self.spool.append(zip(new_listings, images))
+        else:
+            self.store(self.pgSQL, new_listings, images)
+        if self.valuation != None:
+            from ..utilities.valuation import metrics_listings
+            self.valuation.update(metrics_listings(new_listings))
+        for metrics in new_listings:
+            self.seen.add(metrics[self.FEED_KEY])
+            self.seen.add(self.seen_key(metrics))
+        return items
+
+    def store(self, db, new_listings, images):
+        """
+            inserts new listings with one db.insert_many, then queues their images and indexes
+            their location. Returns their listing_numbers (None for rows not inserted)
+        """
+        with REGISTRY.timed('db_insert_seconds'):
+            listing_ids = db.insert_many(new_listings)
+        REGISTRY.inc('listings_inserted_total', len([n for n in listing_ids if n != None]))
+        for metrics, image_urls, listing_id in izip(new_listings, images, listing_ids):
+            if listing_id != None:
+                print 'inserted url={0}'.format(metrics['url'])
+                if self.images != None:
+                    self.images.save(listing_id, image_urls)
+                if self.spatial_index != None:
+                    self.spatial_index.add(listing_id, metrics.get('latitude'), metrics.get('longitude'), metrics.get('br'), metrics.get('ft2'))
+        return listing_ids
+
+    def store_spooled(self, records):
+        """
+            stores a batch of (metrics, image urls) records read from self.spool, skipping the
+            listings already stored by feed link or url (a batch is read again if the drainer
+            stopped before committing it, and lookup may have let duplicates through).
+            A failed batch drops the connection, so the retry reconnects
+        """
+        if self.drain_pgSQL == None:
+            self.drain_pgSQL = self.connect() if self.db_args != None else self.pgSQL
+        db = self.drain_pgSQL
         try:
-            if self.proxy_handler != None:
-                proxy = self.proxy_handler.get_proxy()
-                html = proxy.open(url).read()
+            for key in [self.FEED_KEY, 'url']:
+                if len(db.identify_missing([key])) == 0:
+                    stored = db.existing(key, [metrics.get(key) for (metrics, image_urls) in records])
+                    records = [ (metrics, image_urls) for (metrics, image_urls) in records if metrics.get(key) not in stored ]
+            return self.store(db, [metrics for (metrics, image_urls) in records], [image_urls for (metrics, image_urls) in records])
+        except Exception as e:
+            if db is not self.pgSQL:
+                self.disconnect(db)
+            self.drain_pgSQL = None
+            raise
+
+    def link_reposts(self, metrics_list):
+        """
+            sets REPOST_KEY of every listing that nearly duplicates one in self.reposts (or an
+            earlier one in metrics_list) to the canonical url, and indexes them all.
+            Returns the number of reposts
+        """
+        n = 0
+        for metrics in metrics_list:
+            if metrics.get('url') == None:
+                continue
+            signature = self.reposts.signature(metrics.get('text_body') or '')
+            match = self.reposts.find(signature)
+            if match != None:
+                metrics[self.REPOST_KEY] = match[0]
+                print 'url={0} REPOSTS {1}'.format(metrics['url'], match[0])
+                n += 1
+            self.reposts.add(metrics['url'], signature, match[0] if match != None else None)
+        return n
+
+    def warm_reposts(self):
+        """
+            indexes the text_body of the active listings, oldest first
+        """
+        if len(self.pgSQL.identify_missing(['url', 'text_body', 'archived'])) > 0:
+            return 0
+        fields = ['url', 'text_body'] + [k for k in [self.REPOST_KEY] if len(self.pgSQL.identify_missing([k])) == 0]
+        rows = self.pgSQL.get_active_listings(fields, limit=self.reposts.capacity)
+        for row in reversed(rows):
+            canonical = row[2] if len(row) > 2 else None
+            self.reposts.add(row[0], self.reposts.signature(row[1] or ''), canonical)
+        return len(self.reposts)
+
+    def comparables(self, metrics, k=10, ft2_tolerance=0.25, max_km=2.0):
+        """
+            [(distance in km, listing_number)] of the k closest active listings with the same
+            number of bedrooms and a size within ft2_tolerance of the listing described by metrics
+        """
+        br, ft2 = metrics.get('br'), metrics.get('ft2')
+        br_range = (br, br) if br != None else None
+        ft2_range = (ft2 * (1 - ft2_tolerance), ft2 * (1 + ft2_tolerance)) if ft2 != None else None
+        return self.spatial_index.nearest(metrics.get('latitude'), metrics.get('longitude'), k, br_range, ft2_range, max_km)
+
+    def archive_listings(self, listing_numbers):
+        """
+            pgSQL.archive_listings, also dropping the listings from the spatial index
+        """
+        REGISTRY.inc('listings_archived_total', len(listing_numbers))
+        if self.spatial_index != None:
+            for listing_number in listing_numbers:
+                self.spatial_index.remove(listing_number)
+        return self.pgSQL.archive_listings(listing_numbers)
+
+    def unseen_items(self, items):
+        """
+            drops feed items whose link is already stored in the FEED_KEY column (or repeats
+            within the feed) before any page is downloaded. Links missing from self.seen are
+            looked up with one query for the whole feed
+
+            listings stored before FEED_KEY existed are still caught by apt_exists after fetching
+        """
+        REGISTRY.inc('items_received_total', len(items))
+        uncached = [item['link'] for item in items if item['link'] not in self.seen]
+        seen = self.lookup('existing', set(), self.FEED_KEY, uncached)
+        self.seen.update(seen)
+        unseen = []
+        for item in items:
+            if item['link'] in seen or item['link'] in self.seen:
+                print 'url={0} ALREADY EXISTS '.format(item['link'])
             else:
-                html = urllib2.urlopen(url).read()
-        except urllib2.HTTPError as e:
+                seen.add(item['link'])
+                unseen.append(item)
+        REGISTRY.inc('items_unseen_total', len(unseen))
+        return unseen
+
+    def lookup(self, name, default, *args):
+        """
+            self.pgSQL.<name>(*args). With a spool the database is optional while scraping: a
+            failed lookup counts as a miss (default), deduping against self.seen only, and
+            store_spooled drops the duplicates that get through. A lost connection is dropped
+            and the next lookup reconnects, like the drainer does
+        """
+        if self.spool == None:
+            return getattr(self.pgSQL, name)(*args)
+        try:
+            if self.pgSQL == None:
+                self.pgSQL = self.connect()
+            return getattr(self.pgSQL, name)(*args)
+        except Exception as e:
+            print 'database lookup failed, treated as a miss: {0}'.format(e)
+            REGISTRY.inc('db_lookup_failures_total')
+            if isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError)) and self.db_args != None and self.pgSQL != None:
+                db, self.pgSQL = self.pgSQL, None
+                self.disconnect(db)
+            return default
+
+    def seen_key(self, db_identifier):
+        """
+            self.seen key of a listing's primary key values
+        """
+        return tuple(db_identifier.get(k) for k in sorted(self.primary_key_methods))
+
+    def warm_seen(self):
+        """
+            fills self.seen with the feed links and primary keys of the most recent active listings
+        """
+        pk_fields = sorted(self.primary_key_methods)
+        if len(self.pgSQL.identify_missing(pk_fields + ['archived'])) > 0:
+            return 0
+        fields = pk_fields + [k for k in [self.FEED_KEY] if len(self.pgSQL.identify_missing([k])) == 0]
+        rows = self.pgSQL.get_active_listings(fields, limit=self.seen.capacity / len(fields))
+        for row in reversed(rows):
+            self.seen.add(tuple(row[:len(pk_fields)]))
+            self.seen.update(link for link in row[len(pk_fields):] if link != None)
+        return len(self.seen)
+
+    def extract_items(self, items):
+        """
+            lazily yields (item, extract() of its listing page, or None if the page could not
+            be fetched) for every item, in order. Pages are parsed in the fetch threads, or by
+            the parse pool when parse_processes is set
+        """
+        if self.parse_processes == None:
+            return izip(items, self.fetch_map(self.page_metrics, [item['link'] for item in items]))
+        fetch = lambda item: (self.fetch_page(item['link']), None)
+        return self.pipeline(fetch, extract_metrics, 'ingest').run(items)
+
+    def page_metrics(self, url):
+        soup = self.soup(url)
+        return self.extract(soup) if soup != None else None
+
+    def pipeline(self, fetch, extract, name='pipeline'):
+        """
+            Pipeline of fetch threads feeding extract (a module level worker function below)
+            in the parse pool, started with the first pipeline
+        """
+        if self.parse_pool == None:
+            self.parse_pool = multiprocessing.Pool(self.parse_processes, init_worker, (type(self), self.soup_parser, self.strainer != None))
+        return Pipeline(fetch, extract, self.parse_pool, self.fetch_concurrency(), self.pipeline_depth, name)
+
+    def close(self):
+        """
+            stops the fetch threads and parse processes, after the queued images are downloaded
+            (and the spool is synced). Connections taken from self.pg_pool are handed back
+        """
+        if self.drainer != None:
+            self.drainer.close()
+            self.spool.close()
+            self.drainer = None
+        if self.pg_pool != None:
+            for db in set([self.pgSQL, self.drain_pgSQL]) - set([None]):
+                self.disconnect(db)
+            self.pgSQL = self.drain_pgSQL = None
+        if self.images != None:
+            self.images.close()
+            self.images = None
+        for pool in [self.fetch_pool, self.parse_pool]:
+            if pool != None:
+                pool.terminate()
+                pool.join()
+        self.fetch_pool = None
+        self.parse_pool = None
+
+    def fetch_soups(self, urls):
+        """
+            lazily yields self.soup(url) for every url, in order, while up to fetch_concurrency()
+            requests run in the background
+
+        """
+        return self.fetch_map(self.soup, urls)
+
+    def fetch_map(self, f, urls):
+        """
+            lazily yields f(url) for every url, in order, running up to fetch_concurrency() calls
+            in the background
+        """
+        if self.fetch_pool == None:
+            self.fetch_pool = ThreadPool(self.fetch_concurrency())
+        return self.fetch_pool.imap(f, urls)
+
+    def fetch_concurrency(self):
+        return self.proxy_handler.concurrency()
+
+    def update_feed(self):
+        """
+            re-reads self.feed, which is left as it was if the server answers 304 (not modified).
+            Returns the status
+        """
+        feed = self.read_feed(self.rss_url)
+        if feed.get('status') != 304 or self.feed == None:
+            self.feed = feed
+        return feed.get('status')
+
+    def read_feed(self, rss_url):
+        """
+            parsed RSS feed at rss_url, requested conditionally on the validators of its last
+            handled response (a 304 response has no items)
+        """
+        import feedparser
+        (etag, modified) = self.watermarks.conditional(rss_url)
+        t_start = time.time()
+        feed = feedparser.parse(rss_url, etag=etag, modified=modified)
+        REGISTRY.observe('feed_fetch_seconds', time.time() - t_start, status=feed.get('status', 'error'))
+        REGISTRY.inc('feed_items_total', len(feed.get('items', [])))
+        return feed
+
+    def fetch(self, url):
+        return self.proxy_handler.fetch(url)
+
+    def fetch_page(self, url):
+        """
+            raw html of url (kept in self.html_store, if any), or None on an error status or
+            when it could not be reached
+        """
+        try:
+            html = self.fetch(url)
+        except urllib2.URLError as e:
             return None
-        return BeautifulSoup(html, self.soup_parser)
+        if self.html_store != None:
+            self.html_store.put(url, html)
+        return html
+
+    def soup(self, url):
+        html = self.fetch_page(url)
+        return self.parse(html) if html != None else None
+
+    def replay(self, fields=None, processes=None, batch_size=1000):
+        """
+            re-runs coalesce_metrics over every page in self.html_store, on all cores and without
+            any network traffic, and writes the extracted fields (only `fields`, if given) to the
+            listings the pages were scraped from with pgSQL.update_many, batch_size at a time
+
+            Returns the number of listings updated
+
+        """
+        keep = lambda k: (k in fields) if fields != None else (k not in self.REPLAY_EXCLUDED)
+        pool = multiprocessing.Pool(processes, init_worker, (type(self), self.soup_parser, self.strainer != None))
+        updated = 0
+        batch = []
+        try:
+            for (url, metrics, recorded) in pool.imap_unordered(replay_page, self.html_store.items(), chunksize=32):
+                REGISTRY.merge(recorded)
+                metrics = { k:v for (k, v) in metrics.items() if keep(k) }
+                metrics[self.FEED_KEY] = url
+                batch.append(metrics)
+                if len(batch) >= batch_size:
+                    updated += self.pgSQL.update_many(self.FEED_KEY, batch)
+                    batch = []
+            updated += self.pgSQL.update_many(self.FEED_KEY, batch)
+        finally:
+            pool.close()
+            pool.join()
+        return updated
+
+    def parse(self, html, strainer=None):
+        """
+            BeautifulSoup of html, limited to the elements kept by strainer (self.strainer by default)
+        """
+        with REGISTRY.timed('parse_seconds'):
+            return BeautifulSoup(html, self.soup_parser, parse_only=(strainer or self.strainer))
+
+    def build_strainer(self, methods):
+        """
+            SoupStrainer keeping only the elements declared with @parses by methods, or None
+            (keep everything) if any of them doesn't declare its elements
+        """
+        selectors = {}
+        for method in methods:
+            if not hasattr(method, 'selectors'):
+                return None
+            for (name, attrs) in method.selectors:
+                selectors.setdefault(name, []).append(attrs)
+        keep = lambda name, attrs: any(selector_matches(wanted, attrs) for wanted in selectors.get(name, []))
+        return SoupStrainer(keep)
 
     @metric
+    @parses(('span', {'class':'price'}))
     def get_rent(self, soup):
         rent = soup.find('span', {'class':'price'}).text
-        rent = re.sub('[^0-9]', '', rent)
+        rent = NON_DIGITS.sub('', rent)
         rent = int(rent)
         return {'rent':rent}
 
     @metric
+    @parses(('div', {'id':'map'}))
     def get_geo(self, soup):
         map_div = soup.find('div', {'id':'map'})
         geo_keys = ['data-latitude', 'data-longitude']
-        if map_div == None or any(key not in map_div.attrs for key in geo_keys): return self.pgSQL.no_geo
+        if map_div == None or any(key not in map_div.attrs for key in geo_keys): return dict(pgSQL.no_geo)
         return { k.replace('data-', ''):self.str_to_float(map_div[k]) for k in geo_keys}
 
     @metric
+    @parses(('span', {'class':'housing'}))
     def get_size_metrics(self, soup):
         db_fields = {}
         size_metrics = {'ft2':None, 'br':None}
@@ -115,34 +648,40 @@ class AptFeed(object):
             for metric in size_metrics:
                 if metric in text:
                     text = text.replace(metric, '')
-                    text = re.sub('[^0-9]', '', text)
+                    text = NON_DIGITS.sub('', text)
                     db_fields[metric] = int(text)
         return db_fields
 
     @metric
+    @parses(('link', {}))
     def get_url(self, soup):
         url = soup.link.attrs['href']
         return {'url':url}
 
     @metric
+    @parses(('section', {'id':'postingbody'}))
     def get_text_body(self, soup):
         body = soup.find('section', {'id':'postingbody'}).text
         return {'text_body':body}
 
     @metric
+    @parses(('title', {}))
     def get_title(self, soup):
         title = soup.title.text
         return {'title':title}
 
     @metric
+    @parses()
     def get_archived(self, soup):
         return {'archived':False}
 
     @metric
+    @parses()
     def get_scrape_time(self, soup):
         return {'scrape_time': datetime.now()}
 
     @metric
+    @parses(('div', {'class':'postinginfos'}))
     def get_post_date(self, soup):
         date_str = soup.find('div', {'class':'postinginfos'}).findAll('p', {'class':'postinginfo'})[1].find('time').attrs['datetime']
         dt = dateutil.parser.parse(date_str)
@@ -154,26 +693,35 @@ class AptFeed(object):
             db_fields.update(field)
         return db_fields
 
-    def save_images(self, soup, img_dir):
+    def extract(self, soup):
+        """
+            coalesce_metrics of soup, plus the urls of its images under IMAGES_KEY and its
+            content_hash under CONTENT_KEY
+        """
+        metrics = self.coalesce_metrics(soup)
+        metrics[self.IMAGES_KEY] = self.image_urls(soup)
+        metrics[self.CONTENT_KEY] = self.content_hash(soup)
+        return metrics
+
+    def content_hash(self, soup):
+        """
+            sha1 of the elements the metrics are read from (soup parsed with self.strainer), so
+            an edit of the listing changes it and the rest of the page doesn't
+        """
+        return hashlib.sha1(soup.encode('utf-8')).hexdigest()
+
+    @parses(('div', {'id':'thumbs'}))
+    def image_urls(self, soup):
         thumbs = soup.find('div', {'id':'thumbs'})
-        thumbs = thumbs.findAll('a') if thumbs != None else None
-        if thumbs == None: return False
-
-        img_dir = os.path.join(self.img_base, img_dir)
-        mkdir_p(img_dir)
-
-        count = 0
-        proxy = self.proxy_handler.get_proxy()
-        for i, thumb in enumerate(thumbs):
-            if proxy:
-                img_data = proxy.open(thumb['href'] ).read()       #TODO hide with random list of proxies
-                img_path = urlparse.urlparse(thumb['href']).path
-                img_ext =  os.path.splitext(img_path)[1]
-                path = os.path.join(img_dir, '{0}{1}'.format(i, img_ext))
-                with open(path, 'wb') as f:
-                    f.write(img_data)
-                    count+=1
-        return True
+        return [ thumb['href'] for thumb in thumbs.findAll('a', href=True) ] if thumbs != None else []
+
+    def save_images(self, soup, img_dir):
+        """
+            queues the listing's images for download to <base_dir>/<img_dir> (see ImageDownloader)
+        """
+        if self.images == None:
+            self.images = ImageDownloader(self.proxy_handler, self.img_base)
+        return self.images.save(img_dir, self.image_urls(soup)) > 0
 
     def listing_removed(self, soup):
         try:
@@ -189,26 +737,198 @@ class AptFeed(object):
             return True
         return False
 
+    def check_removed(self, url):
+        """
+            Returns True if the listing at url has been removed, False if it is still live and
+            None if that could not be determined (network errors, blocked proxies...)
+
+            The cheapest check that decides wins: the response status, then the raw page text
+            (removal notice / posting date), and only then a full listing_removed parse
+
+        """
+        t_start = time.time()
+        (html, is_removed) = self.removal_page(url)
+        if html != None:
+            is_removed = self.listing_removed(self.parse(html, self.removal_strainer))
+        REGISTRY.observe('archive_check_seconds', time.time() - t_start, removed=is_removed)
+        return is_removed
+
+    def removal_page(self, url):
+        """
+            (None, check_removed result) when the response status or raw page text decides,
+            otherwise (html, None): the page has to be parsed by listing_removed
+        """
+        (html, is_removed) = self.live_page(url)
+        if html != None and self.POSTING_DATE.search(html):
+            return None, False
+        return html, is_removed
+
+    def live_page(self, url):
+        """
+            (html, None) for the listing at url, or (None, check_removed result) when the
+            response status or the removal notice decides it is gone (or it can't be fetched)
+        """
+        try:
+            html = self.fetch(url)
+        except urllib2.HTTPError as e:
+            return None, (True if e.code in self.REMOVED_STATUS else None)
+        except urllib2.URLError as e:
+            return None, None
+        if self.REMOVED_NOTICE.search(html):
+            return None, True
+        return html, None
+
+    def check_listing(self, listing):
+        """
+            recheck result for a (url, stored content hash) listing, (None, None, None) if it
+            could not be fetched
+        """
+        t_start = time.time()
+        (page, result) = self.recheck_page(listing)
+        if page != None:
+            result = self.recheck(page)
+        REGISTRY.observe('archive_check_seconds', time.time() - t_start, removed=result[0])
+        return result
+
+    def recheck_page(self, listing):
+        """
+            (None, recheck result) when the response status or removal notice decides,
+            otherwise ((html, stored content hash), None): the page has to go through recheck
+        """
+        (url, stored_hash) = listing
+        (html, is_removed) = self.live_page(url)
+        if html == None:
+            return None, (is_removed, None, None)
+        return (html, stored_hash), None
+
+    def recheck(self, page):
+        """
+            (is_removed, content hash, metrics) of a live listing's (html, stored content hash).
+            The page is parsed once (with self.strainer), and metrics are only extracted
+            (None otherwise) when its content hash differs from the stored one
+        """
+        (html, stored_hash) = page
+        soup = self.parse(html)
+        if self.listing_removed(soup):
+            return True, None, None
+        content_hash = self.content_hash(soup)
+        if content_hash == stored_hash:
+            REGISTRY.inc('listings_unchanged_total')
+            return False, content_hash, None
+        return False, content_hash, self.coalesce_metrics(soup)
+
+    def rechecks(self, listings):
+        """
+            lazily yields check_listing(listing) for every (url, stored content hash) listing,
+            in order, parsing the pages in the parse pool when parse_processes is set
+        """
+        if self.parse_processes == None:
+            return self.fetch_map(self.check_listing, listings)
+        results = self.pipeline(self.recheck_page, extract_recheck, 'recheck').run(listings)
+        return (result for (listing, result) in results)
+
+    def listing_checks(self, listings):
+        """
+            lazily yields (is_removed, content hash, metrics) for every (url, stored content hash)
+            listing: rechecks() when self.track_changes is set, otherwise removal_checks() (with
+            no hash or metrics)
+        """
+        if self.track_changes:
+            return self.rechecks(listings)
+        return ((is_removed, None, None) for is_removed in self.removal_checks([url for (url, stored_hash) in listings]))
+
+    def hash_fields(self):
+        """
+            [CONTENT_KEY] if changes are tracked and the column exists, for get_active_listings
+        """
+        if self.track_changes and len(self.pgSQL.identify_missing([self.CONTENT_KEY])) == 0:
+            return [self.CONTENT_KEY]
+        return []
+
+    def record_changes(self, changes):
+        """
+            writes the fields of rechecked listings that differ from the stored ones (and their
+            new content hash) with one update_many, and one pgSQL.insert_history row per changed
+            field
+
+            changes -- list of (listing_number, content hash, metrics)
+
+            Returns the number of fields changed
+        """
+        if len(changes) == 0: return 0
+        fields = set(k for (listing_number, content_hash, metrics) in changes for k in metrics)
+        fields = [ k for k in sorted(fields) if k not in self.CHANGE_EXCLUDED and len(self.pgSQL.identify_missing([k])) == 0 ]
+        rows = self.pgSQL.get_listings(['listing_number'] + fields, [listing_number for (listing_number, content_hash, metrics) in changes])
+        stored = dict( (row[0], dict(izip(fields, row[1:]))) for row in rows )
+
+        updates = []
+        history = []
+        for (listing_number, content_hash, metrics) in changes:
+            old = stored.get(listing_number, {})
+            update = {'listing_number':listing_number, self.CONTENT_KEY:content_hash}
+            for (field, value) in sorted(metrics.items()):
+                if field in self.CHANGE_EXCLUDED or same_value(old.get(field), value):
+                    continue
+                update[field] = value
+                history.append((listing_number, field, old.get(field), value))
+            updates.append(update)
+        self.pgSQL.update_many('listing_number', updates)
+        self.pgSQL.insert_history(history)
+        REGISTRY.inc('listing_fields_changed_total', len(history))
+        return len(history)
+
+    def removal_checks(self, urls):
+        """
+            lazily yields check_removed(url) for every url, in order, parsing the undecided pages
+            in the parse pool when parse_processes is set
+        """
+        if self.parse_processes == None:
+            return self.fetch_map(self.check_removed, urls)
+        results = self.pipeline(self.removal_page, extract_removed, 'archive').run(urls)
+        return (is_removed for (url, is_removed) in results)
+
     def archive(self):
-        column_selection = ['url', 'title']
-        for db_row in self.pgSQL.get_active_listings(column_selection):
-            url = db_row[0] 
-            title = db_row[1]
-            soup = self.soup(url)
-            removed = self.listing_removed(soup)
-            if removed:
-                self.pgSQL.archive_listing({'url':url, 'title':title})
-                print 'archived url={0}'.format(url)
+        """
+            checks every active listing concurrently and archives the removed ones in batches
+            of ARCHIVE_BATCH with archive_listings (recording the changes of the live ones
+            with record_changes, if changes are tracked)
+        """
+        db_rows = self.pgSQL.get_active_listings(['listing_number', 'url'] + self.hash_fields())
+        removed = []
+        changes = []
+        listings = [ (row[1], row[2] if len(row) > 2 else None) for row in db_rows ]
+        for row, (is_removed, content_hash, metrics) in izip(db_rows, self.listing_checks(listings)):
+            if is_removed:
+                removed.append(row[0])
+                print 'archived url={0}'.format(row[1])
+            elif metrics != None:
+                changes.append((row[0], content_hash, metrics))
+            if len(removed) >= self.ARCHIVE_BATCH:
+                self.archive_listings(removed)
+                removed = []
+            if len(changes) >= self.ARCHIVE_BATCH:
+                self.record_changes(changes)
+                changes = []
+        self.archive_listings(removed)
+        self.record_changes(changes)
 
     def str_to_float(self, string):
-        return float(re.sub(r'[^\d.]', '', string))
+        return float(NON_FLOAT.sub('', string))
 
     def catch_all(self, f, soup):
+        """
+            f(soup), or {} if it raises. Every call is timed and every error counted in
+            REGISTRY, labelled with the method's name
+        """
+        t_start = time.time()
         try:
             return f(soup)
         except Exception as e:
             print e
+            REGISTRY.inc('metric_errors_total', metric=f.__name__, error=type(e).__name__)
             return {}
+        finally:
+            REGISTRY.observe('metric_seconds', time.time() - t_start, metric=f.__name__)
         
     def primary_key(self, soup):
         """
@@ -221,3 +941,70 @@ class AptFeed(object):
             primary_keys.update(field)
         return primary_keys
 
+
+# replay() and pipeline() workers live at module level so multiprocessing can pickle them,
+# each worker process extracts with its own AptFeed (no db, no network). What they record in
+# REGISTRY is sent back to the parent with their results (see Registry.drain)
+
+worker_feed = None
+
+def init_worker(feed_class, soup_parser, fast_extract=True):
+    global worker_feed
+    REGISTRY.clear()        # forked with the parent's values, which are not the worker's to send
+    worker_feed = feed_class('', '', soup_parser=soup_parser, fast_extract=fast_extract)
+
+def replay_page(item):
+    (url, path) = item
+    metrics = worker_feed.coalesce_metrics(worker_feed.parse(read_page(path)))
+    return url, metrics, REGISTRY.drain()
+
+def extract_metrics(html):
+    try:
+        return worker_feed.extract(worker_feed.parse(html))
+    except Exception as e:
+        traceback.print_exc()
+        return None
+
+def extract_removed(html):
+    try:
+        return worker_feed.listing_removed(worker_feed.parse(html, worker_feed.removal_strainer))
+    except Exception as e:
+        traceback.print_exc()
+        return None
+
+def extract_recheck(page):
+    try:
+        return worker_feed.recheck(page)
+    except Exception as e:
+        traceback.print_exc()
+        return None, None, None
+
+def same_value(stored, value):
+    """
+        True if a scraped value equals the stored one (text read back as utf-8 bytes, floats
+        read back from float4 columns, the 'nan' of pgSQL.no_geo read back as a NaN float,
+        datetimes read back naive from timestamp columns)
+    """
+    if isinstance(stored, datetime) and isinstance(value, datetime):
+        return as_timestamp(stored) == as_timestamp(value)
+    if type(stored) == str and type(value) == unicode:
+        stored = stored.decode('utf-8', 'replace')
+    if type(stored) == float or type(value) == float:
+        (stored_float, value_float) = (as_number(stored), as_number(value))
+        if stored_float == None or value_float == None:
+            return stored == value
+        if math.isnan(stored_float) or math.isnan(value_float):
+            return math.isnan(stored_float) and math.isnan(value_float)
+        return abs(stored_float - value_float) <= 1e-6 * max(abs(stored_float), abs(value_float), 1.0)
+    return stored == value
+
+def as_number(value):
+    """
+        value as a float (eg: 'nan'), or None if it isn't a number
+    """
+    if value == None or type(value) == bool:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,165 @@
+import time
+import heapq
+import threading
+import traceback
+from itertools import izip
+
+class FeedScheduler(object):
+
+    """
+    Polls many RSS feeds from one AptFeed, each at an interval adapted to how fast it produces
+    new listings, instead of every feed every DELTA_T.
+
+    A feed only shows its newest `capacity` items (25 on craigslist), so it has to be polled
+    before that many new listings have been posted or some are missed. For every feed, the
+    rate of new items (an exponentially weighted moving average, per second) sets
+
+        interval = TARGET_FILL * capacity / rate, clamped to [min_t, max_t]
+
+    so a busy feed is polled when about half its items have turned over, while quiet feeds
+    back off (doubling their interval while they produce nothing). A poll that finds every
+    item new may have missed some, and halves the interval at once. A feed that answers 304
+    (not modified) had no new items.
+
+    Feeds are requested conditionally and only their items past the AptFeed's watermarks
+    reach process_items (see FeedWatermarks).
+
+    Every tick polls all due feeds through the AptFeed's fetch pool and handles their items
+    in one process_items batch, so feeds and listing pages share one fetch budget.
+
+    """
+
+    TARGET_FILL = 0.5
+    ALPHA = 0.3
+
+    def __init__(self, feed, rss_urls, min_t=60, max_t=60*60, tick_t=5):
+        self.feed = feed
+        self.min_t = min_t
+        self.max_t = max_t
+        self.tick_t = tick_t
+        self.feeds = {}         # rss url: {'interval', 'rate', 'capacity', 'polled'}
+        self.queue = []         # heap of (next poll, rss url)
+        self.cycle_end = time.time()
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()    # held by run() while it ticks, so set_feeds waits for the tick
+        now = time.time()
+        for rss_url in rss_urls:
+            self.add(rss_url, now)
+
+    def add(self, rss_url, now):
+        if rss_url in self.feeds:
+            return False
+        self.feeds[rss_url] = {'interval':self.min_t, 'rate':None, 'capacity':0, 'polled':None}
+        heapq.heappush(self.queue, (now, rss_url))
+        return True
+
+    def set_feeds(self, rss_urls, now=None):
+        """
+            polls rss_urls from now on: new feeds are added, and feeds no longer listed are
+            dropped (with their rate). Returns (added, dropped)
+        """
+        with self.lock:
+            now = now if now != None else time.time()
+            added = [rss_url for rss_url in rss_urls if self.add(rss_url, now)]
+            dropped = [rss_url for rss_url in self.feeds if rss_url not in rss_urls]
+            for rss_url in dropped:
+                del self.feeds[rss_url]
+            self.queue = [entry for entry in self.queue if entry[1] in self.feeds]
+            heapq.heapify(self.queue)
+        return added, dropped
+
+    def run(self):
+        """
+            polls until stop() is called
+        """
+        while not self.stopped.is_set():
+            with self.lock:
+                self.tick()
+            if time.time() - self.cycle_end > self.feed.DELTA_T:
+                self.feed.end_cycle()
+                self.cycle_end = time.time()
+            if self.queue:
+                self.stopped.wait(max(min(self.queue[0][0] - time.time(), self.tick_t), 0))
+            else:
+                self.stopped.wait(self.tick_t)
+
+    def stop(self):
+        self.stopped.set()
+
+    def due(self, now):
+        """
+            rss urls of the feeds whose next poll is at or before now, taken off the queue
+        """
+        due = []
+        while self.queue and self.queue[0][0] <= now:
+            due.append(heapq.heappop(self.queue)[1])
+        return due
+
+    def tick(self, now=None):
+        """
+            polls the due feeds and processes their items.
+            Returns {rss url: number of new items} for the feeds polled
+        """
+        now = now if now != None else time.time()
+        due = self.due(now)
+        if len(due) == 0:
+            return {}
+
+        # the due feeds are off the queue until they are pushed back: even if the poll or
+        # process_items raises, so that a failed tick is retried instead of dropping them
+        try:
+            parsed = list(self.feed.fetch_map(self.poll, due))
+            items = []
+            source = {}
+            for (rss_url, result) in izip(due, parsed):
+                if result != None and result.get('status') != 304:
+                    self.feeds[rss_url]['capacity'] = len(result.get('items', []))
+                    for item in self.feed.watermarks.new_items(rss_url, result):
+                        source.setdefault(item['link'], rss_url)
+                        items.append(item)
+
+            new = {}
+            for item in self.feed.process_items(items):
+                rss_url = source[item['link']]
+                new[rss_url] = new.get(rss_url, 0) + 1
+
+            observed = {}
+            for (rss_url, result) in izip(due, parsed):
+                if result != None:
+                    self.feed.watermarks.advance(rss_url, result)
+                    observed[rss_url] = new.get(rss_url, 0)
+                    self.observe(rss_url, observed[rss_url], now)
+        finally:
+            for rss_url in due:
+                if rss_url in self.feeds:
+                    heapq.heappush(self.queue, (now + self.feeds[rss_url]['interval'], rss_url))
+        return observed
+
+    def poll(self, rss_url):
+        try:
+            return self.feed.read_feed(rss_url)
+        except Exception as e:
+            traceback.print_exc()
+            return None
+
+    def observe(self, rss_url, new, now):
+        """
+            updates a feed's rate of new items and its interval after a poll found `new` of
+            its items new
+        """
+        state = self.feeds[rss_url]
+        capacity = state['capacity']
+        polled, state['polled'] = state['polled'], now
+        if polled == None or capacity == 0:
+            return state['interval']       # the first poll sees a backlog, not a rate
+
+        rate = float(new) / max(now - polled, 1.0)
+        state['rate'] = rate if state['rate'] == None else self.ALPHA * rate + (1 - self.ALPHA) * state['rate']
+        if new >= capacity:
+            interval = state['interval'] / 2.0
+        elif state['rate'] <= 0:
+            interval = state['interval'] * 2.0
+        else:
+            interval = self.TARGET_FILL * capacity / state['rate']
+        state['interval'] = min(max(interval, self.min_t), self.max_t)
+        return state['interval']
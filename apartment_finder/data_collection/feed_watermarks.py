@@ -0,0 +1,92 @@
+import os
+import json
+import calendar
+import threading
+
+class FeedWatermarks(object):
+
+    """
+    Per-feed state for incremental polling, persisted as JSON across restarts
+
+        etag, modified  -- validators of the last response, sent back as If-None-Match /
+                           If-Modified-Since so an unchanged feed costs a 304 and no parsing
+        published       -- high-water mark: publish time (epoch seconds) of the newest item seen
+        guids           -- ids of the most recent items seen (at most MAX_GUIDS per feed)
+
+    new_items() keeps only the items a feed hasn't shown before: an item is old if its id was
+    seen, or if it was published before the high-water mark (it has rolled down the feed
+    after an earlier poll). advance() moves the marks once the items have been handled, so a
+    crash in between only means handling them again.
+
+    """
+
+    MAX_GUIDS = 500
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.feeds = {}         # rss url: {'etag', 'modified', 'published', 'guids'}
+        if path != None and os.path.exists(path):
+            with open(path) as f:
+                self.feeds = json.load(f)
+
+    def conditional(self, rss_url):
+        """
+            (etag, modified) to make the next request for rss_url conditional on
+        """
+        state = self.feeds.get(rss_url, {})
+        return state.get('etag'), state.get('modified')
+
+    def guid(self, item):
+        return item.get('id') or item.get('link')
+
+    def published(self, item):
+        parsed = item.get('published_parsed') or item.get('updated_parsed')
+        return calendar.timegm(parsed) if parsed != None else None
+
+    def new_items(self, rss_url, parsed):
+        """
+            items of the parsed feed that are newer than its watermarks
+        """
+        state = self.feeds.get(rss_url)
+        if state == None:
+            return list(parsed.get('items', []))
+        guids = set(state['guids'])
+        mark = state['published']
+        new = []
+        for item in parsed.get('items', []):
+            published = self.published(item)
+            if self.guid(item) in guids or (mark != None and published != None and published < mark):
+                continue
+            new.append(item)
+        return new
+
+    def advance(self, rss_url, parsed):
+        """
+            records the validators and items of a parsed feed (a 304 changes nothing) and
+            saves the watermarks
+        """
+        if parsed.get('status') == 304:
+            return False
+        with self.lock:
+            state = self.feeds.setdefault(rss_url, {'etag':None, 'modified':None, 'published':None, 'guids':[]})
+            state['etag'] = parsed.get('etag')
+            state['modified'] = parsed.get('modified')
+            items = parsed.get('items', [])
+            dates = [ p for p in (self.published(item) for item in items) if p != None ]
+            if len(dates) > 0:
+                state['published'] = max(dates + [state['published'] or 0])
+            fresh = [ self.guid(item) for item in items if self.guid(item) not in state['guids'] ]
+            state['guids'] = (state['guids'] + fresh)[-self.MAX_GUIDS:]
+        self.save()
+        return True
+
+    def save(self):
+        if self.path == None: return False
+        with self.lock:
+            data = json.dumps(self.feeds)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        os.rename(tmp_path, self.path)
+        return True
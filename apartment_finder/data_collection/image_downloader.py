@@ -0,0 +1,198 @@
+import os
+import json
+import Queue
+import urllib2
+import hashlib
+import urlparse
+import threading
+import traceback
+
+from ..utilities.general_utils import mkdir_p
+
+class ImageDownloader(object):
+
+    """
+    Background, deduplicated and resumable download of listing images
+
+        <base_dir>/blobs/<2 hex>/<sha1><ext>   every image, stored once, named by its content
+        <base_dir>/<listing_id>/manifest.json  the listing's images, in order, as
+                                               [{"url": ..., "blob": path relative to base_dir}]
+        <base_dir>/index                       append-only "<blob> <url>" lines
+
+    `workers` threads stream images to disk in chunks (hashing them on the way) through the
+    proxy handler. An image url found in the index is never fetched again, so reposted
+    listings reuse the photos already on disk, and the same photo under a new url is still
+    stored once.
+
+    A manifest is written with "blob": null entries as soon as a listing is queued and filled
+    in when all of its images are done. After an interruption resume() queues the listings
+    whose manifest is incomplete again, and only their missing images are fetched.
+
+    """
+
+    def __init__(self, proxy_handler, base_dir, workers=8, queue_size=256):
+        self.proxy_handler = proxy_handler
+        self.base_dir = os.path.expanduser(base_dir)
+        self.lock = threading.Lock()
+        self.index = {}             # url: blob
+        self.in_flight = {}         # url: Event set when its download ends
+        self.listings = {}          # listing_id: [blobs (None until downloaded), images left]
+        self.queue = Queue.Queue(queue_size)
+        mkdir_p(os.path.join(self.base_dir, 'blobs'))
+
+        index_path = os.path.join(self.base_dir, 'index')
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                for line in f:
+                    parts = line.rstrip('\n').split(' ', 1)
+                    if len(parts) == 2:
+                        self.index[parts[1]] = parts[0]
+        self.index_file = open(index_path, 'a')
+
+        self.workers = [ threading.Thread(target=self.work) for i in range(workers) ]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def save(self, listing_id, urls):
+        """
+            queues the images at urls for listing_id, blocking while the queue is full.
+            Returns the number of images queued
+        """
+        listing_id = str(listing_id)
+        urls = [ url.encode('utf-8') if type(url) == unicode else url for url in urls ]
+        if len(urls) == 0:
+            return 0
+        blobs = [ self.index.get(url) for url in urls ]
+        self.write_manifest(listing_id, urls, blobs)
+        with self.lock:
+            self.listings[listing_id] = [blobs, len(urls)]
+        for (i, url) in enumerate(urls):
+            self.queue.put((listing_id, urls, i))
+        return len(urls)
+
+    def resume(self):
+        """
+            queues the listings whose manifest still has images missing.
+            Returns the number of listings queued
+        """
+        queued = 0
+        for listing_id in os.listdir(self.base_dir):
+            manifest = self.read_manifest(listing_id)
+            if manifest != None and any(image['blob'] == None for image in manifest):
+                self.save(listing_id, [image['url'] for image in manifest])
+                queued += 1
+        return queued
+
+    def join(self):
+        """
+            blocks until every queued image is done
+        """
+        self.queue.join()
+
+    def close(self):
+        self.join()
+        for worker in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.index_file.close()
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job == None:
+                    return
+                (listing_id, urls, i) = job
+                try:
+                    blob = self.download(urls[i])
+                except (urllib2.URLError, IOError, OSError) as e:
+                    print 'image url={0} COULD NOT BE FETCHED ({1})'.format(urls[i], e)
+                    blob = None
+                except Exception as e:
+                    traceback.print_exc()
+                    blob = None
+                self.done(listing_id, urls, i, blob)
+            finally:
+                self.queue.task_done()
+
+    def download(self, url):
+        """
+            blob holding the image at url, fetched only if the url isn't in the index yet (or
+            waiting for the worker already fetching it)
+        """
+        with self.lock:
+            blob = self.index.get(url)
+            in_flight = self.in_flight.get(url)
+            if in_flight == None and blob == None:
+                self.in_flight[url] = threading.Event()
+        if in_flight != None:
+            in_flight.wait()
+            return self.index.get(url)
+        if blob != None:
+            return blob
+        try:
+            return self.fetch(url)
+        finally:
+            with self.lock:
+                self.in_flight.pop(url).set()
+
+    def fetch(self, url):
+        ext = os.path.splitext(urlparse.urlparse(url).path)[1]
+        tmp_path = os.path.join(self.base_dir, 'blobs', '{0}.{1}.part'.format(os.getpid(), threading.current_thread().ident))
+        sha1 = hashlib.sha1()
+        try:
+            with open(tmp_path, 'wb') as f:
+                def write(chunk):
+                    sha1.update(chunk)
+                    f.write(chunk)
+                self.proxy_handler.fetch(url, write)
+            digest = sha1.hexdigest()
+            blob = os.path.join('blobs', digest[:2], digest + ext)
+            path = os.path.join(self.base_dir, blob)
+            if os.path.exists(path):
+                os.remove(tmp_path)
+            else:
+                mkdir_p(os.path.dirname(path))
+                os.rename(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        with self.lock:
+            if self.index.get(url) != blob:
+                self.index_file.write('{0} {1}\n'.format(blob, url))
+                self.index_file.flush()
+                self.index[url] = blob
+        return blob
+
+    def done(self, listing_id, urls, i, blob):
+        with self.lock:
+            state = self.listings.get(listing_id)
+            if state == None:
+                return
+            state[0][i] = blob
+            state[1] -= 1
+            if state[1] > 0:
+                return
+            del self.listings[listing_id]
+        self.write_manifest(listing_id, urls, state[0])
+
+    def manifest_path(self, listing_id):
+        return os.path.join(self.base_dir, listing_id, 'manifest.json')
+
+    def read_manifest(self, listing_id):
+        path = self.manifest_path(listing_id)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def write_manifest(self, listing_id, urls, blobs):
+        path = self.manifest_path(listing_id)
+        mkdir_p(os.path.dirname(path))
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump([ {'url':url, 'blob':blob} for (url, blob) in zip(urls, blobs) ], f)
+        os.rename(tmp_path, path)
@@ -0,0 +1,135 @@
+import time
+import Queue
+import threading
+import traceback
+import multiprocessing
+from ..utilities.instrumentation import REGISTRY
+
+class Pipeline(object):
+
+    """
+    Staged fetch -> parse -> write pipeline, each stage sized independently and connected by
+    bounded queues, so parsing (CPU bound) no longer shares one core with fetching (I/O bound)
+
+        fetch -- `fetchers` threads call fetch(task), which returns (html, result). When html is
+                 None, result is final and the page skips the parse stage
+        parse -- a multiprocessing pool (shared, see AptFeed.parse_pool) runs extract(html) on
+                 the raw html and sends back a plain (picklable) result, along with what it
+                 recorded in the worker's REGISTRY (merged into this process's). extract must
+                 be a module level function and must not raise
+        write -- the caller, iterating over run(tasks), which yields (task, result) in the
+                 order of tasks
+
+    At most `depth` tasks are between the fetch and write stages at any time, which bounds
+    every queue (and the memory held by pages waiting to be parsed). When the caller stops
+    iterating (eg: it raised), the fetch threads skip the remaining tasks and exit. A parse
+    task that fails (eg: its result can't be pickled) re-raises its error in run(), and one
+    without a result after parse_timeout seconds (its worker died) raises
+    multiprocessing.TimeoutError, instead of waiting forever.
+
+    The time each task spends in the fetch and parse stages is recorded in REGISTRY as
+    pipeline_stage_seconds{pipeline=name, stage=...}, the parse stage including the wait for
+    a free parse process.
+
+    """
+
+    POLL_T = 1.0        # how often the write stage checks on the parse tasks while it waits
+
+    def __init__(self, fetch, extract, parse_pool, fetchers=4, depth=32, name='pipeline', parse_timeout=5*60):
+        self.name = name
+        self.fetch = fetch
+        self.extract = extract
+        self.parse_pool = parse_pool
+        self.fetchers = fetchers
+        self.depth = depth
+        self.parse_timeout = parse_timeout
+
+    def run(self, tasks):
+        tasks = list(tasks)
+        slots = threading.Semaphore(self.depth)
+        to_fetch = Queue.Queue(self.depth)
+        done = Queue.Queue()
+        parsing = {}                # index: (AsyncResult, time sent) of the tasks in the parse stage
+        stopped = threading.Event()
+
+        def feed():
+            for (index, task) in enumerate(tasks):
+                slots.acquire()
+                if stopped.is_set():
+                    break
+                to_fetch.put((index, task))
+            for i in range(self.fetchers):
+                to_fetch.put(None)
+
+        def fetch():
+            while True:
+                job = to_fetch.get()
+                if job == None:
+                    return
+                if stopped.is_set():
+                    continue
+                (index, task) = job
+                t_start = time.time()
+                try:
+                    (html, result) = self.fetch(task)
+                except Exception as e:
+                    traceback.print_exc()
+                    (html, result) = (None, None)
+                t_fetched = time.time()
+                REGISTRY.observe('pipeline_stage_seconds', t_fetched - t_start, pipeline=self.name, stage='fetch')
+                if html == None:
+                    done.put((index, result))
+                else:
+                    result = self.parse_pool.apply_async(run_extract, (self.extract, html), callback=self.parsed(done, index, t_fetched))
+                    parsing[index] = (result, time.time())
+
+        threads = [threading.Thread(target=feed, name=self.name + '-feed')]
+        threads += [threading.Thread(target=fetch, name=self.name + '-fetch') for i in range(self.fetchers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        finished = {}
+        try:
+            for index in range(len(tasks)):
+                while index not in finished:
+                    try:
+                        (i, result) = done.get(True, self.POLL_T)
+                    except Queue.Empty:
+                        self.check(parsing, index)
+                        continue
+                    finished[i] = result
+                parsing.pop(index, None)
+                slots.release()
+                yield tasks[index], finished.pop(index)
+        finally:
+            # wakes the feed thread if it waits for a slot, the fetch threads then drain the queue
+            stopped.set()
+            for i in range(self.depth):
+                slots.release()
+
+    def check(self, parsing, index):
+        """
+            raises the error of any parse task that failed, or multiprocessing.TimeoutError if
+            task index has been waiting for its parse result for more than parse_timeout
+        """
+        for (result, t_sent) in parsing.values():
+            if result.ready() and not result.successful():
+                result.get()
+        if index in parsing and time.time() - parsing[index][1] > self.parse_timeout:
+            raise multiprocessing.TimeoutError('{0}: no parse result for task {1} after {2}s'.format(self.name, index, self.parse_timeout))
+
+    def parsed(self, done, index, t_fetched):
+        def callback(parsed):
+            (result, recorded) = parsed
+            REGISTRY.merge(recorded)
+            REGISTRY.observe('pipeline_stage_seconds', time.time() - t_fetched, pipeline=self.name, stage='parse')
+            done.put((index, result))
+        return callback
+
+def run_extract(extract, html):
+    """
+        (extract(html), what it recorded in REGISTRY), in a parse process
+    """
+    result = extract(html)
+    return result, REGISTRY.drain()
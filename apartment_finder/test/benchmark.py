@@ -0,0 +1,91 @@
+import time
+from ..data_collection.craigslist_rss import AptFeed
+from ..utilities.pgSQL_handler import pgSQL
+from .fake_pgSQL import FakePgSQL
+
+def percentile(samples, p):
+    if len(samples) == 0:
+        return float('nan')     # eg: every page of a stage failed with the stand-in's error_rate
+    ordered = sorted(samples)
+    index = int(round((p / 100.0) * (len(ordered) - 1)))
+    return ordered[index]
+
+class Benchmark(object):
+
+    """
+    Throughput and latency percentiles of the scraping pipeline, run offline against the
+    StandIn server (recorded craigslist corpus) and either FakePgSQL or a real PostgreSQL
+    table (dropped and recreated on every cycle).
+
+        stand_in  -- a started StandIn
+        items     -- listings per feed
+        db        -- (db_name, db_user) to benchmark against PostgreSQL, None for FakePgSQL
+        db_latency -- simulated round trip of FakePgSQL, in seconds
+        parse_processes -- run process_items as a staged pipeline with this many parse processes
+
+    """
+
+    STAGES = ['soup', 'coalesce_metrics', 'primary_key', 'insert', 'process_feed cycle']
+
+    def __init__(self, stand_in, items=100, db=None, db_latency=0.0, max_per_proxy=4, parse_processes=None):
+        self.stand_in = stand_in
+        self.items = items
+        self.db = db
+        self.db_latency = db_latency
+        self.max_per_proxy = max_per_proxy
+        self.parse_processes = parse_processes
+        self.results = []
+
+    def new_parser(self):
+        parser = AptFeed(self.stand_in.feed_url(self.items), '', max_per_proxy=self.max_per_proxy, parse_processes=self.parse_processes)
+        if self.db != None:
+            parser.pgSQL = pgSQL(self.db[0], self.db[1], default_table='benchmark')
+            parser.pgSQL.pg_conn.cursor().execute('drop table if exists benchmark')
+            parser.pgSQL.init_db()
+        else:
+            parser.pgSQL = FakePgSQL(latency=self.db_latency)
+        return parser
+
+    def timed(self, name, f, args, units=1):
+        """
+            calls f(arg) for every arg, recording each call's latency
+
+            Returns the results of the calls
+        """
+        latencies = []
+        results = []
+        t_start = time.time()
+        for arg in args:
+            t = time.time()
+            results.append(f(arg))
+            latencies.append(time.time() - t)
+        self.results.append((name, len(latencies) * units, time.time() - t_start, latencies))
+        return results
+
+    def run(self, cycles=3):
+        parser = self.new_parser()
+        parser.update_feed()
+        urls = [item['link'] for item in parser.feed['items']]
+
+        soups = self.timed('soup', parser.soup, urls)
+        metrics = self.timed('coalesce_metrics', parser.coalesce_metrics, soups)
+        self.timed('primary_key', parser.primary_key, soups)
+        self.timed('insert', parser.pgSQL.insert, metrics)
+        parser.close()
+
+        def cycle(i):
+            cycle_parser = self.new_parser()
+            cycle_parser.update_feed()
+            cycle_parser.process_items(cycle_parser.feed['items'])
+            cycle_parser.close()
+        self.timed('process_feed cycle', cycle, range(cycles), units=self.items)
+        return self.results
+
+    def report(self):
+        header = '{0:<20} {1:>8} {2:>12} {3:>10} {4:>10} {5:>10}'
+        row = '{0:<20} {1:>8} {2:>12.1f} {3:>10.2f} {4:>10.2f} {5:>10.2f}'
+        lines = [header.format('stage', 'n', 'items/s', 'p50 ms', 'p90 ms', 'p99 ms')]
+        for (name, n, elapsed, latencies) in self.results:
+            ms = [1000 * percentile(latencies, p) for p in (50, 90, 99)]
+            lines.append(row.format(name, n, n / elapsed if n > 0 else 0.0, *ms))
+        return '\n'.join(lines)
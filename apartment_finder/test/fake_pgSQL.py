@@ -0,0 +1,154 @@
+import time
+from datetime import datetime
+from ..utilities.pgSQL_handler import pgSQL, as_timestamp
+
+class FakePgSQL(object):
+
+    """
+    In-memory stand-in for utilities.pgSQL_handler.pgSQL, with the interface AptFeed and the
+    schedulers use, for tests and benchmarks that run without a PostgreSQL server.
+
+    Every method that would talk to the server sleeps for latency seconds (one round trip),
+    so batching behaves as it would against a remote database.
+
+    """
+
+    no_geo = pgSQL.no_geo
+    POSTGRESQL_TYPES = pgSQL.POSTGRESQL_TYPES
+
+    def __init__(self, default_table='apartment_listings', latency=0.0):
+        self.default_table = default_table
+        self.latency = latency
+        self.round_trips = 0
+        self.init_db()
+
+    def round_trip(self):
+        self.round_trips += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def init_db(self):
+        self.rows = []
+        self.history = []
+        self.columns = {'cl_id':'int8', 'listing_number':'int8', 'url':'text', 'title':'text',
+                        'rss_link':'text', 'archived':'bool', 'archived_at':'timestamp'}
+
+    def load_columns(self):
+        self.round_trip()
+        return self.columns
+
+    def identify_missing(self, fields):
+        return [field for field in fields if field.lower() not in self.columns]
+
+    def add_columns(self, fields):
+        for (name, field_type) in fields.items():
+            self.round_trip()
+            self.columns[name.lower()] = self.POSTGRESQL_TYPES[field_type]
+        return True
+
+    def insert(self, metrics):
+        self.insert_many([metrics])
+        return True
+
+    def insert_many(self, metrics_list):
+        if len(metrics_list) == 0: return []
+        missing = self.identify_missing(set(k for metrics in metrics_list for k in metrics))
+        self.add_columns({ k:type(m[k]) for m in metrics_list for k in missing if m.get(k) != None })
+        self.round_trip()
+        listing_numbers = []
+        for metrics in metrics_list:
+            row = {'archived':False}
+            row.update(self.stored(metrics))
+            row['listing_number'] = len(self.rows) + 1
+            self.rows.append(row)
+            listing_numbers.append(row['listing_number'])
+        return listing_numbers
+
+    NUMERIC_TYPES = {'int4':int, 'int8':int, 'float4':float, 'float8':float}
+
+    def stored(self, metrics):
+        """
+            metrics as PostgreSQL would read them back: coerced to the type of their column (eg:
+            the 'nan' of no_geo is a NaN float in a float4 column), datetimes naive (see
+            as_timestamp)
+        """
+        stored = {}
+        for (k, v) in metrics.items():
+            numeric = self.NUMERIC_TYPES.get(self.columns.get(k.lower()))
+            if isinstance(v, datetime):
+                v = as_timestamp(v)
+            elif numeric != None and v != None and type(v) != bool:
+                v = numeric(v)
+            stored[k] = v
+        return stored
+
+    def matches(self, row, identifier):
+        return all(row.get(k) == v for (k, v) in identifier.items())
+
+    def existing(self, field, values):
+        if len(values) == 0: return set()
+        self.round_trip()
+        values = set(values)
+        return set(row.get(field) for row in self.rows if row.get(field) in values)
+
+    def apt_exists(self, identifier):
+        self.round_trip()
+        return any(self.matches(row, identifier) for row in self.rows)
+
+    def get_uid(self, identifier):
+        self.round_trip()
+        return [row['listing_number'] for row in self.rows if self.matches(row, identifier)][0]
+
+    def get_active_listings(self, column_selection, limit=None):
+        self.round_trip()
+        rows = [row for row in self.rows if not row['archived']]
+        if limit != None:
+            rows = rows[::-1][:limit]
+        return [ tuple(row.get(c) for c in column_selection) for row in rows ]
+
+    def get_listings(self, column_selection, listing_numbers):
+        self.round_trip()
+        listing_numbers = set(listing_numbers)
+        return [ tuple(row.get(c) for c in column_selection) for row in self.rows
+                 if row['listing_number'] in listing_numbers and not row['archived'] ]
+
+    def insert_history(self, changes):
+        if len(changes) == 0: return 0
+        self.round_trip()
+        now = datetime.now()
+        self.history.extend((listing_number, now, field, old, new) for (listing_number, field, old, new) in changes)
+        return len(changes)
+
+    def archive_listing(self, identifier):
+        self.round_trip()
+        for row in self.rows:
+            if self.matches(row, identifier):
+                row['archived'] = True
+                row['archived_at'] = datetime.now()
+        return True
+
+    def archive_listings(self, listing_numbers):
+        return self.update_listings(listing_numbers, {'archived':True, 'archived_at':datetime.now()})
+
+    def mark_checked(self, listing_numbers):
+        return self.update_listings(listing_numbers, {'last_checked':datetime.now()})
+
+    def update_many(self, key, metrics_list):
+        if len(metrics_list) == 0: return 0
+        missing = self.identify_missing(set(k for metrics in metrics_list for k in metrics))
+        self.add_columns({ k:type(m[k]) for m in metrics_list for k in missing if m.get(k) != None })
+        self.round_trip()
+        by_key = { metrics[key]:metrics for metrics in metrics_list }
+        updated = [row for row in self.rows if row.get(key) in by_key]
+        for row in updated:
+            row.update(self.stored(by_key[row[key]]))
+        return len(updated)
+
+    def update_listings(self, listing_numbers, values):
+        if len(listing_numbers) == 0: return 0
+        self.round_trip()
+        listing_numbers = set(listing_numbers)
+        updated = [row for row in self.rows if row['listing_number'] in listing_numbers]
+        for row in updated:
+            row.update(values)
+        return len(updated)
@@ -0,0 +1,156 @@
+import os
+import time
+import hashlib
+import random
+import socket
+import urlparse
+import threading
+import BaseHTTPServer
+from SocketServer import ThreadingMixIn
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+
+class ThreadingHTTPServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.stand_in.connections.add(self.connection)
+        self.server.stand_in.threads.add(threading.current_thread())
+
+    def finish(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+        self.server.stand_in.connections.discard(self.connection)
+
+    def do_GET(self):
+        self.server.stand_in.handle(self)
+
+    def log_message(self, format, *args):
+        pass
+
+class StandIn(object):
+
+    """
+    Local HTTP stand-in for craigslist.org that serves the recorded corpus in ./corpus
+
+        /feed.rss?n=<items>&start=<i>
+                                RSS feed of n listings from listing i (default: one per recorded
+                                listing page, from 0), listing i posted i minutes after the first
+        /listings/<i>.html      listing i (recorded page i % number of recorded pages)
+        /removed/<i>.html       listing i after it was deleted by its author (404)
+        /images/<name>          a small image, the same bytes for the same name
+
+    Every response is delayed by latency (+/- jitter) seconds, and fails with a 503 with
+    probability error_rate. requests counts the requests served per path. Successful responses
+    carry an ETag, and a request whose If-None-Match matches it gets a 304.
+
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, corpus_dir=CORPUS_DIR, port=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = {}
+        self.connections = set()        # open keep-alive connections, closed by stop()
+        self.threads = set()            # request threads, joined by stop()
+        self.lock = threading.Lock()
+
+        listing_dir = os.path.join(corpus_dir, 'listings')
+        self.pages = [ self.read(os.path.join(listing_dir, name)) for name in sorted(os.listdir(listing_dir)) ]
+        self.removed_page = self.read(os.path.join(corpus_dir, 'removed.html'))
+        self.feed_template = self.read(os.path.join(corpus_dir, 'feed.rss'))
+        self.item_template = self.read(os.path.join(corpus_dir, 'item.rss'))
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), StandInHandler)
+        self.server.stand_in = self
+        self.base = 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+        self.thread = None
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self, timeout=5.0):
+        """
+            stops serving, closes the open connections and waits (up to timeout seconds) for
+            the server and request threads to end, so none is left running at exit
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        for connection in list(self.connections):
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        t_end = time.time() + timeout
+        for thread in [self.thread] + list(self.threads):
+            thread.join(max(t_end - time.time(), 0))
+
+    def feed_url(self, n=None, start=None):
+        query = [ '{0}={1}'.format(k, v) for (k, v) in [('n', n), ('start', start)] if v != None ]
+        return '{0}/feed.rss'.format(self.base) + ('?' + '&'.join(query) if query else '')
+
+    def listing_url(self, i):
+        return '{0}/listings/{1}.html'.format(self.base, i)
+
+    def feed(self, n, start=0):
+        listings = range(start, start + n)
+        links = [ self.listing_url(i) for i in listings ]
+        seq = '\n'.join('<rdf:li rdf:resource="{0}"/>'.format(link) for link in links)
+        date = lambda i: '2016-03-01T{0:02d}:{1:02d}:00-05:00'.format(10 + i / 60, i % 60)
+        items = '\n'.join(self.item_template.replace('{link}', link).replace('{n}', str(i)).replace('{date}', date(i)) for (i, link) in zip(listings, links))
+        return self.feed_template.replace('{base}', self.base).replace('{seq}', seq).replace('{items}', items)
+
+    def route(self, path, query):
+        """
+            returns (status, content type, body) for a request path
+        """
+        name = os.path.splitext(os.path.basename(path))[0]
+        if path == '/feed.rss':
+            n = int(query.get('n', [len(self.pages)])[0])
+            return 200, 'application/rss+xml', self.feed(n, int(query.get('start', [0])[0]))
+        if path.startswith('/listings/') and name.isdigit():
+            page = self.pages[int(name) % len(self.pages)]
+            return 200, 'text/html', page.replace('{link}', self.base + path)
+        if path.startswith('/removed/'):
+            return 404, 'text/html', self.removed_page
+        if path.startswith('/images/'):
+            return 200, 'image/jpeg', (name * 512)[:64*1024]
+        return 404, 'text/html', ''
+
+    def handle(self, request):
+        parsed = urlparse.urlparse(request.path)
+        with self.lock:
+            self.requests[parsed.path] = self.requests.get(parsed.path, 0) + 1
+
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if random.random() < self.error_rate:
+            status, content_type, body = 503, 'text/html', ''
+        else:
+            status, content_type, body = self.route(parsed.path, urlparse.parse_qs(parsed.query))
+
+        etag = '"{0}"'.format(hashlib.md5(body).hexdigest())
+        if status == 200 and request.headers.get('If-None-Match') == etag:
+            status, body = 304, ''
+        request.send_response(status)
+        if status in (200, 304):
+            request.send_header('ETag', etag)
+        request.send_header('Content-Type', content_type)
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+        request.wfile.flush()
@@ -1,5 +1,43 @@
+import os
+import sys
+import math
+import json
+import time
+import shutil
+import tempfile
+import threading
 import unittest
+import psycopg2
+import multiprocessing
+from multiprocessing.pool import MaybeEncodingError
+import feedparser
+from bs4 import SoupStrainer
 from ..data_collection.craigslist_rss import AptFeed
+from ..data_collection.archive_scheduler import ArchiveScheduler
+from ..data_collection.image_downloader import ImageDownloader
+from ..data_collection.feed_scheduler import FeedScheduler
+from ..data_collection.feed_watermarks import FeedWatermarks
+from ..data_collection.pipeline import Pipeline
+from ..utilities.general_utils import ProxyHandler
+from .stand_in import StandIn, CORPUS_DIR
+from .fake_pgSQL import FakePgSQL
+from ..utilities.html_store import HtmlStore
+from ..utilities.instrumentation import REGISTRY
+from ..utilities.spatial_index import SpatialIndex
+from ..utilities.valuation import RentModel
+from ..utilities.near_duplicates import NearDuplicates
+from ..utilities.spool import Spool, SpoolDrainer
+
+with open(os.path.join(CORPUS_DIR, 'listings', '0.html')) as f:
+    LISTING_HTML = f.read()
+
+# parse stage extract functions for TestPipeline (module level, so they can be pickled)
+
+def unpicklable_result(html):
+    return lambda: html
+
+def exit_worker(html):
+    os._exit(1)
 
 class TestRSS(unittest.TestCase):
 
@@ -13,6 +51,7 @@ class TestRSS(unittest.TestCase):
         except:
             self.parser.pgSQL.pg_conn.rollback()
         self.parser.pgSQL.init_db()
+        self.parser.seen.clear()
 
     def tearDown(self):
         self.parser.pgSQL.pg_conn.commit()
@@ -33,16 +72,44 @@ class TestRSS(unittest.TestCase):
         
     def test_insert_real_data(self):
         identifiers = [] 
+        batch = []
         for item in self.parser.feed['items']:
             soup = self.parser.soup(item['link'])
             metrics = self.parser.coalesce_metrics(soup)
-            self.parser.pgSQL.insert(metrics)
+            batch.append(metrics)
             identifiers.append( {'url':metrics['url'], 'title':metrics['title'] })
+        self.parser.pgSQL.insert_many(batch)
 
         for db_identifier in identifiers:
             apt_exists = self.parser.pgSQL.apt_exists(db_identifier)
             self.assertTrue(apt_exists)
 
+    def test_unseen_items(self):
+        items = self.parser.feed['items']
+        self.assertEqual(len(self.parser.unseen_items(items)), len(set(item['link'] for item in items)))
+        self.parser.pgSQL.insert_many([ {self.parser.FEED_KEY:item['link']} for item in items ])
+        self.assertEqual(self.parser.unseen_items(items), [])
+
+    def test_spool_second_connection(self):
+        # the drainer stores (adding the listing columns) on a connection of its own, after
+        # the feed's connection has warmed its seen cache and looked the feed items up
+        directory = tempfile.mkdtemp()
+        stand_in = StandIn().start()
+        os.environ['PGOPTIONS'] = '-c lock_timeout=5s'      # a blocked alter table fails instead of waiting
+        try:
+            feed = AptFeed(stand_in.feed_url(12), '', db_name='apartment_listings', db_user='an0nym1ty',
+                           default_table='test', spool_path=os.path.join(directory, 'spool'))
+            feed.update_feed()
+            links = [item['link'] for item in feed.process_items(feed.feed['items'])]
+            self.assertEqual(len(links), 12)
+            self.assertTrue(feed.drainer.drain())
+            self.assertEqual(feed.pgSQL.existing(feed.FEED_KEY, links), set(links))
+            feed.close()
+        finally:
+            del os.environ['PGOPTIONS']
+            stand_in.stop()
+            shutil.rmtree(directory)
+
     def test_archive_real_data(self):
         identifiers = [] 
         for item in self.parser.feed['items']:
@@ -71,5 +138,433 @@ class TestRSS(unittest.TestCase):
             self.assertTrue(new_archived)
 
 
+class TestOfflineFeed(unittest.TestCase):
+
+    def setUp(self):
+        self.stand_in = StandIn().start()
+        self.parser = AptFeed(self.stand_in.feed_url(12), '')
+        self.parser.pgSQL = FakePgSQL()
+        self.parser.update_feed()
+
+    def tearDown(self):
+        self.parser.close()
+        self.stand_in.stop()
+
+    def listing_requests(self):
+        return sum(n for (path, n) in self.stand_in.requests.items() if path.startswith('/listings/'))
+
+    def test_process_items(self):
+        REGISTRY.clear()
+        self.parser.process_items(self.parser.feed['items'])
+        self.assertEqual(len(self.parser.pgSQL.rows), 12)
+        self.assertEqual(self.listing_requests(), 12)
+        snapshot = REGISTRY.snapshot()
+        self.assertEqual(snapshot['counters']['listings_inserted_total'], 12)
+        self.assertEqual(snapshot['latency']['metric_seconds{metric="get_rent"}']['count'], 12)
+        self.assertEqual(snapshot['latency']['page_fetch_seconds{proxy="direct"}']['count'], 12)
+        for row in self.parser.pgSQL.rows:
+            self.assertEqual(row['url'], row[self.parser.FEED_KEY])
+
+        self.parser.process_items(self.parser.feed['items'])
+        self.assertEqual(len(self.parser.pgSQL.rows), 12)
+        self.assertEqual(self.listing_requests(), 12)
+
+    def test_replay(self):
+        store_dir = tempfile.mkdtemp()
+        try:
+            self.parser.html_store = HtmlStore(store_dir)
+            self.parser.process_items(self.parser.feed['items'])
+            self.assertEqual(len(self.parser.html_store), 12)
+            rents = [row['rent'] for row in self.parser.pgSQL.rows]
+            for row in self.parser.pgSQL.rows:
+                row['rent'] = 0
+
+            self.assertEqual(self.parser.replay(fields=['rent'], processes=2), 12)
+            self.assertEqual([row['rent'] for row in self.parser.pgSQL.rows], rents)
+        finally:
+            shutil.rmtree(store_dir)
+
+    def test_archive(self):
+        self.parser.process_items(self.parser.feed['items'])
+        for row in self.parser.pgSQL.rows[:5]:
+            row['url'] = row['url'].replace('/listings/', '/removed/')
+        self.parser.archive()
+        archived = [row['archived'] for row in self.parser.pgSQL.rows]
+        self.assertEqual(archived, [True] * 5 + [False] * 7)
+
+    def test_changes(self):
+        self.parser.process_items(self.parser.feed['items'])
+        rows = self.parser.pgSQL.rows
+        self.assertTrue(all(len(row[self.parser.CONTENT_KEY]) == 40 for row in rows))
+        rents = [row['rent'] for row in rows]
+        for row in rows[:3]:
+            row['rent'] += 100
+            row[self.parser.CONTENT_KEY] = 'edited'
+
+        REGISTRY.clear()
+        self.parser.track_changes = True
+        self.parser.archive()
+        self.assertEqual(REGISTRY.snapshot()['latency']['metric_seconds{metric="get_rent"}']['count'], 3)
+        self.assertEqual([row['rent'] for row in rows], rents)
+        self.assertEqual([ (n, field, old, new) for (n, changed_at, field, old, new) in self.parser.pgSQL.history ],
+                         [ (i + 1, 'rent', rents[i] + 100, rents[i]) for i in range(3) ])
+        self.assertEqual(REGISTRY.snapshot()['counters']['listings_unchanged_total'], 9)
+        self.assertTrue(all(not row['archived'] for row in rows))
+
+        # the pages are unchanged now, parsed in the parse pool this time
+        pgSQL = self.parser.pgSQL
+        self.parser.close()
+        self.parser = AptFeed(self.stand_in.feed_url(12), '', parse_processes=2, track_changes=True)
+        self.parser.pgSQL = pgSQL
+        self.parser.archive()
+        self.assertEqual(len(pgSQL.history), 3)
+        self.assertFalse(any(row[self.parser.CONTENT_KEY] == 'edited' for row in rows))
+
+    def test_changes_without_geo(self):
+        self.parser.process_items(self.parser.feed['items'])
+        no_geo = [row for row in self.parser.pgSQL.rows if math.isnan(row['latitude'])]
+        self.assertTrue(len(no_geo) > 0)
+        for row in no_geo:
+            row['rent'] += 100
+            row[self.parser.CONTENT_KEY] = 'edited'
+        self.parser.track_changes = True
+        self.parser.archive()
+        history = self.parser.pgSQL.history
+        self.assertEqual([ (n, field) for (n, changed_at, field, old, new) in history ],
+                         [ (row['listing_number'], 'rent') for row in no_geo ])
+
+    def test_spatial_index(self):
+        self.parser.spatial_index = SpatialIndex()
+        self.parser.process_items(self.parser.feed['items'])
+        self.assertEqual(len(self.parser.spatial_index), 9)     # listing page 2 has no map
+        listing = self.parser.pgSQL.rows[0]
+        comparables = self.parser.comparables(listing)
+        self.assertEqual(len(comparables), 3)
+        self.assertEqual(comparables[0][0], 0.0)
+
+        self.parser.archive_listings([listing['listing_number']])
+        self.assertEqual(len(self.parser.comparables(listing)), 2)
+
+    def test_valuation(self):
+        self.parser.valuation = RentModel()
+        self.parser.process_items(self.parser.feed['items'][:4])
+        self.assertTrue(self.parser.valuation.n > 0)
+        self.assertTrue(all('expected_rent' not in row for row in self.parser.pgSQL.rows))
+
+        self.parser.process_items(self.parser.feed['items'])
+        self.assertTrue(all(row['expected_rent'] > 0 for row in self.parser.pgSQL.rows[4:]))
+
+    def test_reposts(self):
+        self.parser.reposts = NearDuplicates()
+        self.parser.process_items(self.parser.feed['items'])
+        rows = self.parser.pgSQL.rows
+        self.assertTrue(all(self.parser.REPOST_KEY not in row for row in rows[:4]))
+        for (i, row) in enumerate(rows[4:], 4):
+            self.assertEqual(row[self.parser.REPOST_KEY], rows[i % 4]['url'])
+
+    def test_watermarks(self):
+        path = os.path.join(tempfile.mkdtemp(), 'watermarks')
+        try:
+            watermarks = FeedWatermarks(path)
+            url = self.stand_in.feed_url(8)
+            first = feedparser.parse(url)
+            self.assertEqual(len(watermarks.new_items(url, first)), 8)
+            watermarks.advance(url, first)
+
+            (etag, modified) = watermarks.conditional(url)
+            self.assertEqual(feedparser.parse(url, etag=etag).status, 304)
+            self.assertEqual(FeedWatermarks(path).conditional(url), (etag, modified))
+
+            later = feedparser.parse(self.stand_in.feed_url(8, start=4))
+            self.assertEqual([item['link'] for item in watermarks.new_items(url, later)],
+                             [self.stand_in.listing_url(i) for i in range(8, 12)])
+            watermarks.advance(url, later)
+            rolled_down = feedparser.parse(self.stand_in.feed_url(2, start=1))
+            self.assertEqual(watermarks.new_items(url, rolled_down), [])
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+
+    def test_spool(self):
+        directory = tempfile.mkdtemp()
+        try:
+            self.parser.spool = Spool(os.path.join(directory, 'spool'))
+            self.parser.drainer = SpoolDrainer(self.parser.spool, self.parser.store_spooled, retry_t=0.01, poll_t=0.01)
+            self.parser.process_items(self.parser.feed['items'])
+            self.assertTrue(self.parser.drainer.drain())
+            self.assertEqual(len(self.parser.pgSQL.rows), 12)
+
+            # a batch read again after a crash is not stored twice
+            self.parser.spool.append([ (dict(row), []) for row in self.parser.pgSQL.rows[:3] ])
+            self.assertTrue(self.parser.drainer.drain())
+            self.assertEqual(len(self.parser.pgSQL.rows), 12)
+        finally:
+            self.parser.close()
+            shutil.rmtree(directory)
+
+    def test_spool_db_unavailable(self):
+        directory = tempfile.mkdtemp()
+        db = self.parser.pgSQL
+        def unavailable(*args):
+            raise IOError('database unavailable')
+        try:
+            self.parser.spool = Spool(os.path.join(directory, 'spool'))
+            db.existing = db.apt_exists = db.insert_many = unavailable
+            self.assertEqual(len(self.parser.process_items(self.parser.feed['items'])), 12)
+            self.assertEqual(len(self.parser.process_items(self.parser.feed['items'])), 0)
+            self.assertEqual(len(self.parser.spool.read()[0]), 12)
+
+            for name in ['existing', 'apt_exists', 'insert_many']:
+                delattr(db, name)
+            self.parser.drainer = SpoolDrainer(self.parser.spool, self.parser.store_spooled, retry_t=0.01, poll_t=0.01)
+            self.assertTrue(self.parser.drainer.drain())
+            self.assertEqual(len(db.rows), 12)
+        finally:
+            self.parser.close()
+            shutil.rmtree(directory)
+
+    def test_spool_reconnect(self):
+        directory = tempfile.mkdtemp()
+        lost = self.parser.pgSQL
+        def closed(*args):
+            raise psycopg2.InterfaceError('connection already closed')
+        disconnected = []
+        try:
+            self.parser.spool = Spool(os.path.join(directory, 'spool'))
+            lost.existing = lost.apt_exists = closed
+            self.parser.db_args = ('apartment_listings', 'an0nym1ty', 'test', False)
+            self.parser.connect = FakePgSQL
+            self.parser.disconnect = disconnected.append
+            self.assertEqual(len(self.parser.process_items(self.parser.feed['items'])), 12)
+            self.assertEqual(disconnected, [lost])
+            self.assertTrue(isinstance(self.parser.pgSQL, FakePgSQL) and self.parser.pgSQL is not lost)
+        finally:
+            del self.parser.disconnect
+            self.parser.close()
+            shutil.rmtree(directory)
+
+    def test_pipeline_abandoned(self):
+        def unavailable(*args):
+            raise IOError('database unavailable')
+        pipeline_threads = lambda: [t for t in threading.enumerate() if t.name.startswith('ingest-')]
+        self.parser.close()
+        self.parser = AptFeed(self.stand_in.feed_url(12), '', parse_processes=2, pipeline_depth=4)
+        self.parser.pgSQL = FakePgSQL()
+        self.parser.pgSQL.apt_exists = unavailable
+        self.parser.update_feed()
+        for i in range(3):
+            self.assertRaises(IOError, self.parser.process_items, self.parser.feed['items'])
+        sys.exc_clear()         # the last traceback holds on to the abandoned pipeline
+        t_end = time.time() + 5
+        while len(pipeline_threads()) > 0 and time.time() < t_end:
+            time.sleep(0.01)
+        self.assertEqual(pipeline_threads(), [])
+
+    def test_not_modified(self):
+        self.parser.watermarks.advance(self.parser.rss_url, self.parser.feed)
+        self.assertEqual(self.parser.update_feed(), 304)
+        self.assertEqual(len(self.parser.feed['items']), 12)
+
+    def test_pipeline(self):
+        # NaN (no geo) never equals itself, so rows are compared with it as 'nan'
+        comparable = lambda row: {k:(v if v == v else 'nan') for (k, v) in row.items() if k != 'scrape_time'}
+        self.parser.process_items(self.parser.feed['items'])
+        expected = [ comparable(row) for row in self.parser.pgSQL.rows ]
+
+        self.parser.close()
+        self.parser = AptFeed(self.stand_in.feed_url(12), '', parse_processes=2, pipeline_depth=4)
+        self.parser.pgSQL = FakePgSQL()
+        self.parser.update_feed()
+        REGISTRY.clear()
+        self.parser.process_items(self.parser.feed['items'])
+        rows = [ comparable(row) for row in self.parser.pgSQL.rows ]
+        self.assertEqual(rows, expected)
+        latency = REGISTRY.snapshot()['latency']      # recorded in the parse processes
+        self.assertEqual(latency['metric_seconds{metric="get_rent"}']['count'], 12)
+        self.assertEqual(latency['parse_seconds']['count'], 12)
+
+        for row in self.parser.pgSQL.rows[:5]:
+            row['url'] = row['url'].replace('/listings/', '/removed/')
+        self.parser.archive()
+        archived = [row['archived'] for row in self.parser.pgSQL.rows]
+        self.assertEqual(archived, [True] * 5 + [False] * 7)
+
+
+class TestFeedScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.stand_in = StandIn().start()
+        self.parser = AptFeed('', '')
+        self.parser.pgSQL = FakePgSQL()
+        self.feeds = [self.stand_in.feed_url(4), self.stand_in.feed_url(10)]
+        self.scheduler = FeedScheduler(self.parser, self.feeds, min_t=60, max_t=3600)
+
+    def tearDown(self):
+        self.parser.close()
+        self.stand_in.stop()
+
+    def test_tick(self):
+        now = time.time()
+        observed = self.scheduler.tick(now)
+        self.assertEqual(sorted(observed), sorted(self.feeds))
+        self.assertEqual(sum(observed.values()), 10)     # the feeds share listings 0-3
+        self.assertEqual(len(self.parser.pgSQL.rows), 10)
+        self.assertEqual(self.scheduler.tick(now + 30), {})
+        self.assertEqual(self.scheduler.tick(now + 60), {self.feeds[0]:0, self.feeds[1]:0})
+        self.assertEqual(self.scheduler.feeds[self.feeds[0]]['interval'], 120)
+        self.assertEqual(self.stand_in.requests['/feed.rss'], 4)
+
+    def test_set_feeds(self):
+        now = time.time()
+        added = self.stand_in.feed_url(2)
+        self.assertEqual(self.scheduler.set_feeds([self.feeds[1], added], now), ([added], [self.feeds[0]]))
+        self.assertEqual(sorted(self.scheduler.tick(now)), sorted([self.feeds[1], added]))
+
+    def test_failed_tick(self):
+        def fail(items):
+            raise IOError('database is down')
+        now = time.time()
+        self.parser.process_items = fail
+        self.assertRaises(IOError, self.scheduler.tick, now)
+        self.assertEqual(sorted(entry[1] for entry in self.scheduler.queue), sorted(self.feeds))
+        del self.parser.process_items
+        self.assertEqual(sorted(self.scheduler.tick(now + 60)), sorted(self.feeds))
+
+    def test_stop(self):
+        self.scheduler.tick_t = 0.01
+        thread = threading.Thread(target=self.scheduler.run)
+        thread.start()
+        self.scheduler.stop()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    def test_adaptive_interval(self):
+        (busy, quiet) = self.feeds
+        for feed in self.feeds:
+            self.scheduler.feeds[feed].update({'capacity':20, 'polled':0})
+        self.assertEqual(self.scheduler.observe(busy, 10, 100), 100)     # 0.1 new/s fills half the feed in 100s
+        self.assertEqual(self.scheduler.observe(busy, 20, 150), 60)      # overflowed: halved, clamped to min_t
+        self.assertEqual(self.scheduler.observe(quiet, 0, 100), 120)
+        self.assertEqual(self.scheduler.observe(quiet, 0, 300), 240)
+        for i in range(10):
+            self.scheduler.observe(quiet, 0, 300 + i)
+        self.assertEqual(self.scheduler.feeds[quiet]['interval'], 3600)
+
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.parse_pool = multiprocessing.Pool(1)
+
+    def tearDown(self):
+        self.parse_pool.terminate()
+        self.parse_pool.join()
+
+    def pipeline(self, extract):
+        pipeline = Pipeline(lambda task: (task, None), extract, self.parse_pool, fetchers=2, depth=4, parse_timeout=1.0)
+        pipeline.POLL_T = 0.01
+        return pipeline
+
+    def test_failed_parse(self):
+        results = self.pipeline(unpicklable_result).run(['a', 'b'])
+        self.assertRaises(MaybeEncodingError, list, results)
+
+    def test_lost_parse(self):
+        results = self.pipeline(exit_worker).run(['a'])
+        self.assertRaises(multiprocessing.TimeoutError, list, results)
+
+
+class TestImageDownloader(unittest.TestCase):
+
+    def setUp(self):
+        self.stand_in = StandIn().start()
+        self.base_dir = tempfile.mkdtemp()
+        self.downloader = ImageDownloader(ProxyHandler(''), self.base_dir, workers=2)
+
+    def tearDown(self):
+        self.downloader.close()
+        self.stand_in.stop()
+        shutil.rmtree(self.base_dir)
+
+    def image(self, name):
+        return '{0}/images/{1}'.format(self.stand_in.base, name)
+
+    def manifest(self, listing_id):
+        with open(os.path.join(self.base_dir, listing_id, 'manifest.json')) as f:
+            return json.load(f)
+
+    def test_dedupe(self):
+        self.downloader.save(1, [self.image('a.jpg'), self.image('b.jpg')])
+        self.downloader.save(2, [self.image('a.jpg'), self.image('b.jpg?size=large')])
+        self.downloader.join()
+
+        self.assertEqual(self.stand_in.requests['/images/a.jpg'], 1)
+        first, second = self.manifest('1'), self.manifest('2')
+        self.assertEqual([image['blob'] for image in first], [image['blob'] for image in second])
+        for image in first:
+            with open(os.path.join(self.base_dir, image['blob'])) as f:
+                name = os.path.splitext(os.path.basename(image['url']))[0]
+                self.assertEqual(f.read(), (name * 512)[:64*1024])
+
+    def test_resume(self):
+        self.downloader.save(1, [self.image('a.jpg')])
+        self.downloader.close()
+        with open(os.path.join(self.base_dir, '1', 'manifest.json'), 'w') as f:
+            json.dump([ {'url':self.image('a.jpg'), 'blob':None}, {'url':self.image('c.jpg'), 'blob':None} ], f)
+
+        self.downloader = ImageDownloader(ProxyHandler(''), self.base_dir, workers=2)
+        self.assertEqual(self.downloader.resume(), 1)
+        self.downloader.join()
+        self.assertTrue(all(image['blob'] != None for image in self.manifest('1')))
+        self.assertEqual(self.stand_in.requests['/images/a.jpg'], 1)
+        self.assertEqual(self.stand_in.requests['/images/c.jpg'], 1)
+        self.assertEqual(self.downloader.resume(), 0)
+
+
+class TestExtraction(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = AptFeed('', '')
+
+    def test_strained_metrics_match_full_parse(self):
+        full = self.parser.coalesce_metrics(self.parser.parse(LISTING_HTML, SoupStrainer()))
+        fast = self.parser.coalesce_metrics(self.parser.parse(LISTING_HTML))
+        for metrics in (full, fast):
+            del metrics['scrape_time']
+        self.assertEqual(fast, full)
+        self.assertEqual(fast['rent'], 2500)
+        self.assertEqual((fast['br'], fast['ft2']), (1, 650))
+        self.assertEqual(fast['latitude'], 40.7265)
+
+    def test_strainer_requires_declared_selectors(self):
+        self.assertTrue(self.parser.strainer != None)
+        self.assertEqual(self.parser.build_strainer([self.parser.listing_removed]), None)
+        self.assertEqual(AptFeed('', '', fast_extract=False).strainer, None)
+
+    def test_listing_removed(self):
+        self.assertFalse(self.parser.listing_removed(self.parser.parse(LISTING_HTML, self.parser.removal_strainer)))
+        self.assertTrue(self.parser.listing_removed(self.parser.parse('<html><body>gone</body></html>')))
+
+
+class TestArchiveScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = AptFeed('', '')
+        self.scheduler = ArchiveScheduler(self.parser, budget=2)
+        day = ArchiveScheduler.AGE_BUCKET
+        self.now = 100 * day
+        self.scheduler.listings = { 1:['fresh', self.now - day, self.now - day],
+                                    2:['old', self.now - 30*day, self.now - day/2],
+                                    3:['old, just checked', self.now - 30*day, self.now - 60],
+                                    4:['fresh, never checked', self.now - 2*day, self.now - 2*day] }
 
+    def test_priority_by_time_since_check(self):
+        self.assertEqual(self.scheduler.select(self.now), [4, 1])
 
+    def test_priority_by_removal_probability(self):
+        for i in range(20):
+            self.scheduler.observe(30 * ArchiveScheduler.AGE_BUCKET, True)
+            for age in range(3):
+                self.scheduler.observe(age * ArchiveScheduler.AGE_BUCKET, False)
+        self.assertEqual(self.scheduler.select(self.now), [2, 4])
+        self.assertTrue(self.scheduler.removal_probability(30 * ArchiveScheduler.AGE_BUCKET) > 0.9)
+        self.assertTrue(self.scheduler.removal_probability(0) < 0.1)
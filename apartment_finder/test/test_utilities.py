@@ -1,7 +1,24 @@
+import os
+import time
+import shutil
+import urllib2
 import inspect
+import tempfile
 import unittest
+import random
 import datetime
+import numpy as np
 from ..utilities.pgSQL_handler import pgSQL
+from ..utilities.general_utils import ProxyHandler, ProxySession
+from ..utilities.seen_cache import SeenCache
+from ..utilities.html_store import HtmlStore
+from ..utilities.analytics import Listings
+from ..utilities.spatial_index import SpatialIndex
+from ..utilities.valuation import RentModel, revalue
+from ..utilities.near_duplicates import NearDuplicates
+from ..utilities.instrumentation import Registry
+from ..utilities.spool import Spool, SpoolDrainer
+from .stand_in import StandIn
 
 class TestpgSQL(unittest.TestCase):
 
@@ -48,6 +65,14 @@ class TestpgSQL(unittest.TestCase):
         missing_metrics = self.pgSQL.identify_missing(metrics.keys())
         self.assertEqual(metrics.keys(), missing_metrics)
 
+    def test_column_catalog(self):
+        self.assertEqual(self.pgSQL.identify_missing(['cl_id', 'listing_number']), [])
+        self.assertEqual(self.pgSQL.identify_missing(['x', 'y']), ['x', 'y'])
+        self.pgSQL.add_columns({'x':int, 'y':str})
+        self.assertEqual(self.pgSQL.identify_missing(['x', 'y']), [])
+        cached = dict(self.pgSQL.columns)
+        self.assertEqual(set(cached.keys()), set(self.pgSQL.load_columns().keys()))
+
     def test_insert(self):
         metrics= {'a':25, 'b':3.5213, 'c':'THIS"is|" some$TEXT$"BRO', 'd':datetime.datetime.now(), 'e':True}
         result = self.pgSQL.insert(metrics)
@@ -55,6 +80,32 @@ class TestpgSQL(unittest.TestCase):
         self.assertEqual(missing_metrics, [])
         self.assertTrue(result, 'insert unique row returns false')
 
+    def test_insert_many(self):
+        batch = [ {'a':25, 'b':3.5213, 'c':'THIS"is|" some$TEXT$"BRO'},
+                  {'a':26, 'd':datetime.datetime.now(), 'e':True},
+                  {'a':27, 'f':None} ]
+        listing_numbers = self.pgSQL.insert_many(batch)
+        self.assertEqual(len(listing_numbers), len(batch))
+        self.assertTrue(all(n != None for n in listing_numbers))
+
+        missing_metrics = self.pgSQL.identify_missing(['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(missing_metrics, [])
+        for (metrics, listing_number) in zip(batch, listing_numbers):
+            self.assertEqual(self.pgSQL.get_uid({'a':metrics['a']}), listing_number)
+
+    def test_existing(self):
+        self.assertEqual(self.pgSQL.existing('link', ['a', 'b']), set())
+        self.pgSQL.insert_many([{'link':'a'}, {'link':'c'}])
+        self.assertEqual(self.pgSQL.existing('link', ['a', 'b', 'c', 'd']), set(['a', 'c']))
+        self.assertEqual(self.pgSQL.existing('link', []), set())
+
+    def test_archive_listings(self):
+        listing_numbers = self.pgSQL.insert_many([ {'a':i, 'archived':False} for i in range(4) ])
+        self.assertEqual(self.pgSQL.archive_listings(listing_numbers[:2]), 2)
+        active = self.pgSQL.get_active_listings(['listing_number'])
+        self.assertEqual(sorted(row[0] for row in active), sorted(listing_numbers[2:]))
+        self.assertEqual(self.pgSQL.archive_listings([]), 0)
+
     def test_archive(self):
         identifier = {'b':32}
         metrics = {'a':True, 'b':32, 'archived':False}
@@ -73,10 +124,466 @@ class TestpgSQL(unittest.TestCase):
         new_archived = cursor.fetchone()[0]
         self.assertTrue(new_archived)
 
+    def test_history(self):
+        listing_numbers = self.pgSQL.insert_many([ {'rent':2000, 'archived':False}, {'rent':3000, 'archived':False} ])
+        self.assertEqual(self.pgSQL.get_listings(['listing_number', 'rent'], listing_numbers[1:]), [(listing_numbers[1], 3000)])
+        self.assertEqual(self.pgSQL.insert_history([(listing_numbers[0], 'rent', 2000, 1900)]), 1)
+        cursor = self.pgSQL.pg_conn.cursor()
+        cursor.execute('select listing_number, field, old_value, new_value from test_history')
+        self.assertEqual(cursor.fetchall(), [(listing_numbers[0], 'rent', '2000', '1900')])
+        cursor.execute('drop table test_history')
+        self.pgSQL.pg_conn.commit()
+
+    def test_partitioned(self):
+        partitioned = pgSQL('apartment_listings', 'an0nym1ty', default_table='test_partitioned', partitioned=True)
+        cursor = partitioned.pg_conn.cursor()
+        cursor.execute('drop table if exists test_partitioned cascade')
+        partitioned.pg_conn.commit()
+        partitioned.init_db()
+
+        listing_numbers = partitioned.insert_many([ {'a':i, 'archived':False} for i in range(4) ])
+        self.assertEqual(partitioned.archive_listings(listing_numbers[:3]), 3)
+        partitioned.archive_listing({'a':3})
+        self.assertEqual(partitioned.get_active_listings(['listing_number']), [])
+
+        count = 'select count(*) from {0}'
+        cursor.execute(count.format('test_partitioned_active'))
+        self.assertEqual(cursor.fetchone()[0], 0)
+        month = partitioned.create_archive_partition(datetime.datetime.now())
+        cursor.execute(count.format(month))
+        self.assertEqual(cursor.fetchone()[0], 4)
+        cursor.execute('drop table test_partitioned cascade')
+        partitioned.pg_conn.commit()
+
+    def test_listings_snapshot(self):
+        created = datetime.datetime(2015, 6, 1, 12)
+        self.pgSQL.insert_many([ {'rent':2000, 'br':1, 'ft2':500, 'created':created, 'archived':False},
+                                 {'rent':3000, 'br':2, 'archived':False},
+                                 {'rent':9000, 'br':3, 'archived':True} ])
+        listings = Listings.from_db(self.pgSQL, chunk_size=1)
+        self.assertEqual(len(listings), 2)
+        self.assertEqual(sorted(listings['rent']), [2000, 3000])
+        self.assertEqual(np.isnan(listings['ft2']).sum(), 1)
+        self.assertEqual(np.isnat(listings['created']).sum(), 1)
+
+    def test_revalue_empty(self):
+        self.assertTrue(revalue(self.pgSQL).coef is None)
+
+
+class TestAnalytics(unittest.TestCase):
+
+    def setUp(self):
+        day = lambda d: np.datetime64('2015-06-01') + np.timedelta64(d, 'D')
+        self.listings = Listings({ 'rent':np.array([1000., 2000., 3000., 4000., np.nan]),
+                                   'br':np.array([1., 1., 2., np.nan, 2.]),
+                                   'ft2':np.array([500., 1000., 1000., 800., 900.]),
+                                   'latitude':np.zeros(5),
+                                   'longitude':np.zeros(5),
+                                   'created':np.array([day(0), day(1), day(7), day(8), day(8)], dtype='datetime64[s]') })
+
+    def test_rent_per_ft2_by_br(self):
+        (brs, values, counts) = self.listings.rent_per_ft2_by_br()
+        self.assertEqual(list(brs), [1, 2])
+        self.assertEqual(list(values), [2.0, 3.0])
+        self.assertEqual(list(counts), [2, 1])
+
+    def test_quantiles(self):
+        self.assertEqual(list(self.listings.quantiles('rent', [0, 50, 100])), [1000, 2500, 4000])
+
+    def test_trend(self):
+        (days, values, counts) = self.listings.trend('rent', unit='D')
+        self.assertEqual(len(days), 4)
+        self.assertEqual(list(values), [1000, 2000, 3000, 4000])
+        (weeks, values, counts) = self.listings.trend('rent', unit='W')
+        self.assertEqual(counts.sum(), 4)
+
+    def test_snapshot(self):
+        path = os.path.join(tempfile.mkdtemp(), 'listings.npz')
+        try:
+            self.listings.save(path)
+            loaded = Listings.load(path)
+            for column in ['rent', 'br', 'ft2', 'created']:
+                np.testing.assert_array_equal(loaded[column], self.listings[column])
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+
+
+class TestSpatialIndex(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(7)
+        self.index = SpatialIndex(cell_km=0.5)
+        self.points = {}
+        for n in range(2000):
+            point = (40.7 + random.uniform(-0.1, 0.1), -73.95 + random.uniform(-0.1, 0.1), random.randint(0, 3), random.randint(300, 1500))
+            self.points[n] = point
+            self.index.add(n, *point)
+        self.index.add(-1, float('nan'), float('nan'), 1, 500)
+
+    def brute_force(self, lat, lon, br=None, ft2=None):
+        matches = []
+        for (n, (n_lat, n_lon, n_br, n_ft2)) in self.points.items():
+            if (br == None or br[0] <= n_br <= br[1]) and (ft2 == None or ft2[0] <= n_ft2 <= ft2[1]):
+                (x, y), (nx, ny) = self.index.xy(lat, lon), self.index.xy(n_lat, n_lon)
+                matches.append(((nx - x) ** 2 + (ny - y) ** 2) ** 0.5)
+        return sorted(matches)
+
+    def test_nearest(self):
+        for (br, ft2) in [(None, None), ((2, 2), (600, 900))]:
+            found = self.index.nearest(40.71, -73.96, 10, br, ft2)
+            self.assertEqual(len(found), 10)
+            for ((d, n), expected) in zip(found, self.brute_force(40.71, -73.96, br, ft2)):
+                self.assertAlmostEqual(d, expected)
+                self.assertTrue(br == None or self.points[n][2] == 2)
+
+    def test_radius(self):
+        found = self.index.radius(40.69, -73.94, 1.2, br=(1, 2))
+        expected = [d for d in self.brute_force(40.69, -73.94, br=(1, 2)) if d <= 1.2]
+        self.assertEqual(len(found), len(expected))
+        self.assertEqual(self.index.nearest(float('nan'), 0.0, 5), [])
+
+    def test_remove(self):
+        (d, n) = self.index.nearest(40.7, -73.95, 1)[0]
+        self.index.remove(n)
+        self.assertTrue(n not in self.index)
+        self.assertNotEqual(self.index.nearest(40.7, -73.95, 1)[0][1], n)
+        self.assertEqual(len(self.index), 1999)
+
+
+class TestRentModel(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(3)
+        n = 500
+        self.listings = Listings({ 'br':rng.randint(0, 4, n).astype(float),
+                                   'ft2':rng.uniform(300, 1500, n),
+                                   'latitude':40.7 + rng.uniform(-0.1, 0.1, n),
+                                   'longitude':-73.95 + rng.uniform(-0.1, 0.1, n) })
+        self.listings.arrays['ft2'][::10] = np.nan
+        log_ft2 = np.log(np.nan_to_num(self.listings['ft2']) + np.isnan(self.listings['ft2']) * 700)
+        self.listings.arrays['rent'] = np.exp(5 + 0.1 * self.listings['br'] + 0.4 * log_ft2 - 2 * (self.listings['latitude'] - 40.7))
+
+    def test_fit(self):
+        model = RentModel().fit(self.listings)
+        expected, deal = model.score(self.listings)
+        self.assertTrue(np.abs(expected / self.listings['rent'] - 1).max() < 0.1)
+        self.assertTrue(np.abs(deal).max() < 0.1)
+
+    def test_incremental(self):
+        full = RentModel().fit(self.listings)
+        incremental = RentModel()
+        for i in range(0, 500, 100):
+            incremental.update(self.listings.select(np.arange(500) // 100 == i // 100))
+        np.testing.assert_allclose(incremental.coef, full.coef)
+
+        path = os.path.join(tempfile.mkdtemp(), 'model.npz')
+        try:
+            incremental.save(path)
+            np.testing.assert_allclose(RentModel.load(path).coef, full.coef)
+            incremental.save(path[:-len('.npz')])       # kept as named, no .npz appended
+            np.testing.assert_allclose(RentModel.load(path[:-len('.npz')]).coef, full.coef)
+            self.assertEqual(sorted(os.listdir(os.path.dirname(path))), ['model', 'model.npz'])
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+
+    def test_score_metrics(self):
+        model = RentModel()
+        self.assertEqual(model.score_metrics([{'rent':1000}]), [{'rent':1000}])
+        model.fit(self.listings)
+        (cheap, unpriced) = model.score_metrics([ {'rent':500, 'br':1, 'ft2':700, 'latitude':40.7, 'longitude':-73.95},
+                                                  {'br':1, 'latitude':'nan', 'longitude':'nan'} ])
+        self.assertTrue(cheap['deal_score'] > 0.5)
+        self.assertTrue(unpriced['expected_rent'] > 0)
+        self.assertEqual(unpriced['deal_score'], None)
+
+
+class TestNearDuplicates(unittest.TestCase):
+
+    TEXT = ('Sunny renovated one bedroom on a quiet tree lined block in the East Village. Hardwood floors, '
+            'exposed brick, a windowed kitchen with stainless steel appliances and a dishwasher. Laundry in '
+            'the building, live in super, close to the L and 6 trains. Available June 1st, no fee')
+
+    def setUp(self):
+        self.index = NearDuplicates(capacity=3)
+        self.index.add('original', self.index.signature(self.TEXT))
+
+    def test_repost(self):
+        repost = self.TEXT.replace('June 1st', 'July 1st').replace('Sunny', 'Bright') + ' Call today!'
+        self.assertEqual(self.index.find(self.index.signature(repost))[0], 'original')
+        self.index.add('repost', self.index.signature(repost), 'original')
+        (canonical, similarity) = self.index.find(self.index.signature(repost + ' Text me'))
+        self.assertEqual(canonical, 'original')
+        self.assertTrue(similarity > 0.9)
+
+    def test_unrelated(self):
+        other = 'Huge two bedroom duplex in Park Slope with a private backyard, steps from Prospect Park. Pets ok'
+        self.assertEqual(self.index.find(self.index.signature(other)), None)
+        self.assertEqual(self.index.signature(''), None)
+
+    def test_capacity_and_snapshot(self):
+        for i in range(3):
+            self.index.add(i, self.index.signature('listing number {0} of many'.format(i) * 3))
+        self.assertEqual(len(self.index), 3)
+        self.assertTrue('original' not in self.index)
+        self.assertEqual(self.index.find(self.index.signature(self.TEXT)), None)
+
+        path = os.path.join(tempfile.mkdtemp(), 'reposts')
+        try:
+            self.index.snapshot_path = path
+            self.index.save()
+            loaded = NearDuplicates(snapshot_path=path)
+            self.assertEqual(loaded.find(self.index.signature('listing number 2 of many' * 3)), (2, 1.0))
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+
+
+class TestRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = Registry(buckets=(0.01, 0.1, 1.0))
+
+    def test_exposition(self):
+        self.registry.inc('pages_total', 2, proxy='direct')
+        self.registry.inc('pages_total', proxy='direct')
+        for seconds in [0.005, 0.05, 0.05, 5.0]:
+            self.registry.observe('fetch_seconds', seconds, proxy='a"b')
+        text = self.registry.exposition()
+        self.assertTrue('pages_total{proxy="direct"} 3\n' in text)
+        self.assertTrue('fetch_seconds_bucket{proxy="a\\"b",le="0.1"} 3\n' in text)
+        self.assertTrue('fetch_seconds_bucket{proxy="a\\"b",le="+Inf"} 4\n' in text)
+        self.assertTrue('fetch_seconds_count{proxy="a\\"b"} 4\n' in text)
+
+    def test_snapshot(self):
+        with self.registry.timed('parse_seconds'):
+            pass
+        for i in range(9):
+            self.registry.observe('parse_seconds', 0.5)
+        latency = self.registry.snapshot()['latency']['parse_seconds']
+        self.assertEqual(latency['count'], 10)
+        self.assertEqual((latency['p50'], latency['p90'], latency['p99']), (1.0, 1.0, 1.0))
+
+    def test_merge(self):
+        worker = Registry(buckets=(0.01, 0.1, 1.0))
+        worker.inc('pages_total', 2)
+        worker.observe('parse_seconds', 0.05)
+        self.registry.inc('pages_total')
+        self.registry.merge(worker.drain())
+        worker.observe('parse_seconds', 0.5)
+        self.registry.merge(worker.drain())
+        self.assertEqual(worker.snapshot(), {'counters':{}, 'latency':{}})
+        snapshot = self.registry.snapshot()
+        self.assertEqual(snapshot['counters']['pages_total'], 3)
+        self.assertEqual(snapshot['latency']['parse_seconds']['count'], 2)
+        self.assertEqual(snapshot['latency']['parse_seconds']['p90'], 1.0)
+
+    def test_serve(self):
+        self.registry.inc('pages_total')
+        server = self.registry.serve(port=0)
+        try:
+            url = 'http://127.0.0.1:{0}/metrics'.format(server.server_address[1])
+            self.assertEqual(urllib2.urlopen(url).read(), self.registry.exposition())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class TestProxyHandler(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.proxy_path = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            f.write('127.0.0.1 8080\n127.0.0.2 8080\n127.0.0.3 3128\n')
+
+    def tearDown(self):
+        os.remove(self.proxy_path)
+
+    def test_concurrency(self):
+        handler = ProxyHandler(self.proxy_path, max_per_proxy=5)
+        self.assertEqual(handler.N, 3)
+        self.assertEqual(handler.concurrency(), 15)
+        for proxy in handler.proxies:
+            self.assertEqual(proxy.max_connections, 5)
+
+    def test_reload(self):
+        handler = ProxyHandler(self.proxy_path)
+        (first, second, third) = handler.proxies
+        first.record(0.1, True)
+        with open(self.proxy_path, 'w') as f:
+            f.write('127.0.0.1 8080\n127.0.0.4 8080\n')
+        self.assertEqual(handler.reload(), 2)
+        self.assertTrue(handler.proxies[0] is first)
+        self.assertAlmostEqual(handler.proxies[0].latency, 0.1)
+        self.assertEqual(handler.proxies[1].name, '127.0.0.4:8080')
+
+    def test_no_proxies(self):
+        handler = ProxyHandler(self.proxy_path + '.missing', max_per_proxy=5)
+        self.assertEqual(handler.get_proxy(), None)
+        self.assertEqual(handler.concurrency(), 5)
+
+    def test_weighted_selection(self):
+        handler = ProxyHandler(self.proxy_path)
+        (fast, slow, dead) = handler.proxies
+        fast.record(0.1, True)
+        slow.record(1.0, True)
+        for i in range(3):
+            dead.record(0.5, False)
+        self.assertTrue(dead.retry_at > time.time())
+
+        picks = [handler.get_proxy() for i in range(1000)]
+        self.assertEqual(picks.count(dead), 0)
+        self.assertTrue(picks.count(fast) > 5 * picks.count(slow))
+
+        for proxy in handler.proxies:
+            proxy.retry_at = time.time() + 60
+        slow.retry_at -= 30
+        self.assertTrue(handler.get_proxy() is slow)
+
+    def test_reserved_selection(self):
+        handler = ProxyHandler(self.proxy_path, max_per_proxy=2)
+        picks = [handler.reserve_proxy() for i in range(6)]
+        self.assertEqual([picks.count(proxy) for proxy in handler.proxies], [2, 2, 2])
+        picks = [handler.reserve_proxy() for i in range(3)]     # all busy: least loaded first
+        self.assertEqual(sorted(picks), sorted(handler.proxies))
+        self.assertEqual([proxy.in_flight for proxy in handler.proxies], [3, 3, 3])
+
+    def test_keep_alive(self):
+        stand_in = StandIn().start()
+        try:
+            session = ProxySession()
+            first = session.fetch(stand_in.listing_url(0))
+            self.assertEqual(session.fetch(stand_in.listing_url(0)), first)
+            (idle,) = session.idle.values()
+            self.assertEqual(len(idle), 1)
+            self.assertTrue(idle[0].reused)
+
+            chunks = []
+            self.assertEqual(session.fetch(stand_in.listing_url(1), chunks.append), None)
+            self.assertTrue(len(''.join(chunks)) > 0)
 
+            self.assertRaises(urllib2.HTTPError, session.fetch, stand_in.base + '/removed/0.html')
+            self.assertEqual(session.failures, 0)
+            self.assertEqual(session.in_flight, 0)
+        finally:
+            stand_in.stop()
+        self.assertFalse(any(thread.is_alive() for thread in stand_in.threads))     # even with a connection kept alive
 
 
+class TestSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'spool')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_read_commit(self):
+        spool = Spool(self.path)
+        self.assertEqual(spool.append([{'n':i} for i in range(5)]), 5)
+        (records, end) = spool.read(3)
+        self.assertEqual(records, [{'n':0}, {'n':1}, {'n':2}])
+        spool.commit(end)
+        spool.close()
+
+        spool = Spool(self.path)
+        (records, end) = spool.read()
+        self.assertEqual(records, [{'n':3}, {'n':4}])
+        spool.commit(end)
+        self.assertEqual(spool.pending(), 0)
+        self.assertEqual(os.path.getsize(self.path), 0)
+        spool.close()
+
+    def test_torn_frame(self):
+        spool = Spool(self.path)
+        spool.append([{'n':0}, {'n':1}])
+        spool.close()
+        with open(self.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.path) - 3)
+
+        spool = Spool(self.path)
+        spool.append([{'n':2}])
+        self.assertEqual(spool.read()[0], [{'n':0}, {'n':2}])
+        spool.close()
+
+    def test_drainer_retries(self):
+        stored = []
+        failures = [True, True]
+        def store(records):
+            if failures:
+                failures.pop()
+                raise IOError('database unavailable')
+            stored.extend(records)
+        spool = Spool(self.path)
+        drainer = SpoolDrainer(spool, store, batch_size=4, retry_t=0.01, poll_t=0.01)
+        spool.append(range(10))
+        self.assertTrue(drainer.drain())
+        drainer.close()
+        spool.close()
+        self.assertEqual(stored, range(10))
+
+class TestSeenCache(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.snapshot_path = tempfile.mkstemp()
+        os.close(fd)
+        os.remove(self.snapshot_path)
+
+    def tearDown(self):
+        if os.path.exists(self.snapshot_path):
+            os.remove(self.snapshot_path)
+
+    def test_bounded(self):
+        cache = SeenCache(capacity=3)
+        cache.update(['a', 'b', 'c'])
+        self.assertTrue('a' in cache)     # 'a' becomes most recently used
+        cache.add('d')
+        self.assertEqual(len(cache), 3)
+        self.assertFalse('b' in cache)
+        self.assertTrue(all(k in cache for k in ['a', 'c', 'd']))
+
+    def test_unicode_and_tuples(self):
+        cache = SeenCache()
+        cache.add((u'http://a', u'title \u00e9'))
+        cache.add(u'http://b')
+        self.assertTrue(('http://a', 'title \xc3\xa9') in cache)
+        self.assertTrue('http://b' in cache)
+
+    def test_snapshot(self):
+        cache = SeenCache(capacity=10, snapshot_path=self.snapshot_path)
+        cache.update(str(i) for i in range(10))
+        self.assertTrue(cache.save())
+
+        restored = SeenCache(capacity=5, snapshot_path=self.snapshot_path)
+        self.assertEqual(len(restored), 5)
+        self.assertTrue('9' in restored)
+        self.assertFalse('0' in restored)
+
+
+class TestHtmlStore(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
 
+    def objects(self):
+        return sum(len(files) for (path, dirs, files) in os.walk(os.path.join(self.base_dir, 'objects')))
 
+    def test_content_addressed(self):
+        store = HtmlStore(self.base_dir)
+        first = store.put('http://a', '<html>a</html>')
+        self.assertEqual(store.put(u'http://b', '<html>a</html>'), first)
+        self.assertEqual(self.objects(), 1)
+        self.assertEqual(store.get('http://b'), '<html>a</html>')
+        self.assertEqual(store.get('http://c'), None)
 
+        store.put('http://a', '<html>a, edited</html>')
+        self.assertEqual(self.objects(), 2)
+        self.assertEqual(store.get('http://a'), '<html>a, edited</html>')
+        store.close()
 
+        reopened = HtmlStore(self.base_dir)
+        self.assertEqual(len(reopened), 2)
+        self.assertEqual(reopened.get('http://a'), '<html>a, edited</html>')
+        self.assertEqual(sorted(url for (url, path) in reopened.items()), ['http://a', 'http://b'])
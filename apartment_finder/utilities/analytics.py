@@ -0,0 +1,139 @@
+import numpy as np
+
+NUMERIC_COLUMNS = ['listing_number', 'rent', 'br', 'ft2', 'latitude', 'longitude']
+TIME_COLUMN = 'created'
+
+class Listings(object):
+
+    """
+    Columnar snapshot of listings: one typed numpy array per column
+
+        listing_number, rent, br, ft2,     -- float64, NaN where the listing has no value
+        latitude, longitude
+        created                            -- datetime64[s], NaT where the listing has no value
+
+    Built by streaming rows from a server-side cursor (from_db), or loaded from a snapshot
+    written by save(), so repeated analyses don't have to go back to PostgreSQL.
+
+    """
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+
+    @classmethod
+    def from_db(cls, pgSQL, where='archived = False', chunk_size=10000):
+        """
+            reads NUMERIC_COLUMNS and TIME_COLUMN of pgSQL.default_table's rows matching where
+            through a named (server-side) cursor, chunk_size rows at a time, each chunk going
+            straight into a float64 block. Columns missing from the table are all NaN / NaT
+        """
+        missing = pgSQL.identify_missing(NUMERIC_COLUMNS + [TIME_COLUMN])
+        select = [ "coalesce({0}::float8, 'NaN')".format(c) if c not in missing else "'NaN'::float8" for c in NUMERIC_COLUMNS ]
+        select.append("coalesce(extract(epoch from {0})::float8, 'NaN')".format(TIME_COLUMN) if TIME_COLUMN not in missing else "'NaN'::float8")
+        query = 'select {0} from {1}'.format(', '.join(select), pgSQL.default_table)
+        if where != None:
+            query += ' where ' + where
+
+        cursor = pgSQL.pg_conn.cursor(name='listings_snapshot')
+        cursor.itersize = chunk_size
+        blocks = []
+        try:
+            cursor.execute(query)
+            rows = cursor.fetchmany(chunk_size)
+            while len(rows) > 0:
+                blocks.append(np.array(rows, dtype=np.float64))
+                rows = cursor.fetchmany(chunk_size)
+        finally:
+            cursor.close()
+            pgSQL.pg_conn.commit()
+
+        columns = len(NUMERIC_COLUMNS) + 1
+        table = np.concatenate(blocks) if len(blocks) > 0 else np.empty((0, columns))
+        arrays = { c:table[:, i] for (i, c) in enumerate(NUMERIC_COLUMNS) }
+        arrays[TIME_COLUMN] = epoch_to_datetime64(table[:, -1])
+        return cls(arrays)
+
+    @classmethod
+    def load(cls, path):
+        """
+            Listings saved by save() (.npz, or .parquet when pyarrow is installed)
+        """
+        if path.endswith('.parquet'):
+            import pyarrow.parquet as pq
+            table = pq.read_table(path)
+            arrays = { name:table.column(name).to_pandas().values for name in table.column_names }
+            arrays[TIME_COLUMN] = arrays[TIME_COLUMN].astype('datetime64[s]')
+            return cls(arrays)
+        with np.load(path) as snapshot:
+            return cls({ name:snapshot[name] for name in snapshot.files })
+
+    def save(self, path):
+        """
+            writes every column to path, as compressed .npz or (with pyarrow) .parquet
+        """
+        if path.endswith('.parquet'):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            names = sorted(self.arrays)
+            pq.write_table(pa.Table.from_arrays([ pa.array(self.arrays[n]) for n in names ], names), path)
+        else:
+            np.savez_compressed(path, **self.arrays)
+
+    def __len__(self):
+        return len(self.arrays[TIME_COLUMN])
+
+    def __getitem__(self, column):
+        return self.arrays[column]
+
+    def select(self, mask):
+        """
+            Listings of the rows where the boolean array mask is True
+        """
+        return Listings({ k:v[mask] for (k, v) in self.arrays.items() })
+
+    def rent_per_ft2_by_br(self, statistic=np.median):
+        """
+            (bedroom counts, statistic of rent / ft2 for each, listings counted for each) over
+            the listings with a rent, a size and a bedroom count
+        """
+        rent, ft2, br = self['rent'], self['ft2'], self['br']
+        with np.errstate(invalid='ignore'):
+            valid = (rent > 0) & (ft2 > 0) & (br >= 0)
+        return grouped(br[valid].astype(np.int64), rent[valid] / ft2[valid], statistic)
+
+    def quantiles(self, column, q=(10, 25, 50, 75, 90)):
+        """
+            percentiles q of column over the listings that have a value for it
+        """
+        values = self[column]
+        return np.percentile(values[np.isfinite(values)], q) if np.isfinite(values).any() else np.full(len(q), np.nan)
+
+    def trend(self, column='rent', unit='W', statistic=np.median):
+        """
+            (bucket starts, statistic of column in each bucket, listings counted in each) with
+            listings bucketed by the numpy datetime unit of their created time ('D', 'W', 'M'...)
+        """
+        values, created = self[column], self[TIME_COLUMN]
+        valid = np.isfinite(values) & ~np.isnat(created)
+        return grouped(created[valid].astype('datetime64[{0}]'.format(unit)), values[valid], statistic)
+
+def epoch_to_datetime64(seconds):
+    """
+        datetime64[s] array of float unix times, NaN becoming NaT
+    """
+    created = np.full(len(seconds), np.datetime64('NaT'), dtype='datetime64[s]')
+    known = np.isfinite(seconds)
+    created[known] = seconds[known].astype(np.int64).astype('datetime64[s]')
+    return created
+
+def grouped(keys, values, statistic):
+    """
+        (sorted distinct keys, statistic of the values of each key, count of each key)
+    """
+    if len(keys) == 0:
+        return keys, np.empty(0), np.empty(0, dtype=np.int64)
+    order = np.argsort(keys, kind='mergesort')
+    keys, values = keys[order], values[order]
+    distinct, starts = np.unique(keys, return_index=True)
+    groups = np.split(values, starts[1:])
+    return distinct, np.array([ statistic(g) for g in groups ]), np.diff(np.append(starts, len(keys)))
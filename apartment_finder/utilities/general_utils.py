@@ -1,34 +1,267 @@
 import os
+import time
+import errno
+import random
+import socket
+import httplib
 import urllib2
-from itertools import cycle
+import urlparse
+import threading
+from instrumentation import REGISTRY
+
+class ProxySession(object):
+
+    """
+    Pool of keep-alive HTTP(S) connections through one proxy (or straight to the servers when
+    proxy is None), so TCP/TLS setup is paid once per host instead of once per request.
+
+    Health stats kept for ProxyHandler's weighted selection:
+        in_flight   -- requests reserved on the session, running or waiting for a connection
+        latency     -- exponentially weighted moving average of response times (seconds)
+        error_rate  -- exponentially weighted moving average of failures (0 to 1)
+        retry_at    -- after consecutive failures the session is benched until this time
+
+    """
+
+    ALPHA = 0.2             # weight of the newest sample in the moving averages
+    BACKOFF = 30            # seconds benched after the first failure, doubling with each failure
+    MAX_BACKOFF = 30*60
+    MAX_REDIRECTS = 5
+    CHUNK = 64*1024
+    FAILURE_STATUS = (403, 407, 429, 500, 502, 503, 504)
+
+    def __init__(self, proxy=None, max_connections=4, timeout=30):
+        self.proxy = proxy
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.limit = threading.BoundedSemaphore(max_connections)
+        self.lock = threading.Lock()
+        self.idle = {}                  # (scheme, host, port): [idle connections]
+
+        self.in_flight = 0
+        self.name = '{0}:{1}'.format(*proxy) if proxy != None else 'direct'
+        self.latency = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.retry_at = 0
+
+    def fetch(self, url, write=None, reserved=False):
+        """
+            GETs url (following redirects) and returns the body, or streams it in chunks to
+            write() and returns None. Raises urllib2.HTTPError for error statuses and
+            urllib2.URLError when the connection fails, like urllib2.urlopen.
+            reserved: the request was already counted in_flight by reserve()
+        """
+        if not reserved:
+            self.reserve()
+        try:
+            with self.limit:
+                t_start = time.time()
+                try:
+                    body = self.request(url, write)
+                except urllib2.HTTPError as e:
+                    self.record(time.time() - t_start, e.code not in self.FAILURE_STATUS)
+                    raise
+                except (urllib2.URLError, socket.error, httplib.HTTPException) as e:
+                    self.record(time.time() - t_start, False)
+                    if isinstance(e, urllib2.URLError): raise
+                    raise urllib2.URLError(e)
+                self.record(time.time() - t_start, True)
+                return body
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def reserve(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def request(self, url, write):
+        for redirect in range(self.MAX_REDIRECTS + 1):
+            parsed = urlparse.urlparse(url)
+            key = (parsed.scheme, parsed.hostname, parsed.port)
+            path = url if (self.proxy != None and parsed.scheme == 'http') else (parsed.path or '/') + (('?' + parsed.query) if parsed.query else '')
+            headers = {'Host':parsed.netloc, 'Connection':'keep-alive', 'User-Agent':'Mozilla/5.0'}
+
+            conn, response = self.send(key, path, headers)
+            if response.status in (301, 302, 303, 307, 308) and response.getheader('location'):
+                response.read()
+                self.release(key, conn, response)
+                url = urlparse.urljoin(url, response.getheader('location'))
+                continue
+            if response.status >= 400:
+                response.read()
+                self.release(key, conn, response)
+                raise urllib2.HTTPError(url, response.status, response.reason, response.msg, None)
+
+            if write == None:
+                body = response.read()
+            else:
+                body = None
+                chunk = response.read(self.CHUNK)
+                while chunk:
+                    write(chunk)
+                    chunk = response.read(self.CHUNK)
+            self.release(key, conn, response)
+            return body
+        raise urllib2.HTTPError(url, 310, 'too many redirects', {}, None)
+
+    def send(self, key, path, headers):
+        """
+            sends the request on an idle connection to key, or on a new one if there is none
+            (or if the server already closed the idle one)
+        """
+        conn = self.acquire(key)
+        try:
+            conn.request('GET', path, headers=headers)
+            return conn, conn.getresponse()
+        except (socket.error, httplib.HTTPException) as e:
+            conn.close()
+            if not getattr(conn, 'reused', False):
+                raise
+        conn = self.connect(key)
+        conn.request('GET', path, headers=headers)
+        return conn, conn.getresponse()
+
+    def acquire(self, key):
+        with self.lock:
+            idle = self.idle.get(key)
+            if idle:
+                conn = idle.pop()
+                conn.reused = True
+                return conn
+        return self.connect(key)
+
+    def release(self, key, conn, response):
+        if response.will_close:
+            conn.close()
+            return
+        with self.lock:
+            self.idle.setdefault(key, []).append(conn)
+
+    def connect(self, key):
+        (scheme, host, port) = key
+        connection = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+        if self.proxy == None:
+            return connection(host, port, timeout=self.timeout)
+        (proxy_ip, proxy_port) = self.proxy
+        conn = connection(proxy_ip, int(proxy_port), timeout=self.timeout)
+        if scheme == 'https':
+            conn.set_tunnel(host, port)
+        return conn
+
+    def record(self, latency, ok):
+        REGISTRY.observe('page_fetch_seconds', latency, proxy=self.name)
+        if not ok:
+            REGISTRY.inc('page_fetch_failures_total', proxy=self.name)
+        with self.lock:
+            if self.latency == None:
+                self.latency = latency
+            self.latency = self.ALPHA * latency + (1 - self.ALPHA) * self.latency
+            self.error_rate = self.ALPHA * (0.0 if ok else 1.0) + (1 - self.ALPHA) * self.error_rate
+            if ok:
+                self.failures = 0
+                self.retry_at = 0
+            else:
+                self.failures += 1
+                backoff = min(self.BACKOFF * 2 ** (self.failures - 1), self.MAX_BACKOFF)
+                self.retry_at = time.time() + backoff
+
+    def weight(self, now, default_latency):
+        """
+            relative chance of this session being picked: fast, reliable sessions with free
+            connections are preferred, benched ones are skipped until retry_at
+        """
+        if self.retry_at > now:
+            return 0.0
+        latency = self.latency if self.latency != None else default_latency
+        free = max(self.max_connections - self.in_flight, 0) / float(self.max_connections)
+        return (1.0 - self.error_rate) * free / max(latency, 1e-3)
 
 class ProxyHandler(object):
 
-    def __init__(self, proxy_list_path):
+    def __init__(self, proxy_list_path, max_per_proxy=4):
         self.N = -1
-        if os.path.exists(proxy_list_path):
-            with open(proxy_list_path) as f:
-                proxies = [ (l.split()[0], l.split()[1]) for l in f.readlines() ]
-            self.proxies = [ self.get_opener(ip, port) for ip, port in proxies ]
-            self.proxy_cycle = cycle(self.proxies)
-            self.N = len(self.proxies)
+        self.max_per_proxy = max_per_proxy
+        self.proxy_list_path = proxy_list_path
+        self.proxies = []
+        self.direct = ProxySession(None, max_per_proxy)
+        self.lock = threading.Lock()        # a proxy is picked and reserved at once
+        self.reload()
+
+    def reload(self):
+        """
+            (re)reads the proxy list. Proxies still listed keep their session (open connections
+            and latency / failure stats), new ones start fresh and dropped ones are no longer picked.
+            Returns the number of proxies
+        """
+        if not os.path.exists(self.proxy_list_path):
+            return max(self.N, 0)
+        with open(self.proxy_list_path) as f:
+            proxies = [ (l.split()[0], l.split()[1]) for l in f.readlines() if len(l.split()) >= 2 ]
+        sessions = dict((p.name, p) for p in self.proxies)
+        self.proxies = [ sessions.get('{0}:{1}'.format(ip, port)) or self.get_opener(ip, port) for ip, port in proxies ]
+        self.N = len(self.proxies)
+        return self.N
+
+    def concurrency(self):
+        """
+            total number of requests that may be in flight at once across all proxies
+        """
+        return self.max_per_proxy * max(self.N, 1)
+
+    def fetch(self, url, write=None):
+        """
+            read url through a proxy picked by reserve_proxy (see ProxySession.fetch), blocking
+            while that proxy already has max_per_proxy requests in flight
+        """
+        proxy = self.reserve_proxy()
+        return proxy.fetch(url, write, reserved=True)
+
+    def reserve_proxy(self):
+        """
+            get_proxy (or the direct session when there are no proxies), already counted in
+            its in_flight so that concurrent picks see the slot taken. Hand it to
+            ProxySession.fetch with reserved=True
+        """
+        with self.lock:
+            proxy = self.get_proxy()
+            if proxy == None:
+                proxy = self.direct
+            proxy.reserve()
+        return proxy
 
     def get_proxy(self):
-        if self.N >= 0:
-            return self.proxy_cycle.next()
-        return None
+        """
+            picks a proxy at random, weighted by ProxySession.weight. Proxies without stats yet
+            are assumed as fast as the average, so they get tried. If no proxy has a weight
+            (all benched or busy), the least loaded of those not benched is used, or else the
+            one that comes back first
+        """
+        if self.N <= 0:
+            return None
+        now = time.time()
+        latencies = [p.latency for p in self.proxies if p.latency != None]
+        default_latency = sum(latencies) / len(latencies) if len(latencies) > 0 else 1.0
+        weights = [ p.weight(now, default_latency) for p in self.proxies ]
+        total = sum(weights)
+        if total <= 0:
+            return min(self.proxies, key=lambda p: (max(p.retry_at, now), p.in_flight))
+        r = random.uniform(0, total)
+        for (proxy, weight) in zip(self.proxies, weights):
+            r -= weight
+            if r <= 0:
+                return proxy
+        return self.proxies[-1]
 
     def get_proxy_rand(self):
-        if self.N >= 0:
+        if self.N > 0:
             index = random.randint(0, self.N - 1)
             return self.proxies[index]
         return None
 
     def get_opener(self, ip, port, auth=None):
-        proxy_string = 'http://{0}:{1}'.format(ip, port)
-        proxy = urllib2.ProxyHandler({'http':proxy_string})
-        opener = urllib2.build_opener(proxy)
-        return opener
+        return ProxySession((ip, port), self.max_per_proxy)
 
 def mkdir_p(path):
     try:
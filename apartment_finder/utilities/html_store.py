@@ -0,0 +1,94 @@
+import os
+import zlib
+import hashlib
+import threading
+from general_utils import mkdir_p
+
+def read_page(path):
+    """
+        raw html of a page stored at path (see HtmlStore.path)
+    """
+    with open(path, 'rb') as f:
+        return zlib.decompress(f.read())
+
+class HtmlStore(object):
+
+    """
+    Compressed, content addressed on-disk store of the raw html of fetched listing pages
+
+        <base_dir>/objects/<2 hex>/<sha1>   zlib compressed page, named by the sha1 of its html
+        <base_dir>/index                    append-only "<sha1> <url>" lines, the last line of
+                                            a url naming its most recent page
+
+    A page is written once no matter how many times (or under how many urls) it is fetched.
+    Pages outlive the listings, so new @metric methods can be backfilled from the store
+    (see AptFeed.replay) long after the listings were taken down.
+
+    """
+
+    def __init__(self, base_dir):
+        self.base_dir = os.path.expanduser(base_dir)
+        self.lock = threading.Lock()
+        self.index = {}             # url: sha1 of its most recent page
+        mkdir_p(os.path.join(self.base_dir, 'objects'))
+
+        index_path = os.path.join(self.base_dir, 'index')
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                for line in f:
+                    parts = line.rstrip('\n').split(' ', 1)
+                    if len(parts) == 2:
+                        self.index[parts[1]] = parts[0]
+        self.index_file = open(index_path, 'a')
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, url):
+        return url in self.index
+
+    def path(self, digest):
+        return os.path.join(self.base_dir, 'objects', digest[:2], digest)
+
+    def put(self, url, html):
+        """
+            stores html as the most recent page of url and returns its sha1
+        """
+        if type(url) == unicode:
+            url = url.encode('utf-8')
+        digest = hashlib.sha1(html).hexdigest()
+        path = self.path(digest)
+        if not os.path.exists(path):
+            mkdir_p(os.path.dirname(path))
+            tmp_path = '{0}.{1}.tmp'.format(path, threading.current_thread().ident)
+            with open(tmp_path, 'wb') as f:
+                f.write(zlib.compress(html))
+            os.rename(tmp_path, path)
+        with self.lock:
+            if self.index.get(url) != digest:
+                self.index_file.write('{0} {1}\n'.format(digest, url))
+                self.index_file.flush()
+                self.index[url] = digest
+        return digest
+
+    def get(self, url):
+        """
+            most recent html stored for url, or None
+        """
+        if type(url) == unicode:
+            url = url.encode('utf-8')
+        digest = self.index.get(url)
+        if digest == None:
+            return None
+        return read_page(self.path(digest))
+
+    def items(self):
+        """
+            (url, path of its most recent page) for every stored url
+        """
+        with self.lock:
+            index = self.index.items()
+        return [ (url, self.path(digest)) for (url, digest) in index ]
+
+    def close(self):
+        self.index_file.close()
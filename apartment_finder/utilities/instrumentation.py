@@ -0,0 +1,211 @@
+import sys
+import json
+import time
+import bisect
+import threading
+import BaseHTTPServer
+from SocketServer import ThreadingMixIn
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Registry(object):
+
+    """
+    Counters and latency histograms of the scraping pipeline, keyed by name and labels
+
+        inc(name, n, **labels)          -- adds n to a counter
+        observe(name, seconds, **labels) -- records a latency in a histogram (fixed buckets)
+        timed(name, **labels)           -- context manager observing the time spent in it
+
+    Worker processes record into their own copy of the registry: drain() takes what they
+    recorded (sent back with their results) and merge() adds it to the parent's.
+
+    Recording takes a lock, a dict lookup and a bisect, cheap enough to leave on in the hot
+    loop. The values are read as Prometheus text (exposition, served by serve()) or as one
+    JSON line (snapshot, printed every interval by start_logging()).
+
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}          # (name, labels): value
+        self.histograms = {}        # (name, labels): [bucket counts..., sum, count]
+
+    def key(self, name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, n=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def observe(self, name, seconds, **labels):
+        key = self.key(name, labels)
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram == None:
+                histogram = self.histograms[key] = [0] * (len(self.buckets) + 3)
+            histogram[i] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+
+    def timed(self, name, **labels):
+        return Timer(self, name, labels)
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def drain(self):
+        """
+            (counters, histograms) recorded since the last drain or clear, which are cleared
+        """
+        with self.lock:
+            recorded = (self.counters, self.histograms)
+            self.counters = {}
+            self.histograms = {}
+        return recorded
+
+    def merge(self, recorded):
+        """
+            adds the (counters, histograms) drained from another registry to this one
+        """
+        (counters, histograms) = recorded
+        with self.lock:
+            for (key, value) in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for (key, other) in histograms.items():
+                histogram = self.histograms.get(key)
+                if histogram == None:
+                    self.histograms[key] = list(other)
+                else:
+                    for (i, n) in enumerate(other):
+                        histogram[i] += n
+
+    def exposition(self):
+        """
+            every counter and histogram in the Prometheus text exposition format
+        """
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(h)) for (key, h) in self.histograms.items())
+        lines = []
+        typed = set()
+        for ((name, labels), value) in counters:
+            if name not in typed:
+                lines.append('# TYPE {0} counter'.format(name))
+                typed.add(name)
+            lines.append('{0}{1} {2}'.format(name, format_labels(labels), value))
+        for ((name, labels), histogram) in histograms:
+            if name not in typed:
+                lines.append('# TYPE {0} histogram'.format(name))
+                typed.add(name)
+            cumulative = 0
+            for (bound, count) in zip(self.buckets + ('+Inf',), histogram[:-2]):
+                cumulative += count
+                lines.append('{0}_bucket{1} {2}'.format(name, format_labels(labels + (('le', str(bound)),)), cumulative))
+            lines.append('{0}_sum{1} {2}'.format(name, format_labels(labels), histogram[-2]))
+            lines.append('{0}_count{1} {2}'.format(name, format_labels(labels), histogram[-1]))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """
+            {'counters': {series: value}, 'latency': {series: {count, mean, p50, p90, p99}}}
+            with quantiles estimated from the histogram buckets (upper bounds)
+        """
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = dict((key, list(h)) for (key, h) in self.histograms.items())
+        latency = {}
+        for ((name, labels), histogram) in histograms.items():
+            count = histogram[-1]
+            latency[name + format_labels(labels)] = { 'count':count, 'mean':histogram[-2] / count if count else 0.0,
+                                                      'p50':self.quantile(histogram, 0.5), 'p90':self.quantile(histogram, 0.9),
+                                                      'p99':self.quantile(histogram, 0.99) }
+        return { 'counters':dict((name + format_labels(labels), value) for ((name, labels), value) in counters.items()),
+                 'latency':latency }
+
+    def quantile(self, histogram, q):
+        count = histogram[-1]
+        if count == 0:
+            return None
+        cumulative = 0
+        for (bound, n) in zip(self.buckets, histogram[:-3]):
+            cumulative += n
+            if cumulative >= q * count:
+                return bound
+        return float('inf')
+
+    def serve(self, port=9100, host='127.0.0.1'):
+        """
+            serves exposition() at http://host:port/metrics from a background thread.
+            Returns the server (server_address holds the port when port is 0)
+        """
+        server = MetricsServer((host, port), MetricsHandler)
+        server.registry = self
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+    def start_logging(self, interval=60, stream=None):
+        """
+            writes snapshot() as a JSON line (with a timestamp) every interval seconds
+        """
+        def log():
+            while True:
+                time.sleep(interval)
+                record = self.snapshot()
+                record['time'] = time.time()
+                (stream or sys.stdout).write(json.dumps(record, sort_keys=True) + '\n')
+                (stream or sys.stdout).flush()
+        thread = threading.Thread(target=log)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+class Timer(object):
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.t_start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.registry.observe(self.name, time.time() - self.t_start, **self.labels)
+        return False
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    escape = lambda v: unicode(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(u'{0}="{1}"'.format(k, escape(v)) for (k, v) in labels).encode('utf-8') + '}'
+
+class MetricsServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.exposition()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# the registry the pipeline records into
+REGISTRY = Registry()
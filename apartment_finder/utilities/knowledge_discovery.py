@@ -1,23 +1,15 @@
-
-
-import psycopg2
-import numpy as np
 import matplotlib.pyplot as plt
+from pgSQL_handler import pgSQL
+from analytics import Listings
 
-y_label = 'rent'
-x_label = 'br'
-pg_conn = psycopg2.connect('dbname=apartment_listings user=an0nym1ty')
-cursor = pg_conn.cursor()
-
-select = 'select {0}, {1}  from ACTIVE_LISTINGS where rent > 0 and ft2>0'.format(x_label, y_label)
-cursor.execute(select)
-result = cursor.fetchall()
-
-x  = [ pair[0] for pair in result ]
-y   = [ pair[1] for pair in result ]
+if __name__ == '__main__':
 
-plt.scatter(x, y)
-plt.xlabel(x_label)
-plt.ylabel(y_label)
-plt.show()
+    y_label = 'rent'
+    x_label = 'br'
+    listings = Listings.from_db(pgSQL('apartment_listings', 'an0nym1ty'))
+    listings = listings.select((listings['rent'] > 0) & (listings['ft2'] > 0))
 
+    plt.scatter(listings[x_label], listings[y_label])
+    plt.xlabel(x_label)
+    plt.ylabel(y_label)
+    plt.show()
@@ -0,0 +1,143 @@
+import os
+import re
+import zlib
+import cPickle
+import threading
+import numpy as np
+from collections import OrderedDict
+
+WORDS = re.compile(r'\w+', re.UNICODE)
+PRIME = (1 << 32) + 15          # hash functions are (a*h + b) mod PRIME over 32 bit shingle hashes
+
+class NearDuplicates(object):
+
+    """
+    MinHash / locality sensitive hashing index of listing texts, to link reposts (the same
+    apartment under a new url and a slightly changed title) to the listing first seen.
+
+    A text is reduced to its set of `shingle`-word shingles and summarized by a signature of
+    num_perm MinHash values. Two signatures agree in a position with probability equal to
+    the Jaccard similarity of the shingle sets. Signatures are cut into `bands` bands, and
+    texts sharing any whole band land in a common bucket: only those candidates are compared,
+    so finding a repost costs about the same however many listings are indexed.
+
+    With the defaults (64 values, 16 bands of 4) pairs with a similarity of 0.8 become
+    candidates 99.98% of the time, pairs at 0.3 12% of the time. Candidates are confirmed
+    by their estimated similarity (>= threshold).
+
+    At most capacity listings are held (the oldest are dropped first). The index can be
+    snapshotted to a local file, like SeenCache.
+
+    """
+
+    def __init__(self, num_perm=64, bands=16, shingle=4, threshold=0.7, capacity=200000, snapshot_path=None, seed=1):
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm / bands
+        self.shingle = shingle
+        self.threshold = threshold
+        self.capacity = capacity
+        self.snapshot_path = snapshot_path
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, 1 << 32, num_perm).astype(np.uint64)
+        self.b = rng.randint(0, 1 << 32, num_perm).astype(np.uint64)
+
+        self.lock = threading.Lock()
+        self.listings = OrderedDict()   # key: (signature, canonical key)
+        self.buckets = {}               # (band, band hash): set of keys
+        if snapshot_path != None and os.path.exists(snapshot_path):
+            self.load()
+
+    def __len__(self):
+        return len(self.listings)
+
+    def __contains__(self, key):
+        return key in self.listings
+
+    def shingles(self, text):
+        words = WORDS.findall(text.lower())
+        if len(words) < self.shingle:
+            return set([' '.join(words)]) if len(words) > 0 else set()
+        return set(' '.join(words[i:i + self.shingle]) for i in range(len(words) - self.shingle + 1))
+
+    def signature(self, text):
+        """
+            MinHash signature of text (an array of num_perm values), or None for empty text
+        """
+        if type(text) == str:
+            text = text.decode('utf-8', 'ignore')
+        shingles = self.shingles(text)
+        if len(shingles) == 0:
+            return None
+        hashes = np.array([ zlib.crc32(s.encode('utf-8')) & 0xffffffff for s in shingles ], dtype=np.uint64)
+        return ((np.outer(self.a, hashes) + self.b[:, None]) % PRIME).min(axis=1)
+
+    def band_keys(self, signature):
+        return [ (band, hash(signature[band * self.rows:(band + 1) * self.rows].tostring())) for band in range(self.bands) ]
+
+    def similarity(self, s1, s2):
+        return float((s1 == s2).sum()) / self.num_perm
+
+    def find(self, signature):
+        """
+            (canonical key, estimated similarity) of the most similar indexed listing at or
+            above threshold, or None
+        """
+        if signature is None:
+            return None
+        with self.lock:
+            candidates = set()
+            for band_key in self.band_keys(signature):
+                candidates.update(self.buckets.get(band_key, ()))
+            best = None
+            for key in candidates:
+                (other, canonical) = self.listings[key]
+                similarity = self.similarity(signature, other)
+                if similarity >= self.threshold and (best == None or similarity > best[1]):
+                    best = (canonical, similarity)
+            return best
+
+    def add(self, key, signature, canonical=None):
+        """
+            indexes a listing, recording canonical as the listing it reposts (itself if None)
+        """
+        if signature is None:
+            return False
+        with self.lock:
+            self.discard(key)
+            self.listings[key] = (signature, canonical if canonical != None else key)
+            for band_key in self.band_keys(signature):
+                self.buckets.setdefault(band_key, set()).add(key)
+            while len(self.listings) > self.capacity:
+                self.discard(next(iter(self.listings)))
+        return True
+
+    def discard(self, key):
+        entry = self.listings.pop(key, None)
+        if entry == None:
+            return
+        for band_key in self.band_keys(entry[0]):
+            bucket = self.buckets[band_key]
+            bucket.discard(key)
+            if len(bucket) == 0:
+                del self.buckets[band_key]
+
+    def save(self):
+        """
+            atomically writes the indexed listings (oldest first) to self.snapshot_path
+        """
+        if self.snapshot_path == None: return False
+        with self.lock:
+            listings = self.listings.items()
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            cPickle.dump(listings, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, self.snapshot_path)
+        return True
+
+    def load(self):
+        with open(self.snapshot_path, 'rb') as f:
+            listings = cPickle.load(f)
+        for (key, (signature, canonical)) in listings[-self.capacity:]:
+            self.add(key, signature, canonical)
+        return len(self.listings)
@@ -1,4 +1,5 @@
 import math
+import calendar
 import inspect
 import psycopg2
 from types import NoneType
@@ -15,7 +16,8 @@ def pgSQL_type_conversion(f):
 class pgSQL(object):
 
     pg_conn = None
-    pgSQL_conversion_methods = {}
+    columns = None          # column catalog of default_table, {column name: PostgreSQL type}
+    pgSQL_conversion_methods = {}   # python type: convert_* method, found once (see register_conversions)
 
     null = 'NULL'
     nan = 'nan'
@@ -24,12 +26,40 @@ class pgSQL(object):
     
     POSTGRESQL_TYPES = {int:'int4', float:'float4', str:'text', unicode:'text', datetime:'timestamp', bool:'bool'}
 
-    def __init__(self, db_name, db_user, default_table='apartment_listings'):
+    def __init__(self, db_name, db_user, default_table='apartment_listings', partitioned=False, pg_conn=None):
         self.default_table = default_table
-        self.pg_conn = psycopg2.connect('dbname={0} user={1}'.format(db_name, db_user))
-        for (name, method) in inspect.getmembers(self, predicate=inspect.ismethod):
+        self.partitioned = partitioned
+        # active listings live in a partition of their own in the partitioned layout (see init_db)
+        self.active_table = default_table + '_active' if partitioned else default_table
+        self.archive_partitions = set()
+        self.history_table = None
+        self.prepared_statements = {}
+        # pg_conn: an open connection to use instead, eg: taken from a connection pool (see release)
+        self.pg_conn = pg_conn if pg_conn != None else psycopg2.connect('dbname={0} user={1}'.format(db_name, db_user))
+        if len(self.pgSQL_conversion_methods) == 0:
+            self.register_conversions()
+
+    @classmethod
+    def register_conversions(cls):
+        for (name, method) in inspect.getmembers(cls, predicate=inspect.ismethod):
             if '_conversionType' in dir(method):
-                self.pgSQL_conversion_methods[ method._conversionType ] = method
+                cls.pgSQL_conversion_methods[ method._conversionType ] = method
+
+    def release(self, pg_pool):
+        """
+            hands self.pg_conn back to pg_pool, after dropping the statements prepared on it
+            (the next pgSQL using the connection prepares its own)
+        """
+        try:
+            self.pg_conn.rollback()
+            self.pg_conn.cursor().execute('deallocate all')
+            self.pg_conn.commit()
+        except psycopg2.Error as e:
+            pg_pool.putconn(self.pg_conn, close=True)
+        else:
+            pg_pool.putconn(self.pg_conn)
+        self.prepared_statements = {}
+        self.pg_conn = None
 
 
     def insert(self, metrics):
@@ -43,23 +73,31 @@ class pgSQL(object):
 
         """
 
-        insert = u'insert into {0} {1} values {2}'
-        vals = [ self.pgSQL_convert( metrics[key] ) for key in metrics.keys() ]
-        keys_str = '(' + ','.join(metrics.keys()) + ')'
-        vals_str = '(' + ','.join(vals) + ')'
-        query = insert.format(self.default_table, keys_str, vals_str)
+        keys = sorted(metrics.keys())
+        params = [ metrics[key] for key in keys ]
+        insert = 'insert into {0} ({1}) values ({2})'
+        query = insert.format(self.default_table, ','.join(keys), self.placeholders(len(keys)))
+
+        missing_field_names = self.identify_missing(metrics.keys())
+        if len(missing_field_names) > 0:
+            missing_fields = { key:type(metrics[key]) for key in missing_field_names }
+            if not self.add_columns(missing_fields):
+                return False
+
         cursor = self.pg_conn.cursor()
         try:
-            cursor.execute(query)
+            self.execute_prepared(cursor, query, params)
         except Exception as e:
             self.pg_conn.rollback()
             if str(e.pgcode) == str(psycopg2.errorcodes.UNDEFINED_COLUMN):
+                # the table was altered behind the catalog's back
+                self.load_columns()
                 missing_field_names = self.identify_missing(metrics.keys())
                 missing_fields = { key:type(metrics[key]) for key in missing_field_names }
                 success = self.add_columns(missing_fields)
                 if success:
                     cursor = self.pg_conn.cursor()
-                    cursor.execute(query)
+                    self.execute_prepared(cursor, query, params)
                 else:
                     return False
             elif str(e.pgcode) == str(psycopg2.errorcodes.UNIQUE_VIOLATION):
@@ -69,12 +107,157 @@ class pgSQL(object):
         self.pg_conn.commit()
         return True
 
+    def insert_many(self, metrics_list):
+        """
+            insert a batch of metric dictionaries with one multi-row insert and a single commit
+
+            columns are reconciled once for the union of keys in the batch, and a listing that
+            lacks one of those keys gets NULL for it. If a row violates a unique constraint
+            the batch is retried row by row (inside the same transaction) and that row is skipped
+
+            metrics_list: list of dictionaries of key/value pairs for database. Keys MUST be STRINGS
+
+            Returns a list with the listing_number of every row (None for skipped rows), in order
+
+        """
+        if len(metrics_list) == 0: return []
+        keys = self.reconcile_columns(metrics_list)
+
+        cursor = self.pg_conn.cursor()
+        row_template = '(' + ','.join(['%s'] * len(keys)) + ')'
+        rows = [ cursor.mogrify(row_template, [metrics.get(key) for key in keys]) for metrics in metrics_list ]
+        insert = 'insert into {0} ({1}) values {2} returning listing_number'
+        try:
+            cursor.execute(insert.format(self.default_table, ','.join(keys), ','.join(rows)))
+            listing_numbers = [row[0] for row in cursor.fetchall()]
+        except Exception as e:
+            self.pg_conn.rollback()
+            if str(e.pgcode) != str(psycopg2.errorcodes.UNIQUE_VIOLATION):
+                raise
+            listing_numbers = []
+            for row in rows:
+                cursor.execute('savepoint insert_row')
+                try:
+                    cursor.execute(insert.format(self.default_table, ','.join(keys), row))
+                    listing_numbers.append(cursor.fetchone()[0])
+                except Exception as e:
+                    if str(e.pgcode) != str(psycopg2.errorcodes.UNIQUE_VIOLATION):
+                        self.pg_conn.rollback()
+                        raise
+                    cursor.execute('rollback to savepoint insert_row')
+                    listing_numbers.append(None)
+        self.pg_conn.commit()
+        return listing_numbers
+
+    def update_many(self, key, metrics_list):
+        """
+            updates the listings whose `key` column matches metrics[key] with the rest of each
+            metrics dictionary, in a single update ... from (values ...) statement and commit
+
+            columns are reconciled once for the union of keys in the batch, like insert_many
+
+            Returns the number of rows updated
+
+        """
+        metrics_list = [metrics for metrics in metrics_list if metrics.get(key) != None]
+        if len(metrics_list) == 0: return 0
+        keys = self.reconcile_columns(metrics_list)
+        if key not in keys: keys.append(key)
+        fields = [k for k in keys if k != key]
+        if len(fields) == 0: return 0
+
+        cursor = self.pg_conn.cursor()
+        row_template = '(' + ','.join('%s::{0}'.format(self.columns[k.lower()]) for k in keys) + ')'
+        rows = [ cursor.mogrify(row_template, [metrics.get(k) for k in keys]) for metrics in metrics_list ]
+        update = 'update {0} set {1} from (values {2}) as v ({3}) where {0}.{4} = v.{4}'
+        assignments = ','.join('{0} = v.{0}'.format(k) for k in fields)
+        try:
+            cursor.execute(update.format(self.default_table, assignments, ','.join(rows), ','.join(keys), key))
+        except Exception as e:
+            self.pg_conn.rollback()
+            raise
+        self.pg_conn.commit()
+        return cursor.rowcount
+
+    def reconcile_columns(self, metrics_list):
+        """
+            adds the columns missing for the union of keys of metrics_list (typed by their first
+            value that isn't None)
+
+            Returns the keys that have a column, ie: all of them except the missing keys whose
+            values are all None
+        """
+        field_types = {}
+        for metrics in metrics_list:
+            for (key, val) in metrics.items():
+                if val != None:
+                    field_types[key] = field_types.get(key) or type(val)
+                else:
+                    field_types.setdefault(key, None)
+
+        missing_field_names = self.identify_missing(field_types.keys())
+        missing_fields = { key:field_types[key] for key in missing_field_names if field_types[key] != None }
+        if len(missing_fields) > 0:
+            self.add_columns(missing_fields)
+        return [key for key in field_types.keys() if key not in missing_field_names or key in missing_fields]
+
+    def execute_prepared(self, cursor, query, params=()):
+        """
+            executes query as a server side prepared statement, preparing it the first time
+            it is seen on this connection so the server parses and plans it only once
+
+            query  -- statement text with $1, $2, ... placeholders
+            params -- values bound to the placeholders (adapted by psycopg2, never formatted
+                      into the statement text)
+        """
+        name = self.prepared_statements.get(query)
+        if name == None:
+            name = 'stmt_{0}'.format(len(self.prepared_statements))
+            cursor.execute('prepare {0} as {1}'.format(name, query))
+            self.prepared_statements[query] = name
+        if len(params) == 0:
+            cursor.execute('execute {0}'.format(name))
+        else:
+            cursor.execute('execute {0} ({1})'.format(name, ','.join(['%s'] * len(params))), list(params))
+
+    def read_rows(self, query, params=(), prepared=True):
+        """
+            rows returned by a read-only query (prepared, see execute_prepared, or formatted by
+            psycopg2 with %s placeholders). Its transaction is ended at once: an idle
+            transaction keeps a share lock on every table it read, which blocks the alter
+            table of add_columns on any other connection until it ends
+        """
+        cursor = self.pg_conn.cursor()
+        try:
+            if prepared:
+                self.execute_prepared(cursor, query, params)
+            else:
+                cursor.execute(query, params)
+            rows = cursor.fetchall()
+        except Exception as e:
+            self.pg_conn.rollback()
+            raise
+        self.pg_conn.commit()
+        return rows
+
+    def placeholders(self, n, start=1):
+        return ','.join('${0}'.format(i) for i in range(start, start + n))
+
+    def where_params(self, identifier, start=1):
+        """
+            returns a where clause matching every key of identifier against a placeholder,
+            and the values to bind to those placeholders
+        """
+        keys = sorted(identifier.keys())
+        clause = ' and '.join('{0} = ${1}'.format(k, i) for (i, k) in enumerate(keys, start))
+        return 'where ' + clause, [identifier[k] for k in keys]
+
     def add_columns(self, fields):
         """
             adds columns to self.default_table based on dictionary of name/type pairs
 
             keys become column names, types become PostgreSQL types (based on the  type map found 
-            in self.POSTGRESQL_TYPES)
+            in self.POSTGRESQL_TYPES). The column catalog is updated in place
 
             fields: dictionary mapping column names to python types
 
@@ -90,11 +273,14 @@ class pgSQL(object):
             except Exception as e:
                 self.pg_conn.rollback()
                 raise
+            if self.columns != None:
+                self.columns[name.lower()] = pgSQL_type
         return True
 
     def identify_missing(self, fields):
         """
-                Identifies columns which do not exist for a given table
+                Identifies columns which do not exist for a given table, using the cached column
+                catalog (no queries are made once the catalog is loaded)
 
                 Args:
                                 fields  -- a list of column names
@@ -103,71 +289,155 @@ class pgSQL(object):
                                 a list of dataabase field names which were not found in self.database
 
         """
+        if self.columns == None:
+            self.load_columns()
+        return [field for field in fields if field.lower() not in self.columns]
 
-        missing_fields = []
-        select = 'select {0} from {1};'
-        cursor = self.pg_conn.cursor()
-        for field in fields:
-            query = select.format(field, self.default_table)
-            try:
-                cursor.execute(query)
-            except Exception as e:
-                self.pg_conn.rollback()
-                if str(e.pgcode) == str(psycopg2.errorcodes.UNDEFINED_COLUMN):
-                    missing_fields.append(field)
-                else:
-                    raise
-        return missing_fields
+    def load_columns(self):
+        """
+            (re)loads the column catalog of self.default_table from information_schema.columns
+        """
+        query = 'select column_name, udt_name from information_schema.columns where table_schema = current_schema() and table_name = %s'
+        self.columns = dict(self.read_rows(query, (self.default_table.lower(),), prepared=False))
+        return self.columns
 
-    def get_active_listings(self, column_selection):
+    def get_active_listings(self, column_selection, limit=None):
         """
+            returns the selected columns of every listing that is not archived
+
+            limit -- if given, only the `limit` most recently inserted listings are returned
         """
         column_selection_string = ','.join(column_selection)
-        query = 'select {0} from {1} where archived = False'.format(column_selection_string, self.default_table)
+        query = 'select {0} from {1} where archived = False'.format(column_selection_string, self.active_table)
+        params = []
+        if limit != None:
+            query += ' order by listing_number desc limit $1'
+            params.append(int(limit))
+        return self.read_rows(query, params)
+
+    def get_listings(self, column_selection, listing_numbers):
+        """
+            returns the selected columns of the active listings in listing_numbers
+        """
+        if len(listing_numbers) == 0: return []
+        query = 'select {0} from {1} where listing_number = any($1)'.format(','.join(column_selection), self.active_table)
+        return self.read_rows(query, [list(listing_numbers)])
+
+    def insert_history(self, changes):
+        """
+            appends changed fields to <table>_history (created if needed), one row of
+            (listing_number, changed_at, field, old_value, new_value) per change, with a single
+            multi-row insert and commit. Values are stored as text
+
+            changes -- list of (listing_number, field, old value, new value)
+
+            Returns the number of rows inserted
+        """
+        if len(changes) == 0: return 0
         cursor = self.pg_conn.cursor()
-        cursor.execute(query)
-        return cursor.fetchall()
+        if self.history_table == None:
+            self.history_table = self.default_table + '_history'
+            create = 'create table if not exists {0}( listing_number int8, changed_at timestamp, field text, old_value text, new_value text )'
+            cursor.execute(create.format(self.history_table))
+            cursor.execute('create index if not exists {0}_listing_idx on {0} (listing_number, changed_at)'.format(self.history_table))
+        now = datetime.now()
+        text = lambda value: unicode(value) if value != None and type(value) != str else value
+        rows = [ cursor.mogrify('(%s,%s,%s,%s,%s)', (listing_number, now, field, text(old), text(new)))
+                 for (listing_number, field, old, new) in changes ]
+        try:
+            cursor.execute('insert into {0} values {1}'.format(self.history_table, ','.join(rows)))
+        except Exception as e:
+            self.pg_conn.rollback()
+            self.history_table = None
+            raise
+        self.pg_conn.commit()
+        return len(rows)
 
     def archive_listing(self, identifier):
         """
-            sets a listing's archived field to True
+            sets a listing's archived field to True and its archived_at field to the current time
 
             identifier -- dictionary of key/value pairs that identify a given listing
         """
+        archived_at = self.prepare_archive()
         cursor = self.pg_conn.cursor()
-        where_clause = self.unique_where(identifier)
-        query = u'update {0} set archived = True {1}'.format(self.default_table, where_clause)
-        cursor.execute(query)
+        where_clause, params = self.where_params(identifier, start=2)
+        query = 'update {0} set archived = True, archived_at = $1 {1} and archived = False'.format(self.default_table, where_clause)
+        self.execute_prepared(cursor, query, [archived_at] + params)
         self.pg_conn.commit()
         return True
 
-    def apt_exists(self, identifier):
+    def existing(self, field, values):
+        """
+            returns the subset of values already stored in column field, using a single
+            'field = ANY(array)' query
+
+            field  -- column name
+            values -- list of values to look up
+        """
+        if len(values) == 0 or len(self.identify_missing([field])) > 0:
+            return set()
+        query = 'select {0} from {1} where {0} = any(%s)'.format(field, self.default_table)
+        return set(row[0] for row in self.read_rows(query, (list(values),), prepared=False))
+
+    def archive_listings(self, listing_numbers):
+        """
+            sets the archived field of every listing in listing_numbers to True (and archived_at
+            to the current time) with a single update and commit. In the partitioned layout the
+            update moves the rows out of the active partition in bulk: it has to go through the
+            parent table (PostgreSQL only moves rows between partitions then), and archived =
+            False prunes it to the active partition
+
+            Returns the number of listings archived
+        """
+        if len(listing_numbers) == 0: return 0
+        archived_at = self.prepare_archive()
+        cursor = self.pg_conn.cursor()
+        query = 'update {0} set archived = True, archived_at = $1 where listing_number = any($2) and archived = False'.format(self.default_table)
+        self.execute_prepared(cursor, query, [archived_at, list(listing_numbers)])
+        self.pg_conn.commit()
+        return cursor.rowcount
+
+    def mark_checked(self, listing_numbers):
+        """
+            sets the last_checked field of every listing in listing_numbers to the current time
+        """
+        if len(listing_numbers) == 0: return 0
         cursor = self.pg_conn.cursor()
-        where_clause = self.unique_where(identifier)
-        query = u'select exists(select 1 from {0} {1})'.format(self.default_table, where_clause)
+        query = 'update {0} set last_checked = $1 where listing_number = any($2)'.format(self.active_table)
+        self.execute_prepared(cursor, query, [datetime.now(), list(listing_numbers)])
+        self.pg_conn.commit()
+        return cursor.rowcount
+
+    def apt_exists(self, identifier):
+        if len(self.identify_missing(identifier.keys())) > 0:
+            return False
+        where_clause, params = self.where_params(identifier)
+        query = 'select exists(select 1 from {0} {1})'.format(self.default_table, where_clause)
         try:
-            cursor.execute(query)
-        except Exception as e:
-            self.pg_conn.rollback()
+            return self.read_rows(query, params)[0][0]
+        except psycopg2.Error as e:
             if str(e.pgcode) == str(psycopg2.errorcodes.UNDEFINED_COLUMN):
                 return False
             raise
-        return cursor.fetchone()[0]
 
 
     def get_uid(self, identifier):
-        where_clause = self.unique_where(identifier)
-        query = u'select listing_number from {0} {1}'.format(self.default_table, where_clause)
-        cursor = self.pg_conn.cursor()
-        cursor.execute(query)
-        return cursor.fetchone()[0]
+        where_clause, params = self.where_params(identifier)
+        query = 'select listing_number from {0} {1}'.format(self.default_table, where_clause)
+        return self.read_rows(query, params)[0][0]
 
     def unique_where(self, identifier):
+        """
+            literal (string formatted) where clause for identifier, for ad hoc queries.
+            The methods of this class bind values as parameters instead (see where_params)
+        """
+        converted = {}
         for (k, v) in identifier.items():
             if type(v) == str:
                 v = unicode(v, 'utf-8')
-            identifier[k] = self.pgSQL_convert(v)
-        return u'where ' + u' and '.join([u'{0} = {1}'.format(k, v) for (k, v) in identifier.items()])
+            converted[k] = self.pgSQL_convert(v)
+        return u'where ' + u' and '.join([u'{0} = {1}'.format(k, v) for (k, v) in converted.items()])
 
     @pgSQL_type_conversion
     def convert_str(self, val):
@@ -209,10 +479,93 @@ class pgSQL(object):
 
     def pgSQL_convert(self, val):
         conversion = self.pgSQL_conversion_methods[ type(val) ]
-        return conversion(val)
+        return conversion(self, val)
     
     def init_db(self):
+        """
+            creates self.default_table. In the partitioned layout (partitioned=True, PostgreSQL 11+)
+            the table is partitioned on archived:
+
+                <table>_active      -- listings not archived yet, a small hot partition
+                <table>_archived    -- archived listings, partitioned in turn by month of
+                                       archived_at (<table>_archived_YYYYMM, created as needed
+                                       by archive_listings), with a default partition for rows
+                                       archived without a date
+
+            so the active set is read, checked and archived without touching the history
+        """
+        cursor = self.pg_conn.cursor()
+        create = 'create table {0}( cl_id int8, listing_number serial8, url text, title text, rss_link text, archived bool default False, archived_at timestamp )'
+        if not self.partitioned:
+            cursor.execute(create.format(self.default_table))
+        else:
+            cursor.execute(create.format(self.default_table) + ' partition by list (archived)')
+            partition = 'create table {0}_{1} partition of {0} {2}'
+            cursor.execute(partition.format(self.default_table, 'active', 'for values in (False, NULL)'))
+            cursor.execute(partition.format(self.default_table, 'archived', 'for values in (True) partition by range (archived_at)'))
+            cursor.execute(partition.format(self.default_table + '_archived', 'default', 'default'))
+        self.pg_conn.commit()
+        self.archive_partitions = set()
+        self.load_columns()
+        self.create_indexes()
+
+    def prepare_archive(self):
+        """
+            makes sure the archived_at column (and in the partitioned layout, this month's
+            archive partition) exists before listings are archived.
+            Returns the archive time
+        """
+        now = datetime.now()
+        if len(self.identify_missing(['archived_at'])) > 0:
+            self.add_columns({'archived_at':datetime})
+        if self.partitioned:
+            self.create_archive_partition(now)
+        return now
+
+    def create_archive_partition(self, when):
+        """
+            creates (if it doesn't exist yet) the partition of <table>_archived for the month
+            of when. Returns its name
+        """
+        start = datetime(when.year, when.month, 1)
+        end = datetime(when.year + when.month / 12, when.month % 12 + 1, 1)
+        name = '{0}_archived_{1}'.format(self.default_table, start.strftime('%Y%m'))
+        if name in self.archive_partitions:
+            return name
+        # partition bounds must be literals (no ::timestamp casts as psycopg2 would bind them)
+        query = "create table if not exists {0} partition of {1}_archived for values from ('{2}') to ('{3}')"
         cursor = self.pg_conn.cursor()
-        cursor.execute('create table {0}( cl_id int8, listing_number serial8 )'.format(self.default_table))
+        try:
+            cursor.execute(query.format(name, self.default_table, start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')))
+        except Exception as e:
+            self.pg_conn.rollback()
+            raise
         self.pg_conn.commit()
+        self.archive_partitions.add(name)
+        return name
+
+    def create_indexes(self):
+        """
+            creates (if they don't exist yet) the indexes used by the lookups in this class:
+                (url, title)       -- apt_exists, get_uid, archive_listing by primary key
+                rss_link           -- existing() dedupe of feed items
+                listing_number     -- partial index over active listings for get_active_listings
+        """
+        index = 'create index if not exists {0}_{1}_idx on {0} {2}'
+        indexes = [ ('url_title', '(url, title)'),
+                    ('rss_link', '(rss_link)'),
+                    ('active', '(listing_number) where archived = False') ]
+        cursor = self.pg_conn.cursor()
+        for (name, definition) in indexes:
+            cursor.execute(index.format(self.default_table, name, definition))
+        self.pg_conn.commit()
+
 
+def as_timestamp(dt):
+    """
+        dt as a timestamp column reads it back: psycopg2 sends a datetime with a tzinfo as a
+        timestamptz, which PostgreSQL stores converted to the session's (local) time, naive
+    """
+    if dt.tzinfo == None:
+        return dt
+    return datetime.fromtimestamp(calendar.timegm(dt.utctimetuple()))
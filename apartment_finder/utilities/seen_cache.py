@@ -0,0 +1,80 @@
+import os
+import cPickle
+import threading
+from collections import OrderedDict
+
+class SeenCache(object):
+
+    """
+    Bounded, in-memory LRU set of identifiers for listings that are already stored.
+
+    A hit means the listing is known and the database does not need to be asked. A miss
+    proves nothing (the identifier may have been evicted), so callers fall back to the
+    database for misses. Memory is bounded by capacity no matter how large the listings
+    table grows.
+
+    The cache can be snapshotted to a local file so that a restarted process starts warm.
+
+    """
+
+    def __init__(self, capacity=100000, snapshot_path=None):
+        self.capacity = capacity
+        self.snapshot_path = snapshot_path
+        self.keys = OrderedDict()
+        self.lock = threading.Lock()
+        if snapshot_path != None and os.path.exists(snapshot_path):
+            self.load()
+
+    def __contains__(self, key):
+        key = self.normalize(key)
+        with self.lock:
+            if key not in self.keys:
+                return False
+            del self.keys[key]
+            self.keys[key] = True
+            return True
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key):
+        key = self.normalize(key)
+        with self.lock:
+            self.keys.pop(key, None)
+            self.keys[key] = True
+            while len(self.keys) > self.capacity:
+                self.keys.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.keys.clear()
+
+    def update(self, keys):
+        for key in keys:
+            self.add(key)
+
+    def normalize(self, key):
+        if type(key) == unicode:
+            return key.encode('utf-8')
+        if type(key) == tuple:
+            return tuple(self.normalize(k) for k in key)
+        return key
+
+    def save(self):
+        """
+            atomically writes the cached identifiers (oldest first) to self.snapshot_path
+        """
+        if self.snapshot_path == None: return False
+        with self.lock:
+            keys = self.keys.keys()
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            cPickle.dump(keys, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, self.snapshot_path)
+        return True
+
+    def load(self):
+        with open(self.snapshot_path, 'rb') as f:
+            keys = cPickle.load(f)
+        self.update(keys[-self.capacity:])
+        return len(self.keys)
@@ -0,0 +1,162 @@
+import math
+import heapq
+import threading
+
+KM_PER_DEGREE = 111.195
+
+class SpatialIndex(object):
+
+    """
+    In-memory grid index of listing coordinates for comparable-listing queries
+
+    Listings are bucketed into cells of cell_km x cell_km (degrees of longitude are scaled by
+    the cosine of the latitude the index is centered on), so radius and k-nearest queries only
+    look at the few cells around the query point instead of scanning every listing.
+
+        add / remove    -- keep the index in step with inserts and archiving
+        radius          -- listings within km of a point
+        nearest         -- the k listings closest to a point
+
+    Queries take optional br and ft2 filters, each a (low, high) range (inclusive, None for
+    unbounded). Listings without a value are excluded by a filter on that field. Listings
+    and query points without coordinates (see pgSQL.no_geo) are ignored.
+
+    """
+
+    def __init__(self, cell_km=1.0, center_latitude=40.7):
+        self.cell_km = cell_km
+        self.lon_scale = math.cos(math.radians(center_latitude))
+        self.lock = threading.Lock()
+        self.cells = {}             # (row, column): {listing_number: (lat, lon, br, ft2)}
+        self.listings = {}          # listing_number: cell
+
+    @classmethod
+    def from_db(cls, pgSQL, **kwargs):
+        """
+            SpatialIndex of every active listing with coordinates
+        """
+        index = cls(**kwargs)
+        fields = ['listing_number', 'latitude', 'longitude', 'br', 'ft2']
+        if len(pgSQL.identify_missing(['latitude', 'longitude', 'archived'])) > 0:
+            return index
+        columns = [ f if len(pgSQL.identify_missing([f])) == 0 else 'null' for f in fields ]
+        for row in pgSQL.get_active_listings(columns):
+            index.add(*row)
+        return index
+
+    def __len__(self):
+        return len(self.listings)
+
+    def __contains__(self, listing_number):
+        return listing_number in self.listings
+
+    def xy(self, latitude, longitude):
+        """
+            planar position of a coordinate, in km
+        """
+        return latitude * KM_PER_DEGREE, longitude * KM_PER_DEGREE * self.lon_scale
+
+    def cell(self, latitude, longitude):
+        (x, y) = self.xy(latitude, longitude)
+        return int(math.floor(x / self.cell_km)), int(math.floor(y / self.cell_km))
+
+    def add(self, listing_number, latitude, longitude, br=None, ft2=None):
+        """
+            indexes (or moves) a listing. Returns False if it has no usable coordinates
+        """
+        if not located(latitude, longitude):
+            return False
+        (latitude, longitude) = (float(latitude), float(longitude))
+        cell = self.cell(latitude, longitude)
+        with self.lock:
+            self.discard(listing_number)
+            self.cells.setdefault(cell, {})[listing_number] = (latitude, longitude, br, ft2)
+            self.listings[listing_number] = cell
+        return True
+
+    def remove(self, listing_number):
+        with self.lock:
+            self.discard(listing_number)
+
+    def discard(self, listing_number):
+        cell = self.listings.pop(listing_number, None)
+        if cell != None:
+            del self.cells[cell][listing_number]
+            if len(self.cells[cell]) == 0:
+                del self.cells[cell]
+
+    def radius(self, latitude, longitude, km, br=None, ft2=None):
+        """
+            [(distance in km, listing_number)] of the listings within km of the point that pass
+            the br / ft2 filters, closest first
+        """
+        if not located(latitude, longitude):
+            return []
+        (row, column) = self.cell(latitude, longitude)
+        reach = int(math.ceil(km / self.cell_km))
+        found = []
+        with self.lock:
+            for i in range(row - reach, row + reach + 1):
+                for j in range(column - reach, column + reach + 1):
+                    found.extend(self.matches((i, j), latitude, longitude, br, ft2))
+        return sorted((d, n) for (d, n) in found if d <= km)
+
+    def nearest(self, latitude, longitude, k, br=None, ft2=None, max_km=10.0):
+        """
+            [(distance in km, listing_number)] of the (at most) k listings closest to the point
+            that pass the br / ft2 filters and are within max_km, closest first
+
+            Cells are visited in rings of growing size, until the k-th closest listing found so
+            far is closer than anything in the next ring can be
+        """
+        if not located(latitude, longitude):
+            return []
+        (row, column) = self.cell(latitude, longitude)
+        best = []                   # heap of (-distance, listing_number)
+        with self.lock:
+            for ring in range(int(math.ceil(max_km / self.cell_km)) + 1):
+                if len(best) == k and -best[0][0] <= (ring - 1) * self.cell_km:
+                    break
+                for cell in self.ring(row, column, ring):
+                    for (d, n) in self.matches(cell, latitude, longitude, br, ft2):
+                        if d > max_km:
+                            continue
+                        if len(best) < k:
+                            heapq.heappush(best, (-d, n))
+                        elif d < -best[0][0]:
+                            heapq.heapreplace(best, (-d, n))
+        return sorted((-d, n) for (d, n) in best)
+
+    def ring(self, row, column, ring):
+        if ring == 0:
+            return [(row, column)]
+        cells = []
+        for offset in range(-ring, ring + 1):
+            cells += [(row - ring, column + offset), (row + ring, column + offset)]
+        for offset in range(-ring + 1, ring):
+            cells += [(row + offset, column - ring), (row + offset, column + ring)]
+        return cells
+
+    def matches(self, cell, latitude, longitude, br, ft2):
+        (x, y) = self.xy(latitude, longitude)
+        for (n, (lat, lon, n_br, n_ft2)) in self.cells.get(cell, {}).iteritems():
+            if in_range(n_br, br) and in_range(n_ft2, ft2):
+                (nx, ny) = self.xy(lat, lon)
+                yield math.hypot(nx - x, ny - y), n
+
+def located(latitude, longitude):
+    """
+        whether a coordinate is usable: pgSQL.no_geo stores the string 'nan', the db NULL
+    """
+    try:
+        return not (math.isnan(float(latitude)) or math.isnan(float(longitude)))
+    except (TypeError, ValueError):
+        return False
+
+def in_range(value, bounds):
+    if bounds == None:
+        return True
+    if value == None:
+        return False
+    (low, high) = bounds
+    return (low == None or value >= low) and (high == None or value <= high)
@@ -0,0 +1,210 @@
+import os
+import time
+import zlib
+import struct
+import cPickle
+import threading
+import traceback
+from instrumentation import REGISTRY
+
+HEADER = struct.Struct('>II')       # payload length, crc32 of the payload
+
+class Spool(object):
+
+    """
+    Append-only local log of records (eg: metric dictionaries) waiting to be stored, so that
+    scraping never waits on, or dies with, the database.
+
+    Every record is one frame: its length and crc32, then the pickled record. Appends are
+    written at once but fsynced in batches (every sync_every records, or when sync_t seconds
+    have passed since the last fsync), so a crash loses at most that batch.
+
+    Readers (see SpoolDrainer) read frames from the committed offset, kept in <path>.offset
+    and replaced atomically once the records up to it have been stored: a crash in between
+    only means reading those records again. A torn frame at the end of the log (a crash
+    mid-write) is cut off when the spool is opened. Once every record has been committed the
+    log is truncated, so it only grows while the database is behind.
+
+    """
+
+    def __init__(self, path, sync_every=64, sync_t=1.0):
+        self.path = path
+        self.offset_path = path + '.offset'
+        self.sync_every = sync_every
+        self.sync_t = sync_t
+        self.lock = threading.Lock()
+        self.appended = threading.Condition(self.lock)
+        self.unsynced = 0
+        self.synced = time.time()
+        self.offset = 0
+        if os.path.exists(self.offset_path):
+            with open(self.offset_path) as f:
+                self.offset = int(f.read() or 0)
+        self.recover()
+        self.log = open(path, 'ab')
+
+    def recover(self):
+        """
+            truncates the log after its last whole, valid frame.
+            Returns the number of records not committed yet
+        """
+        if not os.path.exists(self.path):
+            open(self.path, 'wb').close()
+        self.offset = min(self.offset, os.path.getsize(self.path))
+        (records, end) = self.read_frames(self.offset, None)
+        if end < os.path.getsize(self.path):
+            with open(self.path, 'r+b') as f:
+                f.truncate(end)
+        return len(records)
+
+    def append(self, records):
+        """
+            writes records to the end of the log (fsynced with the current batch).
+            Returns the number of records written
+        """
+        data = []
+        for record in records:
+            payload = cPickle.dumps(record, cPickle.HIGHEST_PROTOCOL)
+            data.append(HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff))
+            data.append(payload)
+        if len(data) == 0:
+            return 0
+        with self.lock:
+            self.log.write(''.join(data))
+            self.log.flush()
+            self.unsynced += len(data) / 2
+            if self.unsynced >= self.sync_every or time.time() - self.synced >= self.sync_t:
+                self.sync()
+            self.appended.notify_all()
+        REGISTRY.inc('spool_appended_total', len(data) / 2)
+        return len(data) / 2
+
+    def sync(self):
+        os.fsync(self.log.fileno())
+        self.unsynced = 0
+        self.synced = time.time()
+
+    def read(self, max_records=500, timeout=None):
+        """
+            (records, end offset) of up to max_records records past the committed offset,
+            waiting up to timeout seconds for one to be appended if there are none
+        """
+        with self.lock:
+            if timeout != None and os.path.getsize(self.path) <= self.offset:
+                self.appended.wait(timeout)
+            offset = self.offset
+        return self.read_frames(offset, max_records)
+
+    def read_frames(self, offset, max_records):
+        records = []
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            while max_records == None or len(records) < max_records:
+                header = f.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    break
+                (length, crc) = HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+                    break
+                records.append(cPickle.loads(payload))
+                offset += HEADER.size + length
+        return records, offset
+
+    def commit(self, offset):
+        """
+            records that everything before offset has been stored, truncating the log when
+            nothing is left in it
+        """
+        with self.lock:
+            if offset >= os.path.getsize(self.path):
+                self.log.truncate(0)
+                self.sync()
+                offset = 0
+            self.offset = offset
+            tmp_path = self.offset_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(str(offset))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, self.offset_path)
+
+    def pending(self):
+        """
+            size in bytes of the records not committed yet
+        """
+        with self.lock:
+            return os.path.getsize(self.path) - self.offset
+
+    def close(self):
+        with self.lock:
+            self.sync()
+            self.log.close()
+
+class SpoolDrainer(object):
+
+    """
+    Background thread moving records from a Spool to a store function (eg: one bulk
+    insert_many per batch), as fast as the store accepts them.
+
+    A batch is committed only after store(records) returns. When it raises (the database is
+    down, slow to restart...) the same batch is retried after a delay that doubles up to
+    max_retry_t, while appends keep going to the spool.
+
+    """
+
+    def __init__(self, spool, store, batch_size=500, retry_t=1.0, max_retry_t=60.0, poll_t=1.0):
+        self.spool = spool
+        self.store = store
+        self.batch_size = batch_size
+        self.retry_t = retry_t
+        self.max_retry_t = max_retry_t
+        self.poll_t = poll_t
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        delay = self.retry_t
+        while not self.stopped.is_set():
+            if self.drain_batch(self.poll_t):
+                delay = self.retry_t
+            elif self.spool.pending() > 0:
+                self.stopped.wait(delay)
+                delay = min(delay * 2, self.max_retry_t)
+
+    def drain_batch(self, timeout=None):
+        """
+            stores and commits the next batch.
+            Returns False if it was empty or could not be stored
+        """
+        (records, end) = self.spool.read(self.batch_size, timeout)
+        if len(records) == 0:
+            return False
+        try:
+            with REGISTRY.timed('spool_drain_seconds'):
+                self.store(records)
+        except Exception as e:
+            traceback.print_exc()
+            REGISTRY.inc('spool_drain_failures_total')
+            return False
+        self.spool.commit(end)
+        REGISTRY.inc('spool_drained_total', len(records))
+        return True
+
+    def drain(self, timeout=10.0):
+        """
+            waits until every record in the spool has been stored (or timeout seconds have
+            passed). Returns True if the spool is empty
+        """
+        t_end = time.time() + timeout
+        while self.spool.pending() > 0 and time.time() < t_end:
+            time.sleep(0.01)
+        return self.spool.pending() == 0
+
+    def close(self):
+        self.stopped.set()
+        with self.spool.lock:
+            self.spool.appended.notify_all()
+        self.thread.join()
@@ -0,0 +1,165 @@
+import os
+import numpy as np
+from analytics import Listings
+
+class RentModel(object):
+
+    """
+    Linear model of log(rent) over the stored listing metrics
+
+        features -- bedrooms, log(ft2), and a quadratic surface over the coordinates (so rent
+                    can rise towards a neighbourhood), with indicator columns standing in for
+                    a missing size or location
+
+    The model only keeps the sufficient statistics X'X and X'y, so listings can be folded in
+    one batch at a time (update) and the coefficients re-solved at any time (solve) in
+    microseconds, without ever holding the training set in memory.
+
+        expected_rent -- exp(predicted log rent)
+        deal_score    -- (expected_rent - rent) / expected_rent, > 0 when a listing asks less
+                         than comparable listings do
+
+    """
+
+    FEATURES = ['intercept', 'br', 'has_ft2', 'log_ft2', 'has_geo', 'x', 'y', 'x2', 'y2', 'xy']
+    RIDGE = 1e-3
+
+    def __init__(self, center=(40.7, -73.95), scale_km=10.0):
+        self.center = center
+        self.scale_km = scale_km
+        k = len(self.FEATURES)
+        self.xtx = np.zeros((k, k))
+        self.xty = np.zeros(k)
+        self.n = 0
+        self.coef = None
+
+    def features(self, br, ft2, latitude, longitude):
+        """
+            design matrix of float arrays (NaN where a listing has no value)
+        """
+        br = np.nan_to_num(br)
+        with np.errstate(invalid='ignore'):
+            has_ft2 = np.isfinite(ft2) & (ft2 > 0)
+        log_ft2 = np.log(np.where(has_ft2, ft2, 1.0))
+        has_geo = np.isfinite(latitude) & np.isfinite(longitude)
+        x = np.where(has_geo, (latitude - self.center[0]) * 111.195 / self.scale_km, 0.0)
+        y = np.where(has_geo, (longitude - self.center[1]) * 111.195 * np.cos(np.radians(self.center[0])) / self.scale_km, 0.0)
+        return np.column_stack([np.ones(len(br)), br, has_ft2, log_ft2, has_geo, x, y, x * x, y * y, x * y])
+
+    def listing_features(self, listings):
+        return self.features(listings['br'], listings['ft2'], listings['latitude'], listings['longitude'])
+
+    def update(self, listings):
+        """
+            folds the listings with a rent into the sufficient statistics and re-solves.
+            Returns the number of listings used
+        """
+        rent = listings['rent']
+        with np.errstate(invalid='ignore'):
+            valid = np.isfinite(rent) & (rent > 0)
+        if not valid.any():
+            return 0
+        X = self.listing_features(listings)[valid]
+        self.xtx += X.T.dot(X)
+        self.xty += X.T.dot(np.log(rent[valid]))
+        self.n += int(valid.sum())
+        self.solve()
+        return int(valid.sum())
+
+    def solve(self):
+        if self.n == 0:
+            return None
+        ridge = self.RIDGE * np.eye(len(self.FEATURES))
+        self.coef = np.linalg.solve(self.xtx + ridge, self.xty)
+        return self.coef
+
+    def fit(self, listings):
+        """
+            replaces the model with one fitted on listings
+        """
+        k = len(self.FEATURES)
+        (self.xtx, self.xty, self.n, self.coef) = (np.zeros((k, k)), np.zeros(k), 0, None)
+        self.update(listings)
+        return self
+
+    def expected_rent(self, listings):
+        """
+            expected rent of every listing, as one vectorized batch
+        """
+        return np.exp(self.listing_features(listings).dot(self.coef))
+
+    def score(self, listings):
+        """
+            (expected_rent, deal_score) arrays, deal_score NaN where a listing has no rent
+        """
+        expected = self.expected_rent(listings)
+        with np.errstate(invalid='ignore'):
+            deal = np.where(listings['rent'] > 0, (expected - listings['rent']) / expected, np.nan)
+        return expected, deal
+
+    def score_metrics(self, metrics_list):
+        """
+            adds expected_rent and deal_score to every metrics dictionary (see AptFeed.coalesce_metrics)
+        """
+        if self.coef is None or len(metrics_list) == 0:
+            return metrics_list
+        (expected, deal) = self.score(metrics_listings(metrics_list))
+        for (metrics, e, d) in zip(metrics_list, expected, deal):
+            metrics['expected_rent'] = float(e)
+            metrics['deal_score'] = float(d) if np.isfinite(d) else None
+        return metrics_list
+
+    def save(self, path):
+        """
+            atomically writes the sufficient statistics to path (in .npz format, whatever its
+            extension: np.savez would append .npz to a path without it)
+        """
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, xtx=self.xtx, xty=self.xty, n=self.n, center=self.center, scale_km=self.scale_km)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as saved:
+            model = cls(tuple(saved['center']), float(saved['scale_km']))
+            (model.xtx, model.xty, model.n) = (saved['xtx'], saved['xty'], int(saved['n']))
+        model.solve()
+        return model
+
+def metrics_listings(metrics_list):
+    """
+        Listings of the rent, br, ft2 and geo values of metrics dictionaries
+    """
+    def column(name):
+        return np.array([ as_float(metrics.get(name)) for metrics in metrics_list ], dtype=np.float64)
+    return Listings({ name:column(name) for name in ['rent', 'br', 'ft2', 'latitude', 'longitude'] })
+
+def as_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+def revalue(pgSQL, model_path=None, batch_size=1000, **kwargs):
+    """
+        refits a RentModel on every listing in pgSQL.default_table, scores the active ones in
+        one batch and stores their expected_rent and deal_score with pgSQL.update_many.
+        Meant for a connection of its own (eg: a background thread or a cron job), since
+        Listings.from_db holds a server-side cursor open while it streams
+
+        Returns the new model (saved to model_path, if given), left unsaved and without
+        scoring anything when there were no listings with a rent to fit it on
+    """
+    model = RentModel(**kwargs).fit(Listings.from_db(pgSQL, where=None))
+    if model.coef is None:
+        return model
+    active = Listings.from_db(pgSQL)
+    (expected, deal) = model.score(active)
+    updates = [ {'listing_number':int(n), 'expected_rent':float(e), 'deal_score':float(d) if np.isfinite(d) else None}
+                for (n, e, d) in zip(active['listing_number'], expected, deal) ]
+    for i in range(0, len(updates), batch_size):
+        pgSQL.update_many('listing_number', updates[i:i + batch_size])
+    if model_path != None:
+        model.save(model_path)
+    return model
@@ -1,5 +1,8 @@
 #!/usr/bin/env python
+import sys
 from apartment_finder.data_collection.craigslist_rss import AptFeed
+from apartment_finder.data_collection.archive_scheduler import ArchiveScheduler
+from apartment_finder.utilities.instrumentation import REGISTRY
 
 if __name__ == '__main__':
 
@@ -7,5 +10,14 @@ if __name__ == '__main__':
     # consider changing to allow for no square footage...much harder
     # to extract bedroom and size metrics..but may lose some gems
 
-    parser = AptFeed('', '', '~/proxies', 'apartment_listings','an0nym1ty' )
-    parser.archive()
+    # live listings are rechecked too: edits (eg: price drops) go to apartment_listings_history
+    parser = AptFeed('', '', '~/proxies', 'apartment_listings','an0nym1ty', track_changes=True )
+
+    # --incremental runs forever, checking a bounded number of listings per tick
+    # (instead of every active listing at once from cron_archive)
+    if '--incremental' in sys.argv:
+        REGISTRY.serve(9101)
+        REGISTRY.start_logging(60)
+        ArchiveScheduler(parser).run()
+    else:
+        parser.archive()
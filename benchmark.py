@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+import os
+import sys
+import argparse
+from apartment_finder.test.stand_in import StandIn
+from apartment_finder.test.benchmark import Benchmark
+
+if __name__ == '__main__':
+
+    # runs entirely offline: craigslist is replaced by a local server replaying the recorded
+    # corpus in apartment_finder/test/corpus, PostgreSQL by an in-memory fake (unless --db)
+
+    args = argparse.ArgumentParser(description='benchmark the scraping pipeline offline')
+    args.add_argument('--items', type=int, default=100, help='listings per feed')
+    args.add_argument('--cycles', type=int, default=3, help='full process_feed cycles to time')
+    args.add_argument('--latency', type=float, default=0.05, help='stand-in response time (s)')
+    args.add_argument('--jitter', type=float, default=0.02, help='stand-in response time jitter (s)')
+    args.add_argument('--error-rate', type=float, default=0.0, help='fraction of 503 responses')
+    args.add_argument('--db-latency', type=float, default=0.002, help='simulated database round trip (s)')
+    args.add_argument('--max-per-proxy', type=int, default=4, help='concurrent page fetches')
+    args.add_argument('--parse-processes', type=int, default=None, help='parse in a pool of this many processes (staged pipeline)')
+    args.add_argument('--db', nargs=2, metavar=('DB_NAME', 'DB_USER'), help='use a real PostgreSQL database')
+    args = args.parse_args()
+
+    stand_in = StandIn(args.latency, args.jitter, args.error_rate).start()
+    benchmark = Benchmark(stand_in, args.items, args.db, args.db_latency, args.max_per_proxy, args.parse_processes)
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        benchmark.run(args.cycles)
+    finally:
+        sys.stdout = stdout
+        stand_in.stop()
+    print benchmark.report()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+import os
+import time
+import signal
+import argparse
+import threading
+import traceback
+
+# the scraping modules (bs4, feedparser, psycopg2, numpy...) are imported by Daemon.start, so
+# --help and argument errors return at once
+
+class Daemon(object):
+
+    """
+    One long running process for everything run.py and cron_archive's archive.py did
+    separately, as cooperating workers:
+
+        ingest   -- FeedScheduler polling every feed listed in the feeds file
+        archive  -- ArchiveScheduler rechecking a budget of active listings every tick
+                    (archiving the removed ones, recording the edits of the rest)
+        images   -- the ImageDownloader threads fetching the pictures of new listings
+
+    The workers share one proxy pool (ProxyHandler) and one PostgreSQL connection pool, each
+    taking the connections it needs from it. A worker that raises is restarted, on a new
+    database connection, after a delay doubling up to MAX_RESTART_T.
+
+        SIGTERM, SIGINT -- graceful shutdown: the workers finish their tick, the in-memory
+                           state is saved, queued images are downloaded and connections closed
+        SIGHUP          -- reload: re-reads the feeds file and the proxy list
+
+    """
+
+    RESTART_T = 1.0
+    MAX_RESTART_T = 5*60
+
+    def __init__(self, args):
+        self.args = args
+        self.stopped = threading.Event()
+        self.reload_requested = False
+        self.threads = []
+
+    def start(self):
+        from psycopg2.pool import ThreadedConnectionPool
+        from apartment_finder.data_collection.craigslist_rss import AptFeed
+        from apartment_finder.data_collection.feed_scheduler import FeedScheduler
+        from apartment_finder.data_collection.archive_scheduler import ArchiveScheduler
+        from apartment_finder.data_collection.image_downloader import ImageDownloader
+        from apartment_finder.utilities.general_utils import ProxyHandler
+        from apartment_finder.utilities.instrumentation import REGISTRY
+
+        args = self.args
+        (db_name, db_user) = args.db
+        self.pg_pool = ThreadedConnectionPool(1, args.db_connections, 'dbname={0} user={1}'.format(db_name, db_user))
+        self.proxy_handler = ProxyHandler(os.path.expanduser(args.proxies), max_per_proxy=args.max_per_proxy)
+        self.images = ImageDownloader(self.proxy_handler, os.path.expanduser(args.img_dir), args.image_workers)
+        self.images.resume()
+
+        feeds = self.read_feeds()
+        self.ingest = AptFeed(feeds[0], args.img_dir, db_name=db_name, db_user=db_user, pg_pool=self.pg_pool,
+                              proxy_handler=self.proxy_handler, seen_cache_path='~/.seen_listings',
+                              html_store_path='~/html_store', parse_processes=args.parse_processes,
+                              valuation_path='~/.rent_model.npz', detect_reposts=True, reposts_path='~/.reposts',
+                              watermarks_path='~/.feed_watermarks', spool_path='~/.listing_spool')
+        self.ingest.images = self.images
+        self.archiver = AptFeed('', args.img_dir, db_name=db_name, db_user=db_user, pg_pool=self.pg_pool,
+                                proxy_handler=self.proxy_handler, track_changes=True, warm_seen=False)
+        self.feed_scheduler = FeedScheduler(self.ingest, feeds)
+        self.archive_scheduler = ArchiveScheduler(self.archiver, budget=args.archive_budget)
+
+        if args.metrics_port:
+            REGISTRY.serve(args.metrics_port)
+            REGISTRY.start_logging(60)
+        self.threads = [ self.worker('ingest', self.feed_scheduler.run, self.reconnect_ingest) ]
+        if args.archive_budget > 0:
+            self.threads.append(self.worker('archive', self.archive_scheduler.run, self.reconnect_archiver))
+        return self
+
+    def worker(self, name, run, reset):
+        """
+            starts a thread calling run() until the daemon stops, restarting it when it raises
+            (after calling reset(), eg: to replace a connection the failure may have broken)
+        """
+        from apartment_finder.utilities.instrumentation import REGISTRY
+
+        def supervise():
+            delay = self.RESTART_T
+            restarting = False
+            while not self.stopped.is_set():
+                t_start = time.time()
+                try:
+                    if restarting:
+                        reset()
+                    run()
+                    return
+                except Exception as e:
+                    traceback.print_exc()
+                    REGISTRY.inc('worker_restarts_total', worker=name)
+                    restarting = True
+                if time.time() - t_start > self.MAX_RESTART_T:
+                    delay = self.RESTART_T
+                self.stopped.wait(delay)
+                delay = min(delay * 2, self.MAX_RESTART_T)
+        thread = threading.Thread(target=supervise, name=name)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def reconnect(self, feed):
+        """
+            hands feed's connection back to the pool (closed, if it is broken) and takes a
+            new one
+        """
+        if feed.pgSQL != None:
+            db, feed.pgSQL = feed.pgSQL, None
+            feed.disconnect(db)
+        feed.pgSQL = feed.connect()
+
+    def reconnect_ingest(self):
+        self.reconnect(self.ingest)
+
+    def reconnect_archiver(self):
+        self.reconnect(self.archiver)
+        self.archive_scheduler.pgSQL = self.archiver.pgSQL
+
+    def read_feeds(self):
+        """
+            the RSS urls listed in the feeds file (one per line, # for comments), or the
+            default feed
+        """
+        path = os.path.expanduser(self.args.feeds)
+        feeds = []
+        if os.path.exists(path):
+            with open(path) as f:
+                feeds = [ l.strip() for l in f.readlines() if l.strip() and not l.startswith('#') ]
+        return feeds or [self.args.default_feed]
+
+    def reload(self):
+        self.reload_requested = False
+        (added, dropped) = self.feed_scheduler.set_feeds(self.read_feeds())
+        proxies = self.proxy_handler.reload()
+        print 'reloaded: {0} feeds added, {1} dropped, {2} proxies'.format(len(added), len(dropped), proxies)
+
+    def run(self):
+        """
+            waits for signals until a shutdown is requested, then stops the workers
+        """
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+        signal.signal(signal.SIGHUP, self.request_reload)
+        # signal handlers only run between bytecodes of the main thread, so it can't block
+        while not self.stopped.is_set():
+            time.sleep(1)
+            if self.reload_requested:
+                self.reload()
+        self.shutdown()
+
+    def request_stop(self, signum, frame):
+        self.stopped.set()
+
+    def request_reload(self, signum, frame):
+        self.reload_requested = True
+
+    def shutdown(self):
+        self.stopped.set()
+        self.feed_scheduler.stop()
+        self.archive_scheduler.stop()
+        for thread in self.threads:
+            thread.join(self.args.shutdown_timeout)
+        self.ingest.end_cycle()
+        self.ingest.close()         # also waits for the queued images
+        self.archiver.close()
+        self.pg_pool.closeall()
+        print 'stopped'
+
+if __name__ == '__main__':
+
+    args = argparse.ArgumentParser(description='scrape, archive and download images in one supervised process')
+    args.add_argument('--db', nargs=2, metavar=('DB_NAME', 'DB_USER'), default=['apartment_listings', 'an0nym1ty'])
+    args.add_argument('--db-connections', type=int, default=8, help='size of the PostgreSQL connection pool')
+    args.add_argument('--feeds', default='~/feeds', help='file listing the RSS urls to poll, one per line')
+    args.add_argument('--default-feed', default=r'https://newyork.craigslist.org/search/aap?format=rss&hasPic=1&minSqft=1')
+    args.add_argument('--proxies', default='~/proxies', help='proxy list, "ip port" per line')
+    args.add_argument('--max-per-proxy', type=int, default=4, help='concurrent requests per proxy')
+    args.add_argument('--img-dir', default='~/img')
+    args.add_argument('--image-workers', type=int, default=8)
+    args.add_argument('--parse-processes', type=int, default=None, help='parse in a pool of this many processes')
+    args.add_argument('--archive-budget', type=int, default=200, help='listings rechecked per archive tick (0: no archiving)')
+    args.add_argument('--metrics-port', type=int, default=9100, help='serve /metrics on this port (0: off)')
+    args.add_argument('--shutdown-timeout', type=float, default=60.0, help='seconds to wait for each worker on shutdown')
+    args = args.parse_args()
+
+    Daemon(args).start().run()
@@ -0,0 +1,12 @@
+#!/usr/bin/env python
+import sys
+from apartment_finder.data_collection.craigslist_rss import AptFeed
+
+if __name__ == '__main__':
+
+    # backfills listings from the pages saved in ~/html_store, without downloading anything.
+    # usage: replay.py [field ...]   (all @metric fields when none are given)
+
+    parser = AptFeed('', '', '', 'apartment_listings','an0nym1ty', html_store_path='~/html_store' )
+    fields = sys.argv[1:] if len(sys.argv) > 1 else None
+    print 'updated {0} listings'.format(parser.replay(fields))
@@ -1,5 +1,9 @@
 #!/usr/bin/env python
+import os
+import multiprocessing
 from apartment_finder.data_collection.craigslist_rss import AptFeed
+from apartment_finder.data_collection.feed_scheduler import FeedScheduler
+from apartment_finder.utilities.instrumentation import REGISTRY
 
 if __name__ == '__main__':
 
@@ -8,5 +12,21 @@ if __name__ == '__main__':
     # to extract bedroom and size metrics..but may lose some gems
 
     link = r'https://newyork.craigslist.org/search/aap?format=rss&hasPic=1&minSqft=1'
-    parser = AptFeed(link, '~/img', '~/proxies', 'apartment_listings','an0nym1ty' )
-    parser.process_feed()
+
+    # ~/feeds lists one RSS url per line (cities, categories...), all polled by one process
+    feeds = [link]
+    feed_list = os.path.expanduser('~/feeds')
+    if os.path.exists(feed_list):
+        with open(feed_list) as f:
+            feeds = [ l.strip() for l in f.readlines() if l.strip() and not l.startswith('#') ]
+
+    parser = AptFeed(link, '~/img', '~/proxies', 'apartment_listings','an0nym1ty', seen_cache_path='~/.seen_listings', html_store_path='~/html_store',
+                    parse_processes=multiprocessing.cpu_count(), download_images=True, valuation_path='~/.rent_model.npz',
+                    detect_reposts=True, reposts_path='~/.reposts', watermarks_path='~/.feed_watermarks',
+                    spool_path='~/.listing_spool' )
+
+    # per-stage counters and latency histograms: Prometheus text at localhost:9100/metrics,
+    # and a JSON summary line every minute
+    REGISTRY.serve(9100)
+    REGISTRY.start_logging(60)
+    FeedScheduler(parser, feeds).run()